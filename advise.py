@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+'''A utility to recommend num_blocks / num_bits for an existing corpus'''
+
+import json
+import argparse
+from simhash_db import Client
+from simhash_db.advisor import advise, sample_hashes
+
+parser = argparse.ArgumentParser(
+    description='Recommend a block configuration for simhash_db')
+parser.add_argument('--backend', type=str,
+    help='Which backend to sample the corpus from')
+parser.add_argument('--config', type=str, required=False,
+    help='Path to a yaml file with the host configuration')
+parser.add_argument('--name', type=str, default='testing',
+    help='The name of the set of simhashes to sample')
+parser.add_argument('--num-blocks', dest='num_blocks', type=int, default=6,
+    help='How many blocks the existing corpus is configured to use')
+parser.add_argument('--num-bits', dest='num_bits', type=int, default=3,
+    help='How many bits the existing corpus is configured to use')
+parser.add_argument('--hash-file', dest='hash_file', type=str,
+    help='Sample from a file of hashes (one per line) instead of a backend')
+parser.add_argument('--sample', type=int, default=100000,
+    help='How many hashes to sample')
+parser.add_argument('--corpus-size', dest='corpus_size', type=int,
+    help='Scale estimates to this many hashes (defaults to the number seen)')
+parser.add_argument('--distance', type=int, default=3,
+    help='The number of differing bits that makes a near-duplicate')
+parser.add_argument('--recall', type=float, default=1.0,
+    help='The minimum fraction of near-duplicates that must be found')
+parser.add_argument('--max-blocks', dest='max_blocks', type=int, default=16,
+    help='The largest number of blocks to consider')
+parser.add_argument('--max-tables', dest='max_tables', type=int, default=200,
+    help='The largest number of tables to consider')
+parser.add_argument('--bytes-per-entry', dest='bytes_per_entry', type=int,
+    default=16, help='Storage used by one hash in one table')
+parser.add_argument('--top', type=int, default=10,
+    help='How many configurations to print')
+parser.add_argument('--json', action='store_true',
+    help='Print all the modelled configurations as JSON')
+
+args = parser.parse_args()
+
+if args.hash_file:
+    source = args.hash_file
+elif args.backend:
+    kwargs = {}
+    if args.config:
+        from yaml import load
+        with open(args.config) as fin:
+            kwargs = load(fin.read())
+    source = Client(args.backend, args.name, args.num_blocks, args.num_bits,
+        **kwargs)
+else:
+    parser.error('One of --backend or --hash-file is required')
+
+sample, seen = sample_hashes(source, args.sample)
+if not sample:
+    parser.error('No hashes to sample')
+
+results = advise(sample, args.distance, args.recall,
+    args.corpus_size or seen, args.max_blocks, args.max_tables,
+    args.bytes_per_entry)
+
+if args.json:
+    print(json.dumps(results, indent=2))
+else:
+    print('Sampled %i of %i hashes' % (len(sample), seen))
+    print('%6s %4s %6s %12s %10s %7s %10s' % (
+        'blocks', 'bits', 'tables', 'cands/query', 'bytes/hash', 'recall',
+        'cost'))
+    for result in results[:args.top]:
+        print('%6i %4i %6i %12.2f %10i %7.4f %10.3f%s' % (
+            result['num_blocks'], result['num_bits'], result['num_tables'],
+            result['candidates_per_query'], result['bytes_per_hash'],
+            result['recall'], result['cost'],
+            '' if result['meets_recall'] else '  (below target recall)'))
+    best = results[0]
+    print('Recommended: num_blocks=%i, num_bits=%i' % (
+        best['num_blocks'], best['num_bits']))
@@ -2,19 +2,37 @@
 
 '''This is a utility to run a benchmark against a backend'''
 
+from __future__ import print_function
+
 import os
+import sys
+import json
 import time
-import psutil
 import random
 import argparse
+import multiprocessing
 from simhash_db import Client, GeneralException
+from simhash_db.metrics import summarize
 
 parser = argparse.ArgumentParser(description='Run benchmarks on simhash_db')
 parser.add_argument('--count', type=int, default=1000,
-    help='How many thousands of keys should be inserted per process')
+    help='How many keys should be in each batch (the batch size)')
+parser.add_argument('--batches', type=int, default=1000,
+    help='How many timed batches each process should run')
+parser.add_argument('--warmup', type=int, default=25,
+    help='How many untimed batches each process should run first')
+parser.add_argument('--prefill', type=int, default=0,
+    help='How many untimed insert batches to run before anything else')
+parser.add_argument('--read-ratio', dest='read_ratio', type=float,
+    default=None, help='Run a mixed workload where this fraction of '
+    'batches are queries and the rest inserts. By default, all inserts are '
+    'run and then all queries')
+parser.add_argument('--query', type=str, default='find_all',
+    choices=['find_all', 'find_one'], help='Which query to run')
 parser.add_argument('--name', type=str, default='testing',
     help='The name of the set of simhashes to use')
-parser.add_argument('--processes', type=int, default=(2 * psutil.NUM_CPUS),
+parser.add_argument('--processes', type=int,
+    default=(2 * multiprocessing.cpu_count()),
     help='How many processes should be forked (defaults to 2 x NUM_CPUS)')
 parser.add_argument('--num-blocks', dest='num_blocks', type=int, default=6,
     help='How many blocks to configure the client to use')
@@ -24,9 +42,24 @@ parser.add_argument('--backend', type=str, required=True,
     help='Which backend to use')
 parser.add_argument('--config', type=str, required=False,
     help='Path to a yaml file with the host configuration')
+parser.add_argument('--local', action='store_true',
+    help='Use local stand-ins instead of real servers: fakeredis for redis, '
+    'mongomock for mongo and the docker-compose container for es')
+parser.add_argument('--seed', type=int, default=None,
+    help='Seed for the generated hashes, for reproducible runs')
+parser.add_argument('--json', type=str, required=False,
+    help='Write the results as JSON to this path ("-" for stdout)')
 
 args = parser.parse_args()
 
+# In-memory backends and the in-process stand-ins don't share data between
+# processes, so each process can only query what it prefilled itself
+per_process = args.backend == 'judy' or (
+    args.local and args.backend in ('redis', 'mongo'))
+if per_process and args.prefill < 1:
+    parser.error('--prefill must be at least 1 with --local or an in-memory '
+                 'backend, or the queries would run against empty stores')
+
 
 # If a configuration file was provided, we should use it
 if args.config:
@@ -37,7 +70,29 @@ else:
     kwargs = {}
 
 
-def make_seeds():
+def local_kwargs():
+    '''Keyword arguments that point a client at a local stand-in'''
+    if args.backend == 'redis':
+        import fakeredis
+        return {'connection': fakeredis.FakeStrictRedis()}
+    elif args.backend == 'mongo':
+        import mongomock
+        return {'connection': mongomock.MongoClient()}
+    elif args.backend == 'es':
+        return {'hosts': ['localhost:14200']}
+    return {}
+
+
+def make_client():
+    '''Make a client for the configured backend'''
+    options = dict(kwargs)
+    if args.local:
+        options.update(local_kwargs())
+    return Client(args.backend, args.name, args.num_blocks, args.num_bits,
+        **options)
+
+
+def make_seeds(rand):
     '''
     Generate all the hashes that we'll be using. We'd like to be able to get a
     large number of hashes for insertion, but we also don't want to:
@@ -45,89 +100,166 @@ def make_seeds():
       1) use a lot of memory holding said set
       2) spend a lot of time generating that set
 
-    So, we generate a number of random seed values, and then insert 1000 hashes
+    So, we generate a number of random seed values, and then insert hashes
     beginning with that number and skipping by another random number. These
     pairs of (seed, skip) are returned'''
     return [(
-        random.randint(0, 2 ** 64),
-        random.randint(1, 1000)
+        rand.randint(0, 2 ** 64 - 1),
+        rand.randint(1, 1000)
     ) for i in range(args.count)]
 
 
-def insert():
-    '''Run the timing numbers for each of the provided seeds for insertion'''
-    seeds = make_seeds()
-    client = Client(args.backend, args.name, args.num_blocks, args.num_bits,
-        **kwargs)
-    for i in range(1000):
-        if i % 25 == 0:
-            print 'Inserting batch %i' % i
-        # We want to get a relatively good mix each time we insert data
-        hashes = [(start + i * interval) for start, interval in seeds]
-        try:
-            results = client.insert(hashes)
-        except GeneralException as exc:
-            print '---> Client exception: %s' % repr(exc)
-
-    # Since this is meant to be run in a subprocess...
-    exit(0)
-
-
-def query():
-    '''Run the timing numbers for each of the provided seeds for query all'''
-    seeds = make_seeds()
-    client = Client(args.backend, args.name, args.num_blocks, args.num_bits,
-        **kwargs)
-    for i in range(1000):
-        if i % 25 == 0:
-            print 'Querying batch %i' % i
-        # We want to get a relatively good mix each time we insert data
-        hashes = [(start + i * interval) for start, interval in seeds]
+def batch(seeds, i):
+    '''The i-th batch of hashes for the provided seeds'''
+    return [(start + i * interval) % (2 ** 64) for start, interval in seeds]
+
+
+def workload(index, phase):
+    '''Return the list of operations this process should run: tuples of
+    (operation, batch number, timed)'''
+    rand = random.Random(None if args.seed is None else args.seed + index)
+    ops = []
+    if phase != args.query or per_process:
+        ops.extend(('insert', i, False) for i in range(args.prefill))
+    offset = args.prefill
+    total = args.warmup + args.batches
+    for i in range(total):
+        if phase == 'mixed':
+            op = 'insert' if rand.random() >= args.read_ratio else args.query
+        else:
+            op = phase
+        if op == 'insert':
+            ops.append((op, offset + i, i >= args.warmup))
+        elif per_process and phase != 'mixed':
+            # Only the prefilled batches were inserted in this process
+            ops.append((op, rand.randint(0, offset - 1), i >= args.warmup))
+        else:
+            # Query batches that were inserted, where possible
+            ops.append((op, rand.randint(0, max(offset + i - 1, 0)),
+                i >= args.warmup))
+    return ops
+
+
+def run(index, phase):
+    '''Run the workload in this process, returning the latencies of each of
+    the timed operations'''
+    rand = random.Random(None if args.seed is None else args.seed + index)
+    seeds = make_seeds(rand)
+    client = make_client()
+    latencies = {}
+    errors = 0
+    for op, num, timed in workload(index, phase):
+        hashes = batch(seeds, num)
+        start = time.time()
         try:
-            results = client.find_all(hashes)
+            getattr(client, op)(hashes)
         except GeneralException as exc:
-            print '---> Client exception: %s' % repr(exc)
+            errors += 1
+            print('---> Client exception: %s' % repr(exc), file=sys.stderr)
+            continue
+        if timed:
+            latencies.setdefault(op, []).append(time.time() - start)
+    return {'latencies': latencies, 'errors': errors}
 
 
-def time_children(processes, function, *args, **kwargs):
-    '''Run `processes` number of forked processes, each running `function` with
-    the provided arguments, and return the timing information'''
-    start = -time.time()
-    times = []
+def time_children(processes, phase):
+    '''Run `processes` number of forked processes, each running the workload
+    for `phase`, and return the wall time and all their latencies'''
+    start = time.time()
+    pipes = {}
     for i in range(processes):
+        read, write = os.pipe()
         pid = os.fork()
         if pid == 0:
-            function(*args, **kwargs)
-        else:
-            print '---> Started %i' % pid
+            os.close(read)
+            status = 0
+            try:
+                results = run(i, phase)
+            except Exception as exc:
+                results = {'latencies': {}, 'errors': 1, 'error': repr(exc)}
+                status = 1
+            with os.fdopen(write, 'w') as fout:
+                fout.write(json.dumps(results))
+            # Since this is meant to be run in a subprocess...
+            os._exit(status)
+        os.close(write)
+        pipes[pid] = read
+        print('---> Started %i' % pid, file=sys.stderr)
+
+    # And now wait for them, and collect the results. Read before waiting so
+    # that a large result can't block the child on a full pipe
+    latencies = {}
+    errors = 0
+    failed = 0
+    for pid, read in pipes.items():
+        with os.fdopen(read) as fin:
+            results = json.loads(fin.read() or '{}')
+        _, status = os.waitpid(pid, 0)
+        print('---> %i finished in %fs' % (pid, time.time() - start),
+            file=sys.stderr)
+        if status or 'error' in results:
+            failed += 1
+            print('---> %i failed: %s' % (
+                pid, results.get('error', 'exit status %i' % status)),
+                file=sys.stderr)
+        errors += results.get('errors', 0)
+        for op, values in results.get('latencies', {}).items():
+            latencies.setdefault(op, []).extend(values)
+
+    return time.time() - start, latencies, errors, failed
 
-    # And now wait for them, and collect the timing information
-    for i in range(processes):
-        pid, status = os.wait()
-        times.append(start + time.time())
-        print '---> %i finished in %fs' % (pid, times[-1])
 
-    return times
+def report(phase, elapsed, latencies, errors):
+    '''Summarize the latencies and throughput of each operation'''
+    results = {}
+    for op, values in latencies.items():
+        summary = summarize(values)
+        summary['batches_per_second'] = len(values) / elapsed
+        summary['hashes_per_second'] = args.count * len(values) / elapsed
+        results[op] = summary
+    return {'phase': phase, 'elapsed': elapsed, 'errors': errors,
+        'operations': results}
+
+
+def display(result):
+    '''Print a human-readable version of a phase's report'''
+    print('%s (%.3fs, %i errors):' % (
+        result['phase'].capitalize(), result['elapsed'], result['errors']))
+    for op, summary in sorted(result['operations'].items()):
+        print('    %s: %i batches' % (op, summary['count']))
+        print('        Latency (p50 | p95 | p99 | max): '
+            '%9.5f s | %9.5f s | %9.5f s | %9.5f s' % (
+                summary['p50'], summary['p95'], summary['p99'],
+                summary['max']))
+        print('        Throughput: %10i hashes / s | %8.1f batches / s' % (
+            summary['hashes_per_second'], summary['batches_per_second']))
 
 
 # Now run the benchmark itself and print out the results
-insert_times = time_children(args.processes, insert)
-query_times = time_children(args.processes, query)
-
-# This is how many hashes we actually tried to insert
-count = 1000 * args.count
-
-print 'Insertion:'
-print '    Times (min | avg | max): %10.5f s   | %10.5f s   | %10.5f s  ' % (
-    min(insert_times), sum(insert_times) / len(insert_times),
-    max(insert_times))
-print '    Rate  (min | avg | max): %10i / s | %10i / s | %10i / s' % (
-    count / max(insert_times), count * len(insert_times) / sum(insert_times),
-    count / min(insert_times))
-
-print 'Query:'
-print '    Times (min | avg | max): %10.5f s   | %10.5f s   | %10.5f s  ' % (
-    min(query_times), sum(query_times) / len(query_times), max(query_times))
-print '    Rate  (min | avg | max): %10i / s | %10i / s | %10i / s' % (
-    count / max(query_times), count * len(query_times) / sum(query_times),
-    count / min(query_times))
+if args.read_ratio is None:
+    phases = ['insert', args.query]
+else:
+    phases = ['mixed']
+
+results = []
+for phase in phases:
+    elapsed, latencies, errors, failed = time_children(args.processes, phase)
+    results.append(report(phase, elapsed, latencies, errors))
+    # Later phases depend on this one (queries need the inserted hashes), so
+    # a process that failed outright makes the rest of the numbers invalid
+    if failed:
+        display(results[-1])
+        print('---> Aborting: %i of %i processes failed the %s phase' % (
+            failed, args.processes, phase), file=sys.stderr)
+        sys.exit(1)
+
+for result in results:
+    display(result)
+
+if args.json:
+    output = json.dumps({'config': vars(args), 'results': results}, indent=2)
+    if args.json == '-':
+        print(output)
+    else:
+        with open(args.json, 'w') as fout:
+            fout.write(output)
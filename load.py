@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+
+'''A utility to find the saturation point of a backend with open-loop load'''
+
+from __future__ import print_function
+
+import json
+import random
+import argparse
+from simhash_db import Client
+from simhash_db.loadgen import sweep
+
+parser = argparse.ArgumentParser(
+    description='Run open-loop load against simhash_db')
+parser.add_argument('--backend', type=str, required=True,
+    help='Which backend to use')
+parser.add_argument('--config', type=str, required=False,
+    help='Path to a yaml file with the host configuration')
+parser.add_argument('--name', type=str, default='testing',
+    help='The name of the set of simhashes to use')
+parser.add_argument('--layouts', type=str, default='6:3',
+    help='Comma-separated num_blocks:num_bits configurations to sweep')
+parser.add_argument('--qps', type=str, default='10,50,100,500,1000,5000',
+    help='Comma-separated request rates to sweep, in requests / second')
+parser.add_argument('--duration', type=float, default=10.0,
+    help='How many seconds to run each rate for')
+parser.add_argument('--op', type=str, default='find_all',
+    choices=['find_all', 'find_one', 'insert'], help='Which operation to run')
+parser.add_argument('--read-ratio', dest='read_ratio', type=float,
+    default=None, help='Mix in inserts so only this fraction are queries')
+parser.add_argument('--batch-size', dest='batch_size', type=str,
+    default='fixed:1', help='Batch size distribution: fixed:N, '
+    'uniform:LOW:HIGH or exponential:MEAN')
+parser.add_argument('--workers', type=int, default=16,
+    help='How many requests may be outstanding at once')
+parser.add_argument('--prefill', type=int, default=10000,
+    help='How many hashes to insert before, which queries are drawn from')
+parser.add_argument('--slo', type=float, default=None,
+    help='Consider a rate saturated if its p99 latency exceeds this (s)')
+parser.add_argument('--seed', type=int, default=None,
+    help='Seed for the schedule and hashes, for reproducible runs')
+parser.add_argument('--json', type=str, required=False,
+    help='Write the results as JSON to this path ("-" for stdout)')
+
+args = parser.parse_args()
+
+if args.config:
+    from yaml import load
+    with open(args.config) as fin:
+        kwargs = load(fin.read())
+else:
+    kwargs = {}
+
+rand = random.Random(args.seed)
+pool = [rand.randint(0, 2 ** 64 - 1) for i in range(args.prefill)]
+rates = [float(r) for r in args.qps.split(',')]
+
+output = []
+for layout in args.layouts.split(','):
+    num_blocks, num_bits = [int(i) for i in layout.split(':')]
+    client = Client(args.backend, args.name, num_blocks, num_bits, **kwargs)
+    if pool:
+        client.insert(pool)
+
+    results, sustained = sweep(client, rates, args.duration, slo=args.slo,
+        op=args.op, sizes=args.batch_size, workers=args.workers,
+        read_ratio=args.read_ratio, pool=pool, seed=args.seed)
+    output.append({'num_blocks': num_blocks, 'num_bits': num_bits,
+        'results': results, 'sustained': sustained})
+
+    print('%s with num_blocks=%i, num_bits=%i:' % (
+        args.backend, num_blocks, num_bits))
+    for result in results:
+        for op, summary in sorted(result['operations'].items()):
+            print('    %8.1f qps -> %8.1f / s  %-8s p50 %9.5f s | '
+                'p99 %9.5f s | max %9.5f s%s' % (
+                    result['rate'], result['throughput'], op,
+                    summary['p50'], summary['p99'], summary['max'],
+                    '  (saturated)' if result['saturated'] else ''))
+        if result['stuck']:
+            print('    %8.1f qps left %i workers stuck on requests' % (
+                result['rate'], result['stuck']))
+    print('    Highest sustained rate: %s' % sustained)
+
+if args.json:
+    text = json.dumps({'config': vars(args), 'layouts': output}, indent=2)
+    if args.json == '-':
+        print(text)
+    else:
+        with open(args.json, 'w') as fout:
+            fout.write(text)
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+
+'''A utility to export, import and migrate corpora of simhashes between
+backends (or block configurations)'''
+
+from __future__ import print_function
+
+import time
+import argparse
+from simhash_db import Client
+from simhash_db.export import chunks
+
+parser = argparse.ArgumentParser(
+    description='Export, import or migrate a corpus of simhashes')
+parser.add_argument('action', choices=['export', 'import', 'migrate'],
+    help='Export the source to --file, import --file into the target, or '
+    'copy the source straight into the target')
+parser.add_argument('--backend', type=str, required=True,
+    help='Which backend to export from (or import into)')
+parser.add_argument('--config', type=str, required=False,
+    help='Path to a yaml file with the host configuration')
+parser.add_argument('--name', type=str, default='testing',
+    help='The name of the set of simhashes')
+parser.add_argument('--num-blocks', dest='num_blocks', type=int, default=6,
+    help='How many blocks the corpus is configured to use')
+parser.add_argument('--num-bits', dest='num_bits', type=int, default=3,
+    help='How many bits the corpus is configured to use')
+parser.add_argument('--target', type=str, required=False,
+    help='Which backend to migrate into')
+parser.add_argument('--target-config', dest='target_config', type=str,
+    required=False, help='Path to a yaml file with the target configuration')
+parser.add_argument('--target-name', dest='target_name', type=str,
+    help='The name of the target set of simhashes (defaults to --name)')
+parser.add_argument('--target-num-blocks', dest='target_num_blocks',
+    type=int, help='How many blocks the target uses (defaults to '
+    '--num-blocks)')
+parser.add_argument('--target-num-bits', dest='target_num_bits', type=int,
+    help='How many bits the target uses (defaults to --num-bits)')
+parser.add_argument('--file', type=str, required=False,
+    help='The file to export to or import from')
+parser.add_argument('--partitions', type=int, default=None,
+    help='How many concurrent range scans to read the source with')
+parser.add_argument('--no-compress', dest='compress', action='store_false',
+    help="Don't compress the exported frames")
+parser.add_argument('--no-delta', dest='delta', action='store_false',
+    help="Don't delta-encode the exported hashes")
+parser.add_argument('--batch-size', dest='batch_size', type=int,
+    default=None, help='How many hashes to insert per batch')
+parser.add_argument('--in-flight', dest='in_flight', type=int, default=None,
+    help='How many batches to keep in flight while inserting')
+
+args = parser.parse_args()
+
+
+def load_config(path):
+    '''Read the host configuration, if there is one'''
+    if not path:
+        return {}
+    from yaml import load
+    with open(path) as fin:
+        return load(fin.read())
+
+
+source = Client(args.backend, args.name, args.num_blocks, args.num_bits,
+    **load_config(args.config))
+
+start = time.time()
+if args.action == 'export':
+    if not args.file:
+        parser.error('export needs a --file to write to')
+    count = source.export(args.file, args.partitions, args.compress,
+        args.delta)
+elif args.action == 'import':
+    if not args.file:
+        parser.error('import needs a --file to read from')
+    count = source.import_(args.file, args.batch_size, args.in_flight)
+else:
+    if not args.target:
+        parser.error('migrate needs a --target backend')
+    target = Client(args.target, args.target_name or args.name,
+        args.target_num_blocks or args.num_blocks,
+        args.target_num_bits or args.num_bits,
+        **load_config(args.target_config))
+    count = target.insert_stream(
+        (hsh for chunk in chunks(source, args.partitions) for hsh in chunk),
+        args.batch_size, args.in_flight)
+
+elapsed = time.time() - start
+print('%s: %i hashes in %.2fs (%.0f / s)' % (
+    args.action, count, elapsed, count / max(elapsed, 1e-9)))
@@ -2,7 +2,13 @@
 
 '''The base client, exclusing backends'''
 
+import time
+import struct
+import itertools
 import simhash
+from collections import deque
+from . import runtime as runtimes
+from .metrics import NullMetrics
 
 
 class GeneralException(Exception):
@@ -18,27 +24,197 @@ class BackendUnsupported(Exception):
 class BaseClient(object):
     '''The interface that all the clients must support, and a couple helper
     functions'''
+    # How many hashes to send to the backend at once when streaming, and how
+    # many of those batches may be outstanding at a time. Backends whose
+    # connections can't be shared between threads only allow one
+    stream_batch_size = 1000
+    stream_in_flight = 4
+    # How many buckets (databases, keys) are probed at once by clients that
+    # keep a retention window
+    probe_workers = 8
+    probe_executor = None
+    # How many concurrent range scans `export` reads with. Backends whose
+    # `scan_table` can't return a whole range leave this at 1, and are read
+    # with `iter_hashes` instead
+    export_partitions = 1
+    # How hashes are indexed: 'range' keeps each table sorted on the permuted
+    # values and scans a range per query; 'exact' stores each hash under a
+    # key per table and looks up a handful of keys (see `exact_key`)
+    index_mode = 'range'
+    INDEX_MODES = ('range', 'exact')
+    # Which of `simhash_db.runtime.RUNTIMES` runs concurrent work
+    runtime = 'threads'
+
     def __init__(self, name, num_blocks, num_bits):
         self.name = name
         self.num_blocks = num_blocks
         self.num_bits = num_bits
         self.corpus = simhash.Corpus(self.num_blocks, self.num_bits)
         self.num_tables = len(self.corpus.tables)
+        self.metrics = NullMetrics()
+
+    def instrument(self, metrics):
+        '''Attach a metrics object (see `simhash_db.metrics`) to this client.
+        Passing None turns instrumentation back off'''
+        self.metrics = metrics or NullMetrics()
+        return self
 
     def ranges(self, hsh):
         '''For a given hash, return a list of all the ranges that have to be
         searched in each of the tables'''
-        permutations = self.permute(hsh)
-        return [(
-            permutations[i] & self.corpus.tables[i].search_mask,
-            permutations[i] | (
-                (2 ** 64 - 1) ^ self.corpus.tables[i].search_mask)
-        ) for i in range(len(permutations))]
+        with self.metrics.timer('ranges'):
+            permutations = self.permute(hsh)
+            return [(
+                permutations[i] & self.corpus.tables[i].search_mask,
+                permutations[i] | (
+                    (2 ** 64 - 1) ^ self.corpus.tables[i].search_mask)
+            ) for i in range(len(permutations))]
 
     def permute(self, hsh):
         '''Return all the permutations of the provided hash'''
         return [table.permute(hsh) for table in self.corpus.tables]
 
+    def permute_bulk(self, hashes):
+        '''Return the permutations of all the provided hashes, as a list per
+        table. Working a table at a time looks up each table's `permute`
+        once, rather than once per hash'''
+        return [list(map(table.permute, hashes))
+                for table in self.corpus.tables]
+
+    def set_index_mode(self, index_mode):
+        '''Choose one of `INDEX_MODES` for this client'''
+        if index_mode not in self.INDEX_MODES:
+            raise ValueError('Unsupported index mode %s' % index_mode)
+        self.index_mode = index_mode
+
+    @staticmethod
+    def exact_key(name, table_num, prefix):
+        '''The key that a table's entries with the provided prefix (the
+        permuted value with the search mask applied, which is also the low
+        end of a query's range) are stored under in the 'exact' index mode.
+        Two hashes within `num_bits` of each other agree on the search
+        blocks of at least one table, so they share at least one key'''
+        return '%s.%s.%x' % (name, table_num, prefix)
+
+    def exact_keys(self, hsh, name=None):
+        '''The keys a hash is stored under in the 'exact' index mode, one per
+        table'''
+        return [self.exact_key(name or self.name, i,
+                               table.permute(hsh) & table.search_mask)
+                for i, table in enumerate(self.corpus.tables)]
+
+    def filter_candidates(self, hsh, candidates, table_num=None):
+        '''Return only those candidates that are within `num_bits` of the
+        provided hash, recording candidate and match counts for the table'''
+        metrics = self.metrics
+        if not metrics.enabled:
+            return [h for h in candidates if
+                    self.corpus.distance(h, hsh) <= self.num_bits]
+
+        with metrics.timer('filter', table_num):
+            results = [h for h in candidates if
+                       self.corpus.distance(h, hsh) <= self.num_bits]
+        metrics.incr('candidates', len(candidates), table_num)
+        metrics.incr('matches', len(results), table_num)
+        return results
+
+    def ensure_schema(self):
+        '''Create the tables, indexes and so on that this client needs, if
+        they don't already exist. Backends that need this do it once per
+        process when the client is created'''
+        pass
+
+    def delete_old(self):
+        '''Delete the data that has fallen out of the retention window, and
+        return the names of the buckets deleted. Backends without a retention
+        window (or that expire data by themselves) have nothing to delete'''
+        return []
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
+        raise NotImplementedError
+
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the (unfiltered) candidates in the range of this
+        particular table. Backends that can't scan a single table (like the
+        in-memory one) leave this unimplemented'''
+        raise NotImplementedError
+
+    def scan_partition(self, low, high):
+        '''Return the hashes whose permuted value in the first table is in
+        [low, high], for `export`. Each hash must be returned by exactly one
+        of a set of partitions that cover the space'''
+        return self.scan_table(None, 0, [(low, high)])
+
+    def describe_scan(self, table_num, ranges):
+        '''Return a list of the backend commands that `scan_table` would
+        issue for this table'''
+        return []
+
+    def explain(self, hsh, poor_fit_ratio=50, min_candidates=100):
+        '''Run a single query, returning a report of how it was planned and
+        executed: the permuted range for each table, the backend commands
+        issued, candidate and match counts, and time spent in each step.
+        Tables that scan at least `min_candidates` candidates and more than
+        `poor_fit_ratio` candidates per match are flagged as a poor fit for
+        the block configuration'''
+        start = time.time()
+        ranges = self.ranges(hsh)
+        report = {
+            'hash': hsh,
+            'num_blocks': self.num_blocks,
+            'num_bits': self.num_bits,
+            'num_tables': self.num_tables,
+            'ranges_time': time.time() - start,
+            'tables': [],
+            'poor_fit_tables': []
+        }
+
+        matches = set()
+        candidates = 0
+        for i in range(self.num_tables):
+            step = {
+                'table': i,
+                'range': ranges[i],
+                'commands': self.describe_scan(i, ranges)
+            }
+            scan_start = time.time()
+            try:
+                found = self.scan_table(hsh, i, ranges)
+            except NotImplementedError:
+                found = None
+            step['scan_time'] = time.time() - scan_start
+
+            if found is None:
+                step['candidates'] = None
+                step['matches'] = None
+                step['filter_time'] = 0.0
+                step['poor_fit'] = False
+            else:
+                filter_start = time.time()
+                filtered = self.filter_candidates(hsh, found, i)
+                step['filter_time'] = time.time() - filter_start
+                step['candidates'] = len(found)
+                step['matches'] = len(filtered)
+                step['poor_fit'] = (
+                    len(found) >= min_candidates and
+                    len(found) > poor_fit_ratio * max(len(filtered), 1))
+                candidates += len(found)
+                matches.update(filtered)
+                if step['poor_fit']:
+                    report['poor_fit_tables'].append(i)
+            report['tables'].append(step)
+
+        if report['tables'] and report['tables'][0]['candidates'] is None:
+            # Without per-table scans, fall back on the regular query
+            report['candidates'] = None
+            report['matches'] = sorted(self.find_all(hsh))
+        else:
+            report['candidates'] = candidates
+            report['matches'] = sorted(matches)
+        report['time'] = time.time() - start
+        return report
+
     def insert(self, hash_or_hashes):
         '''Insert one (or many) hashes into the database'''
         pass
@@ -51,9 +227,139 @@ class BaseClient(object):
         '''Find all near-duplicates for the provided query (or queries)'''
         pass
 
+    def find_one_columnar(self, hashes, missing=0):
+        '''Like `find_one` for a batch of queries, but return a uint64 array
+        with `missing` where there's no match (see `simhash_db.columnar`).
+        Backends that can fill it directly override this'''
+        from .columnar import first_matches
+        return first_matches(self.find_one(list(hashes)), missing)
+
+    def find_all_columnar(self, hashes):
+        '''Like `find_all` for a batch of queries, but return the matches as
+        a `simhash_db.columnar.Matches`. Backends that can fill it directly
+        override this'''
+        from .columnar import Matches
+        return Matches.from_lists(self.find_all(list(hashes)))
+
+    def probe(self, function, items):
+        '''Call `function` on each of `items` concurrently, yielding results
+        as they complete (not in the order of `items`). Probes that haven't
+        started are cancelled when the generator is closed early'''
+        items = list(items)
+        if len(items) <= 1 or self.probe_workers <= 1:
+            for item in items:
+                yield function(item)
+            return
+
+        if self.probe_executor is None:
+            self.probe_executor = runtimes.executor(
+                self.runtime, self.probe_workers)
+        futures = [self.probe_executor.submit(function, item)
+                   for item in items]
+        try:
+            for future in runtimes.as_completed(self.runtime, futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def stream(self, method, iterable, batch_size=None, in_flight=None):
+        '''Call `method` on batches pulled from `iterable`, keeping up to
+        `in_flight` batches outstanding, and yield each batch's result in the
+        order of the input'''
+        batch_size = batch_size or self.stream_batch_size
+        in_flight = in_flight or self.stream_in_flight
+        if in_flight <= 1:
+            for batch in batches(iterable, batch_size):
+                yield method(batch)
+            return
+
+        with runtimes.executor(self.runtime, in_flight) as executor:
+            pending = deque()
+            for batch in batches(iterable, batch_size):
+                pending.append(executor.submit(method, batch))
+                if len(pending) >= in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def insert_stream(self, iterable, batch_size=None, in_flight=None):
+        '''Insert all the hashes from an iterable (like a generator) in
+        batches, returning how many were inserted'''
+        def insert(batch):
+            self.insert(batch)
+            return len(batch)
+
+        return sum(self.stream(insert, iterable, batch_size, in_flight))
+
+    def export(self, path, partitions=None, compress=True, delta=True):
+        '''Export all the hashes to a file (see `simhash_db.export`),
+        returning how many were written'''
+        from .export import export
+        return export(self, path, partitions, compress, delta)
+
+    def import_(self, path, batch_size=None, in_flight=None):
+        '''Insert all the hashes from an exported file, returning how many
+        were inserted'''
+        from .export import import_
+        return import_(self, path, batch_size, in_flight)
+
+    def find_one_iter(self, iterable, batch_size=None, in_flight=None):
+        '''Like `find_one`, but for an iterable of queries, yielding each
+        query's result in order'''
+        for results in self.stream(
+                self.find_one, iterable, batch_size, in_flight):
+            for result in results:
+                yield result
+
+    def find_all_iter(self, iterable, batch_size=None, in_flight=None):
+        '''Like `find_all`, but for an iterable of queries, yielding each
+        query's results in order'''
+        for results in self.stream(
+                self.find_all, iterable, batch_size, in_flight):
+            for result in results:
+                yield result
+
+
+def batches(iterable, size):
+    '''Yield lists of up to `size` items from the provided iterable'''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def unsigned_to_signed(integer):
+    '''Convert an unsigned integer into a signed integer with the same bits,
+    for backends that only store signed 64-bit integers'''
+    return struct.unpack('!q', struct.pack('!Q', integer))[0]
+
+
+def signed_to_unsigned(integer):
+    '''Convert a signed integer back into the unsigned integer with the same
+    bits'''
+    return struct.unpack('!Q', struct.pack('!q', integer))[0]
+
 
 def Client(backend, name, num_blocks, num_bits, *args, **kwargs):
-    '''A factory to return the appropriate client'''
+    '''A factory to return the appropriate client. With `runtime='gevent'`
+    the process is monkey-patched before the client connects, and with
+    `runtime='asyncio'` the client is wrapped so its methods are awaitable'''
+    metrics = kwargs.pop('metrics', None)
+    runtime = kwargs.pop('runtime', 'threads')
+    runtimes.setup(runtime)
+    client = _make_client(backend, name, num_blocks, num_bits,
+                          *args, **kwargs).instrument(metrics)
+    if runtime == 'asyncio':
+        return runtimes.AsyncClient(client)
+    client.runtime = runtime
+    return client
+
+
+def _make_client(backend, name, num_blocks, num_bits, *args, **kwargs):
+    '''Construct the client for the provided backend'''
     # Import the appropriate module
     if backend == 'cassandra':
         from .cassandra_client import Client as CassClient
@@ -76,5 +382,14 @@ def Client(backend, name, num_blocks, num_bits, *args, **kwargs):
     elif backend == 'es':
         from .elasticsearch_client import Client as ElasticsearchClient
         return ElasticsearchClient(name, num_blocks, num_bits, *args, **kwargs)
+    elif backend == 'sqlite':
+        from .sqlite_client import Client as SqliteClient
+        return SqliteClient(name, num_blocks, num_bits, *args, **kwargs)
+    elif backend == 'tiered':
+        from .tiered_client import Client as TieredClient
+        return TieredClient(name, num_blocks, num_bits, *args, **kwargs)
+    elif backend == 'remote':
+        from .remote_client import Client as RemoteClient
+        return RemoteClient(name, num_blocks, num_bits, *args, **kwargs)
     else:
         raise BackendUnsupported('The %s backend is not supported' % backend)
@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+
+'''Model the cost of each (num_blocks, num_bits) configuration against a
+sample of an existing corpus, and recommend the cheapest one that meets a
+recall target.
+
+For each configuration, the table layout is the one `simhash.Corpus` builds.
+A query's candidates in a table are the stored hashes that share its permuted
+prefix (the bits under the table's `search_mask`), so the sample is bucketed by
+prefix in each table to estimate candidates per query at full corpus size.
+Recall is the fraction of near-duplicates at the target distance that share a
+prefix with the query in at least one table, estimated by flipping random bits
+(permutations are linear over xor, so only the flipped bits matter).'''
+
+import math
+import random
+import simhash
+
+
+def read_hash_file(path):
+    '''Yield the hashes in a file with one hash per line, in decimal or in
+    hexadecimal with a 0x prefix'''
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield int(line, 0)
+
+
+def sample_hashes(source, count, seed=None):
+    '''Reservoir-sample up to `count` hashes from a client (anything with
+    `iter_hashes`), a path to a hash file, or any iterable of hashes. Returns
+    the sample and the total number of hashes seen'''
+    if hasattr(source, 'iter_hashes'):
+        source = source.iter_hashes()
+    elif isinstance(source, str):
+        source = read_hash_file(source)
+
+    rand = random.Random(seed)
+    sample = []
+    seen = 0
+    for hsh in source:
+        seen += 1
+        if len(sample) < count:
+            sample.append(hsh)
+        else:
+            index = rand.randint(0, seen - 1)
+            if index < count:
+                sample[index] = hsh
+    return sample, seen
+
+
+def num_tables(num_blocks, num_bits):
+    '''The number of tables `simhash.Corpus` builds for this configuration'''
+    return int(round(
+        math.factorial(num_blocks) / (
+            math.factorial(num_bits) *
+            math.factorial(num_blocks - num_bits))))
+
+
+def configurations(max_blocks=16, max_tables=200, min_bits=0):
+    '''All the valid (num_blocks, num_bits) pairs within the limits'''
+    for blocks in range(2, max_blocks + 1):
+        for bits in range(min_bits, blocks):
+            if num_tables(blocks, bits) <= max_tables:
+                yield blocks, bits
+
+
+def recall(corpus, distance, trials=2000, seed=0):
+    '''Estimate the fraction of hashes `distance` bits away from a query that
+    share a prefix with it in at least one of the corpus' tables'''
+    if distance == 0:
+        return 1.0
+    rand = random.Random(seed)
+    found = 0
+    for _ in range(trials):
+        flipped = 0
+        for bit in rand.sample(range(64), distance):
+            flipped |= (1 << bit)
+        for table in corpus.tables:
+            if not table.permute(flipped) & table.search_mask:
+                found += 1
+                break
+    return float(found) / trials
+
+
+def model(sample, num_blocks, num_bits, corpus_size=None, distance=None,
+          bytes_per_entry=16, trials=2000):
+    '''Model a single configuration against the provided sample. The
+    estimates are scaled to `corpus_size` hashes (the sample size by
+    default), and recall is measured at `distance` bits (`num_bits` by
+    default)'''
+    corpus = simhash.Corpus(num_blocks, num_bits)
+    tables = len(corpus.tables)
+    size = corpus_size or len(sample)
+    distance = num_bits if distance is None else distance
+
+    # For each query in the sample, how many other hashes share its prefix
+    candidates = 0
+    for table in corpus.tables:
+        counts = {}
+        prefixes = [table.permute(h) & table.search_mask for h in sample]
+        for prefix in prefixes:
+            counts[prefix] = counts.get(prefix, 0) + 1
+        candidates += sum(counts[p] - 1 for p in prefixes)
+
+    if len(sample) > 1:
+        scale = float(size - 1) / (len(sample) - 1)
+        per_query = scale * candidates / len(sample)
+    else:
+        per_query = 0.0
+
+    return {
+        'num_blocks': num_blocks,
+        'num_bits': num_bits,
+        'num_tables': tables,
+        'round_trips': tables,
+        'candidates_per_query': per_query,
+        'bytes_per_hash': tables * bytes_per_entry,
+        'storage_bytes': tables * bytes_per_entry * size,
+        'recall': recall(corpus, distance, trials),
+        'distance': distance
+    }
+
+
+def cost(result, round_trip_cost=1.0, candidate_cost=0.001, write_cost=0.1):
+    '''The relative cost of a configuration: per-query round trips and
+    candidates transferred, plus the write amplification of inserting into
+    every table'''
+    return (round_trip_cost * result['round_trips'] +
+            candidate_cost * result['candidates_per_query'] +
+            write_cost * result['num_tables'])
+
+
+def advise(sample, distance, target_recall=1.0, corpus_size=None,
+           max_blocks=16, max_tables=200, bytes_per_entry=16, trials=2000,
+           **weights):
+    '''Model every valid configuration and return them sorted from cheapest
+    to most expensive, those meeting `target_recall` first. The first result
+    is the recommendation'''
+    results = []
+    for blocks, bits in configurations(max_blocks, max_tables):
+        result = model(sample, blocks, bits, corpus_size, distance,
+                       bytes_per_entry, trials)
+        result['cost'] = cost(result, **weights)
+        result['meets_recall'] = result['recall'] >= target_recall
+        results.append(result)
+    results.sort(key=lambda r: (not r['meets_recall'], r['cost']))
+    return results
@@ -1,145 +1,263 @@
 #! /usr/bin/env python
 
-'''Our Cassandra client'''
-
-# For the time being, this has not been cleaned up into a real client. This is
-# actually just a place for our old benchmarking code to live until we need to
-# turn this into a real client
-
-# #! /usr/bin/python2.7
-
-# import os
-# import time
-# import psutil
-# import random
-# import struct
-# import argparse
-
-# from pycassa.pool import MaximumRetryException
-
-# parser = argparse.ArgumentParser(description='Run benchmarks on Cassandra')
-# parser.add_argument('count', type=int,
-#     help='How many thousands of keys should be inserted per process')
-
-# args = parser.parse_args()
-
-# #########################################################
-# # Generate all the seeds
-# #########################################################
-# # This is how many child processes we'll fork off
-# count = 2 * psutil.NUM_CPUS
-
-# # This is the configuration we'll use for insertions
-# seeds = []
-
-# def make_seeds():
-#     return [(
-#         random.randint(0, 2 ** 64),
-#         random.randint(1, 1000)
-#     ) for i in range(args.count)]
-
-# for i in range(count):
-#     seeds.append(make_seeds())
-
-
-# #########################################################
-# # Child process methods
-# #########################################################
-# def get_cf():
-#     print '    Initializing connection...'
-#     from pycassa import ColumnFamily
-#     from pycassa.pool import ConnectionPool
-#     pool = ConnectionPool('simhash', [
-#         '10.6.165.53:9160',
-#         '10.68.138.8:9160',
-#         '10.50.210.63:9160',
-#         '10.193.218.111:9160'])
-#     col = ColumnFamily(pool, 'hashes')
-#     print '    Completed connection'
-#     return col
-
-# def insert(i):
-#     col = get_cf()
-#     for start, interval in seeds[i]:
-#         end = start + (interval * 1000)
-#         try:
-#             col.batch_insert(dict((struct.pack('!Q', j), {'p': ''})
-#                 for j in range(start, end, interval)))
-#         except MaximumRetryException:
-#             pass
-
-#     print '    Done with insertions'
-#     exit(0)
-
-# def read(i):
-#     col = get_cf()
-#     for start, interval in seeds[i]:
-#         end = start + (interval * 100)
-#         try:
-#             existing = [o for o in col.get_range(
-#                 struct.pack('!Q', start), struct.pack('!Q', end))]
-#         except MaximumRetryException:
-#             pass
-    
-#     print '    Done with reads'
-#     exit(0)
-
-# #########################################################
-# # Time the insertion process
-# #########################################################
-# # Now we'll fork off each of the child processes
-# start = -time.time()
-# insertions = []
-# for i in range(count):
-#     pid = os.fork()
-#     if pid == 0:
-#         insert(i)
-#     else:
-#         print '    Started %i' % pid
-
-# # Now we just wait for all of our child processes to finish up
-# for i in range(count):
-#     pid, statues = os.wait()
-#     s = start + time.time()
-#     insertions.append(s)
-#     print '%i finished in %fs' % (pid, s)
-
-
-# #########################################################
-# # Time the scan process
-# #########################################################
-# # Now we'll fork off each of the child processes to test reading
-# start = -time.time()
-# for i in range(count):
-#     pid = os.fork()
-#     if pid == 0:
-#         insert(i)
-#     else:
-#         print '    Started %i' % pid
-
-# # Now we just wait for all of our child processes to finish up
-# reads = []
-# for i in range(count):
-#     pid, statues = os.wait()
-#     s = start + time.time()
-#     reads.append(s)
-#     print '%i finished in %fs' % (pid, s)    
-
-# #########################################################
-# # Print summary information
-# #########################################################
-# count = 1000 * args.count
-# print 'Insertion:'
-# print '    Times (min / avg / max): %fs / %fs / %fs' % (
-#     min(insertions), sum(insertions) / len(insertions), max(insertions))
-# print '    Rate  (min / avg / max): %fs / %fs / %fs' % (
-#     count / max(insertions), count * len(insertions) / sum(insertions),
-#     count / min(insertions))
-
-
-# print 'Reads:'
-# print '    Times (min / avg / max): %fs / %fs / %fs' % (
-#     min(reads), sum(reads) / len(reads), max(reads))
-# print '    Rate  (min / avg / max): %fs / %fs / %fs' % (
-#     count / max(reads), count * len(reads) / sum(reads),
-#     count / min(reads))
\ No newline at end of file
+'''Our code to connect to the Cassandra backend. It uses the DataStax
+`cassandra-driver` package.
+
+There's a table per permutation. Its partition key is the permuted value
+with the search mask applied, and rows are clustered on the permuted value.
+A range query for a table then only ever reads a slice of one partition.'''
+
+import re
+from cassandra.cluster import Cluster
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import BatchStatement, BatchType
+from . import (
+    BaseClient, batches, signed_to_unsigned, unsigned_to_signed)
+from .pool import connections
+
+
+def connect(*args, **kwargs):
+    '''Connect to the cluster, routing each statement to a replica that
+    owns its partition'''
+    kwargs.setdefault('load_balancing_policy',
+                      TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    return Cluster(*args, **kwargs).connect()
+
+
+class Client(BaseClient):
+    '''Our Cassandra backend client'''
+    # Statements in an unlogged batch that all belong to one partition
+    max_batch = 100
+    # Range queries in flight at once
+    max_in_flight = 1000
+    # Exports read token ranges of the first table concurrently
+    export_partitions = 8
+
+    def __init__(self, name, num_blocks, num_bits, *args, **kwargs):
+        BaseClient.__init__(self, name, num_blocks, num_bits)
+        if not re.match(r'^\w+$', name):
+            raise ValueError('Cassandra table names may only contain '
+                             'letters, digits and underscores')
+        self.keyspace = kwargs.pop('keyspace', 'simhash')
+        self.replication = kwargs.pop('replication', {
+            'class': 'SimpleStrategy', 'replication_factor': 1})
+        ensure_schema = kwargs.pop('ensure_schema', True)
+
+        # An existing session (or stand-in) may be provided; otherwise
+        # clients with the same configuration share a session
+        self.session = kwargs.pop('session', None)
+        self.connection_key = connections.key('cassandra', args, kwargs)
+        if self.session is None:
+            self.session = connections.get(
+                self.connection_key, lambda: connect(*args, **kwargs))
+        else:
+            self.connection_key = ('cassandra', id(self.session))
+        self.statements = None
+
+        if ensure_schema:
+            self.ensure_schema()
+
+    def table_name(self, table_num):
+        '''The fully-qualified name of the table for this permutation'''
+        return '%s.%s_%s' % (self.keyspace, self.name, table_num)
+
+    def create_tables(self):
+        '''Create the keyspace and tables (if they exist it's ok)'''
+        self.session.execute(
+            'CREATE KEYSPACE IF NOT EXISTS %s WITH replication = %r' % (
+                self.keyspace, self.replication))
+        for i in range(self.num_tables):
+            self.session.execute(
+                'CREATE TABLE IF NOT EXISTS %s ('
+                'prefix bigint, permuted bigint, '
+                'PRIMARY KEY ((prefix), permuted))' % self.table_name(i))
+
+    def ensure_schema(self):
+        '''Create the keyspace and tables, once per process'''
+        connections.once((self.connection_key, 'tables', self.name),
+                         self.create_tables)
+
+    def prepared(self):
+        '''The prepared insert and select statements for each table'''
+        if self.statements is None:
+            self.ensure_schema()
+            self.statements = [(
+                self.session.prepare(
+                    'INSERT INTO %s (prefix, permuted) VALUES (?, ?)' %
+                    self.table_name(i)),
+                self.session.prepare(
+                    'SELECT permuted FROM %s WHERE prefix = ? '
+                    'AND permuted >= ? AND permuted <= ?' %
+                    self.table_name(i))
+            ) for i in range(self.num_tables)]
+        return self.statements
+
+    def delete(self):
+        '''Delete this database of simhashes'''
+        for i in range(self.num_tables):
+            self.session.execute('DROP TABLE IF EXISTS %s' %
+                                 self.table_name(i))
+        connections.forget((self.connection_key, 'tables', self.name))
+        self.statements = None
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
+        for row in self.session.execute(
+                'SELECT permuted FROM %s' % self.table_name(0)):
+            yield self.corpus.tables[0].unpermute(
+                signed_to_unsigned(row.permuted))
+
+    def insert(self, hash_or_hashes):
+        '''Insert one (or many) hashes into the database. The rows for each
+        partition are written in unlogged batches, all in flight at once'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+
+        statements = self.prepared()
+        partitions = {}
+        for i in range(self.num_tables):
+            table = self.corpus.tables[i]
+            for hsh in hashes:
+                permuted = table.permute(hsh)
+                prefix = unsigned_to_signed(permuted & table.search_mask)
+                partitions.setdefault((i, prefix), []).append(
+                    unsigned_to_signed(permuted))
+
+        with self.metrics.timer('insert'):
+            futures = []
+            for (i, prefix), values in partitions.items():
+                for start in range(0, len(values), self.max_batch):
+                    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                    for value in values[start:start + self.max_batch]:
+                        batch.add(statements[i][0], (prefix, value))
+                    futures.append(self.session.execute_async(batch))
+            for future in futures:
+                future.result()
+        self.metrics.incr('round_trips', len(futures))
+        self.metrics.incr('inserts', len(hashes))
+        self.metrics.incr('bytes', 16 * len(hashes) * self.num_tables)
+
+    def range_query(self, table_num, ranges):
+        '''The parameters of the range query for this particular table. The
+        low end of the range is the permuted query with the search mask
+        applied, which is also the partition key'''
+        low, high = ranges[table_num]
+        return (unsigned_to_signed(low), unsigned_to_signed(low),
+                unsigned_to_signed(high))
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        return ['SELECT permuted FROM %s WHERE prefix = %s AND permuted >= %s '
+                'AND permuted <= %s' % ((self.table_name(table_num),) +
+                                        self.range_query(table_num, ranges))]
+
+    def scan_async(self, table_num, ranges):
+        '''Start the range query for this particular table'''
+        return self.session.execute_async(
+            self.prepared()[table_num][1],
+            self.range_query(table_num, ranges))
+
+    def candidates(self, table_num, rows):
+        '''Unpermute the rows returned by a range query'''
+        table = self.corpus.tables[table_num]
+        results = [table.unpermute(signed_to_unsigned(row.permuted))
+                   for row in rows]
+        self.metrics.incr('bytes', 8 * len(results), table_num)
+        return results
+
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the candidates in range in this particular table'''
+        with self.metrics.timer('find_in_table', table_num):
+            rows = self.scan_async(table_num, ranges).result()
+            results = self.candidates(table_num, rows)
+        self.metrics.incr('round_trips', 1, table_num)
+        return results
+
+    def scan_partition(self, low, high):
+        '''Return the hashes in a range of partition key tokens of the first
+        table. The unsigned ranges `export` uses don't cross the sign bit,
+        so they map onto contiguous ranges of the (signed) tokens'''
+        rows = self.session.execute(
+            'SELECT permuted FROM %s WHERE token(prefix) >= %%s AND '
+            'token(prefix) <= %%s' % self.table_name(0),
+            (unsigned_to_signed(low), unsigned_to_signed(high)))
+        table = self.corpus.tables[0]
+        return [table.unpermute(signed_to_unsigned(row.permuted))
+                for row in rows]
+
+    def find_in_table(self, hsh, table_num, ranges):
+        '''Return all the results found in this particular table'''
+        return self.filter_candidates(
+            hsh, self.scan_table(hsh, table_num, ranges), table_num)
+
+    def find_tables(self, hashes):
+        '''Run the range queries of every table for every hash concurrently
+        (up to `max_in_flight` at once), and return the matches for each
+        hash, table by table'''
+        results = []
+        for batch in batches(hashes,
+                             max(1, self.max_in_flight // self.num_tables)):
+            with self.metrics.timer('find_in_table'):
+                queries = []
+                for hsh in batch:
+                    ranges = self.ranges(hsh)
+                    queries.append([self.scan_async(i, ranges)
+                                    for i in range(self.num_tables)])
+                for hsh, futures in zip(batch, queries):
+                    results.append([
+                        self.filter_candidates(
+                            hsh, self.candidates(i, future.result()), i)
+                        for i, future in enumerate(futures)])
+        self.metrics.incr('round_trips', len(hashes) * self.num_tables)
+        return results
+
+    def find_one(self, hash_or_hashes):
+        '''Find one near-duplicate for the provided query (or queries). The
+        tables are searched in turn, each with the range queries of the
+        whole batch running concurrently (up to `max_in_flight` at once), and
+        only the hashes without a match so far are queried in the next'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+
+        hashes = list(hashes)
+        ranges = [self.ranges(hsh) for hsh in hashes]
+        results = [None] * len(hashes)
+        remaining = list(range(len(hashes)))
+        for i in range(self.num_tables):
+            if not remaining:
+                break
+            missing = []
+            for batch in batches(remaining, self.max_in_flight):
+                with self.metrics.timer('find_in_table', i):
+                    futures = [self.scan_async(i, ranges[index])
+                               for index in batch]
+                    for index, future in zip(batch, futures):
+                        found = self.filter_candidates(
+                            hashes[index], self.candidates(
+                                i, future.result()), i)
+                        if found:
+                            results[index] = found[0]
+                        else:
+                            missing.append(index)
+                self.metrics.incr('round_trips', len(batch), i)
+            remaining = missing
+
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return results[0]
+        return results
+
+    def find_all(self, hash_or_hashes):
+        '''Find all near-duplicates for the provided query (or queries)'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+
+        results = []
+        for tables in self.find_tables(list(hashes)):
+            results.append(list(set(f for table in tables for f in table)))
+
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return results[0]
+        return results
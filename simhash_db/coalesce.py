@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+
+'''Coalesce concurrent single-hash calls into batched calls. Many threads
+calling `find_one(hsh)` each pay the full per-table round trips; wrapping the
+client in a `Coalescer` instead collects the calls made within a short window
+and sends them to the client as one batch, handing each caller its own
+result.'''
+
+import time
+import threading
+from concurrent.futures import Future
+
+
+class Coalescer(object):
+    '''A thread-safe wrapper around any client. Single-hash calls to
+    `insert`, `find_one` and `find_all` are held for up to `max_delay`
+    seconds (or until `max_batch` of them are waiting) and then dispatched
+    together. Calls with a list of hashes are queued the same way, and are
+    sent in the same batch as the single-hash calls around them.
+
+    All calls to the wrapped client are made from one dispatcher thread, so
+    this is also safe for clients that can't be shared between threads'''
+    operations = ('insert', 'find_one', 'find_all')
+
+    def __init__(self, client, max_delay=0.0005, max_batch=256):
+        self.client = client
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        self.pending = dict((op, []) for op in self.operations)
+        self.count = 0
+        self.oldest = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def insert(self, hash_or_hashes):
+        '''Insert one (or many) hashes into the database'''
+        return self.call('insert', hash_or_hashes)
+
+    def find_one(self, hash_or_hashes):
+        '''Find one near-duplicate for the provided query (or queries)'''
+        return self.call('find_one', hash_or_hashes)
+
+    def find_all(self, hash_or_hashes):
+        '''Find all near-duplicates for the provided query (or queries)'''
+        return self.call('find_all', hash_or_hashes)
+
+    def call(self, op, hash_or_hashes):
+        '''Queue up a call and wait for its result'''
+        future = Future()
+        if hasattr(hash_or_hashes, '__iter__'):
+            item = (list(hash_or_hashes), future, True)
+            if not item[0]:
+                # Nothing to wait for, and it wouldn't wake the dispatcher
+                return None if op == 'insert' else []
+        else:
+            item = ([hash_or_hashes], future, False)
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Coalescer is closed')
+            self.pending[op].append(item)
+            self.count += len(item[0])
+            if self.oldest is None:
+                self.oldest = time.time()
+            self.condition.notify()
+        return future.result()
+
+    def close(self):
+        '''Dispatch anything outstanding and stop the dispatcher'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        '''Wait for calls to collect and dispatch them in batches'''
+        while True:
+            with self.condition:
+                while not self.count and not self.closed:
+                    self.condition.wait()
+                if not self.count and self.closed:
+                    return
+                while self.count < self.max_batch and not self.closed:
+                    remaining = self.oldest + self.max_delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                pending = self.pending
+                self.pending = dict((op, []) for op in self.operations)
+                self.count = 0
+                self.oldest = None
+
+            for op in self.operations:
+                if pending[op]:
+                    self.dispatch(op, pending[op])
+
+    def dispatch(self, op, items):
+        '''Make one call to the client for all of the items, and hand each
+        caller its share of the results'''
+        hashes = []
+        for batch, _, _ in items:
+            hashes.extend(batch)
+        try:
+            results = getattr(self.client, op)(hashes)
+        except Exception as exc:
+            for _, future, _ in items:
+                future.set_exception(exc)
+            return
+
+        if not isinstance(results, list) or len(results) != len(hashes):
+            # Like insert, which doesn't return per-hash results
+            for _, future, _ in items:
+                future.set_result(results)
+            return
+
+        offset = 0
+        for batch, future, many in items:
+            share = results[offset:offset + len(batch)]
+            offset += len(batch)
+            future.set_result(share if many else share[0])
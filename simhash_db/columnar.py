@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+'''Columnar results for batches of queries. Rather than a list of lists of
+ints, the matches of a batch of `find_all` queries are kept CSR-style: one
+flat array of uint64 matches, and an array of offsets into it. The matches
+of query `i` are `values[offsets[i]:offsets[i + 1]]`. The results of a batch
+of `find_one` queries are a single uint64 array, with a sentinel value (by
+default 0) where there is no match.'''
+
+from array import array
+
+
+class Matches(object):
+    '''The matches of a batch of queries, in CSR form'''
+    def __init__(self, values=None, offsets=None):
+        self.values = values if values is not None else array('Q')
+        self.offsets = offsets if offsets is not None else array('Q', [0])
+
+    @classmethod
+    def from_lists(cls, results):
+        '''Build the columnar form of `find_all` results'''
+        matches = cls()
+        for found in results:
+            matches.append(found)
+        return matches
+
+    def append(self, found):
+        '''Add the matches of the next query'''
+        if found:
+            self.values.extend(found)
+        self.offsets.append(len(self.values))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def tolist(self):
+        '''The matches as a list of lists, like `find_all` returns'''
+        return [found.tolist() for found in self]
+
+
+def first_matches(results, missing=0):
+    '''Build the columnar form of `find_one` results'''
+    return array('Q', (missing if found is None else found
+                       for found in results))
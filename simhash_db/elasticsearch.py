@@ -1,42 +1,50 @@
+#! /usr/bin/env python
 
-import struct
-from . import BaseClient
+'''Helpers to add simhash index fields to documents that are indexed in
+Elasticsearch by some other means'''
 
-
-def unsigned_to_signed(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!q', struct.pack('!Q', integer))[0]
-
-
-def signed_to_unsigned(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!Q', struct.pack('!q', integer))[0]
+import simhash
+from . import BaseClient, signed_to_unsigned, unsigned_to_signed
 
 
 class SimHashHelper(BaseClient):
-    '''Our ES backend client'''
+    '''Build the same per-table fields that the ES backend client indexes'''
     def __init__(self, num_blocks, num_bits, *args, **kwargs):
         BaseClient.__init__(self, 'noneed', num_blocks, num_bits)
 
     def build_simhash_indexes(self, hsh):
+        '''The index fields for one hash'''
         return dict((
                 str(i),
                 unsigned_to_signed(int(self.corpus.tables[i].permute(hsh)))
             ) for i in range(self.num_tables))
 
-    def get_simhash(self, hashOn):
+    def build_simhash_indexes_bulk(self, hashes):
+        '''The index fields for each of the provided hashes, permuted a
+        table at a time'''
+        permuted = self.permute_bulk(hashes)
+        return [dict(
+            (str(i), unsigned_to_signed(int(permuted[i][j])))
+            for i in range(self.num_tables)) for j in range(len(hashes))]
+
+    def get_simhash(self, doc, hashOn, hashField):
         '''
         Add simhash properties to a document
         Hashing from the field "hashOn" and putting the simhash
         structure in the field "hashField"
         '''
+        return self.get_simhashes([doc], hashOn, hashField)[0]
 
-        hsh = simhash.hash(hashOn)
-
-        # Construct the simhash indexes
-        hshStruct = self.build_simhash_indexes(hsh)
+    def get_simhashes(self, docs, hashOn, hashField, hashes=None):
+        '''Add simhash properties to each of the documents. The hashes of
+        the "hashOn" fields may be provided if they're already computed (see
+        `simhash_db.ingest`)'''
+        if hashes is None:
+            hashes = [simhash.hash(doc[hashOn]) for doc in docs]
 
-        # Insert simhash indexes
-        doc[hashField] = hshStruct
+        # Construct and insert the simhash indexes
+        for doc, hshStruct in zip(
+                docs, self.build_simhash_indexes_bulk(hashes)):
+            doc[hashField] = hshStruct
 
-        return doc
+        return docs
@@ -2,51 +2,74 @@
 
 '''Code to connect to the ElasticSearch backend'''
 
-import struct
+import json
 import time
 from elasticsearch import Elasticsearch
-from . import BaseClient
-
-
-def unsigned_to_signed(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!q', struct.pack('!Q', integer))[0]
-
-
-def signed_to_unsigned(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!Q', struct.pack('!q', integer))[0]
+from elasticsearch.helpers import scan
+from . import (
+    BaseClient, GeneralException, signed_to_unsigned, unsigned_to_signed)
+from .pool import connections
 
 
 def get_es_connection(*args, **kwargs):
-    time.sleep(5)
-    try:
-        print('Establishing connection...')
-        client = Elasticsearch(*args, **kwargs)
-        client.cluster.health(wait_for_status='yellow', request_timeout=10)
-        return client
-    except Exception:
-        print('Connection failed... Trying again.')
-        time.sleep(1)
-        return get_es_connection(*args, **kwargs)
+    '''Connect to the cluster and wait for it to be available. Failed
+    attempts are retried up to `retries` times with exponential backoff,
+    starting at `retry_delay` seconds and capped at `max_retry_delay`'''
+    retries = kwargs.pop('retries', 8)
+    delay = kwargs.pop('retry_delay', 0.05)
+    max_delay = kwargs.pop('max_retry_delay', 5.0)
+    for attempt in range(retries + 1):
+        try:
+            client = Elasticsearch(*args, **kwargs)
+            client.cluster.health(wait_for_status='yellow', request_timeout=10)
+            return client
+        except Exception as exc:
+            if attempt == retries:
+                raise GeneralException(
+                    'Could not connect to Elasticsearch: %r' % exc)
+            time.sleep(min(delay * 2 ** attempt, max_delay))
 
 
 class Client(BaseClient):
     '''Our ES backend client'''
+    # Each document is indexed with its own request
+    stream_batch_size = 100
+    export_partitions = 8
+
     def __init__(self, name, num_blocks, num_bits, *args, **kwargs):
         BaseClient.__init__(self, name, num_blocks, num_bits)
+        ensure_schema = kwargs.pop('ensure_schema', True)
 
-        self.client = get_es_connection(*args, **kwargs)
+        self.connection_key = connections.key('es', args, kwargs)
+        self.client = connections.get(
+            self.connection_key,
+            lambda: get_es_connection(*args, **kwargs),
+            check=lambda client: client.ping())
 
         self.namePrefix = name + '-'
 
         self.name = name
 
-        self.client.indices.create(index=self.name, ignore=400)
+        if ensure_schema:
+            self.ensure_schema()
+
+    def ensure_schema(self):
+        '''Create the index, once per process'''
+        connections.once(
+            (self.connection_key, 'index', self.name),
+            lambda: self.client.indices.create(index=self.name, ignore=400))
 
     def delete(self):
         '''Delete this database of simhashes'''
         self.client.indices.delete(index=self.name, ignore=[400, 404])
+        connections.forget((self.connection_key, 'index', self.name))
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
+        for hit in scan(self.client, index=self.name,
+                        query={'query': {'match_all': {}}}):
+            yield self.corpus.tables[0].unpermute(
+                signed_to_unsigned(int(hit['_source']['0'])))
 
     def insert(self, hash_or_hashes):
         '''Insert one (or many) hashes into the database'''
@@ -62,11 +85,16 @@ class Client(BaseClient):
             ) for i in range(self.num_tables)) for hsh in hashes
         ]
 
-        for doc in docs:
-            self.client.index(index=self.name, doc_type=self.name, body=doc)
+        with self.metrics.timer('insert'):
+            for doc in docs:
+                self.client.index(index=self.name, doc_type=self.name,
+                                  body=doc)
 
-        # Force index to refresh
-        self.client.indices.refresh(index=self.name)
+            # Force index to refresh
+            self.client.indices.refresh(index=self.name)
+        self.metrics.incr('round_trips', len(docs) + 1)
+        self.metrics.incr('inserts', len(docs))
+        self.metrics.incr('bytes', 8 * len(docs) * self.num_tables)
 
     def get_find_in_table_query(self, hsh, table_num, ranges):
         '''Return all the results found in this particular table'''
@@ -98,9 +126,12 @@ class Client(BaseClient):
             }
         }
 
-        esRes = self.client.search(index=self.name, body=esQuery)
+        with self.metrics.timer('find_in_table'):
+            esRes = self.client.search(index=self.name, body=esQuery)
+        self.metrics.incr('round_trips')
 
         results = self.parse_es_result(esRes)
+        self.metrics.incr('bytes', 8 * self.num_tables * len(results))
         return self.filter_result(results, hsh)
 
     def parse_es_result(self, esResults):
@@ -115,24 +146,47 @@ class Client(BaseClient):
         else:
             table_nums = range(self.num_tables)
 
+        # Each table's candidates are filtered (and counted) on their own
         results = []
-        for table_num in table_nums:
-            results.extend([self.corpus.tables[table_num].unpermute(
-                signed_to_unsigned(int(d[str(table_num)]))) for d in initResults])
+        for i in table_nums:
+            results.extend(self.filter_candidates(hsh, [
+                self.corpus.tables[i].unpermute(signed_to_unsigned(
+                    int(d[str(i)]))) for d in initResults], i))
+        return results
 
-        return [h for h in results if
-                self.corpus.distance(h, hsh) <= self.num_bits]
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        return ['GET /%s/_search %s' % (self.name, json.dumps(
+            self.get_find_in_table_query(None, table_num, ranges)))]
 
-    def find_in_table(self, hsh, table_num, ranges):
-        '''Return all the results found in this particular table'''
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the candidates in range in this particular table'''
         esQuery = self.get_find_in_table_query(hsh, table_num, ranges)
-        try:
-            esRes = self.client.search(index=self.name, body=esQuery)
-        except Exception:
-            esRes = None
+        with self.metrics.timer('find_in_table', table_num):
+            try:
+                esRes = self.client.search(index=self.name, body=esQuery)
+            except Exception:
+                esRes = None
+        self.metrics.incr('round_trips', 1, table_num)
         results = self.parse_es_result(esRes)
+        self.metrics.incr('bytes', 8 * self.num_tables * len(results),
+                          table_num)
+        return [self.corpus.tables[table_num].unpermute(
+            signed_to_unsigned(int(d[str(table_num)]))) for d in results]
+
+    def scan_partition(self, low, high):
+        '''Return the hashes whose permuted value in the first table is in
+        [low, high], scrolling through all of them (a search only returns
+        the first page)'''
+        query = self.get_find_in_table_query(None, 0, [(low, high)])
+        return [self.corpus.tables[0].unpermute(
+            signed_to_unsigned(int(hit['_source']['0'])))
+            for hit in scan(self.client, index=self.name, query=query)]
 
-        return self.filter_result(results, hsh, table_num)
+    def find_in_table(self, hsh, table_num, ranges):
+        '''Return all the results found in this particular table'''
+        return self.filter_candidates(
+            hsh, self.scan_table(hsh, table_num, ranges), table_num)
 
     def find_one(self, hash_or_hashes):
         '''Find one near-duplicate for the provided query (or queries)'''
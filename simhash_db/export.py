@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+'''A compact binary format for moving a corpus of simhashes between
+backends. A file is a header followed by frames:
+
+    header: MAGIC (5 bytes), flags (1 byte)
+    frame:  count (uint32), length (uint32), payload (`length` bytes)
+
+The file ends with a frame whose count is 0. Each payload holds `count`
+hashes. They're either big-endian uint64s or, with the DELTA flag, sorted
+and stored as varints of the difference from the previous hash. With the
+ZLIB flag, each payload is compressed.
+
+Only the original hashes are exported, never the permuted tables, so a
+corpus can be imported into a client with any block configuration.'''
+
+import struct
+import zlib
+
+MAGIC = b'SHDB\x01'
+ZLIB = 1
+DELTA = 2
+FRAME = struct.Struct('!II')
+
+
+def encode_varints(hashes):
+    '''Sort the hashes, and encode their deltas as varints'''
+    data = bytearray()
+    previous = 0
+    for hsh in sorted(hashes):
+        delta = hsh - previous
+        previous = hsh
+        while delta >= 0x80:
+            data.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return bytes(data)
+
+
+def decode_varints(data, count):
+    '''Decode `count` hashes from their varint-encoded deltas'''
+    data = bytearray(data)
+    results = []
+    previous = 0
+    offset = 0
+    for _ in range(count):
+        delta = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            delta |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        previous += delta
+        results.append(previous)
+    return results
+
+
+class Writer(object):
+    '''Write hashes to a file object in frames of up to `frame_size`'''
+    def __init__(self, fileobj, compress=True, delta=True, frame_size=65536):
+        self.fileobj = fileobj
+        self.flags = (ZLIB if compress else 0) | (DELTA if delta else 0)
+        self.frame_size = frame_size
+        self.count = 0
+        self.fileobj.write(MAGIC + struct.pack('!B', self.flags))
+
+    def frame(self, hashes):
+        '''Write one frame'''
+        if self.flags & DELTA:
+            payload = encode_varints(hashes)
+        else:
+            payload = struct.pack('!%iQ' % len(hashes), *hashes)
+        if self.flags & ZLIB:
+            payload = zlib.compress(payload)
+        self.fileobj.write(FRAME.pack(len(hashes), len(payload)) + payload)
+        self.count += len(hashes)
+
+    def write(self, hashes):
+        '''Write some hashes, splitting them into frames'''
+        hashes = list(hashes)
+        for start in range(0, len(hashes), self.frame_size):
+            self.frame(hashes[start:start + self.frame_size])
+
+    def close(self):
+        '''Write the final frame. The file object is left open'''
+        self.fileobj.write(FRAME.pack(0, 0))
+
+
+def read(fileobj):
+    '''Yield the hashes in a file object, a frame's worth at a time'''
+    header = fileobj.read(len(MAGIC) + 1)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a simhash_db export')
+    flags = struct.unpack('!B', header[len(MAGIC):])[0]
+    while True:
+        frame = fileobj.read(FRAME.size)
+        if len(frame) < FRAME.size:
+            raise ValueError('Truncated simhash_db export')
+        count, length = FRAME.unpack(frame)
+        if not count:
+            return
+        payload = fileobj.read(length)
+        if len(payload) < length:
+            raise ValueError('Truncated simhash_db export')
+        if flags & ZLIB:
+            payload = zlib.decompress(payload)
+        if flags & DELTA:
+            yield decode_varints(payload, count)
+        else:
+            yield list(struct.unpack('!%iQ' % count, payload))
+
+
+def key_ranges(count):
+    '''Split the space of permuted values into `count` contiguous ranges. The
+    count is rounded up to a power of two (and at least 2), so that no range
+    crosses the sign bit of backends that store signed integers'''
+    bits = max(1, (count - 1).bit_length())
+    size = 2 ** (64 - bits)
+    return [(i * size, (i + 1) * size - 1) for i in range(2 ** bits)]
+
+
+def chunks(client, count=None):
+    '''Yield all of a client's hashes, in chunks. Backends whose
+    `export_partitions` is more than 1 are read with that many concurrent
+    `scan_partition`s of the first table; the rest with `iter_hashes`'''
+    count = count or client.export_partitions
+    if count <= 1:
+        chunk = []
+        for hsh in client.iter_hashes():
+            chunk.append(hsh)
+            if len(chunk) >= 65536:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    for chunk in client.probe(
+            lambda rng: client.scan_partition(*rng), key_ranges(count)):
+        yield chunk
+
+
+def export(client, path, partitions=None, compress=True, delta=True):
+    '''Export all of a client's hashes to `path`, returning how many were
+    written'''
+    with open(path, 'wb') as fout:
+        writer = Writer(fout, compress=compress, delta=delta)
+        for chunk in chunks(client, partitions):
+            writer.write(chunk)
+        writer.close()
+    return writer.count
+
+
+def import_(client, path, batch_size=None, in_flight=None):
+    '''Insert all the hashes in `path` into a client, in batches through
+    `insert_stream`, returning how many were inserted'''
+    with open(path, 'rb') as fin:
+        return client.insert_stream(
+            (hsh for frame in read(fin) for hsh in frame),
+            batch_size, in_flight)
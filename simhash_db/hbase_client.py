@@ -4,13 +4,11 @@
 package, which depends on the Thrift service that (for now) is
 part of HBase.'''
 
-from gevent import monkey
-monkey.patch_all()
-
 import struct
 import happybase
 import happybase.hbase.ttypes
 from . import BaseClient
+from .pool import connections
 
 
 def column_name(integer):
@@ -20,59 +18,125 @@ def column_name(integer):
 
 class Client(BaseClient):
     '''Our HBase backend client'''
+    export_partitions = 8
+
     def __init__(self, name, num_blocks, num_bits, *args, **kwargs):
         BaseClient.__init__(self, name, num_blocks, num_bits)
 
         # Time to live in seconds
-        ttl = kwargs.pop('ttl', None)
-        if ttl is None:
+        self.ttl = kwargs.pop('ttl', None)
+        if self.ttl is None:
             raise ValueError
-
-        self.connection = happybase.Connection(**kwargs)
-        families = {column_name(i): dict(time_to_live=ttl)
+        ensure_schema = kwargs.pop('ensure_schema', True)
+
+        # A happybase connection can't be shared between threads, so
+        # clients with the same configuration share a pool of them
+        pool_size = kwargs.pop('pool_size', 10)
+        self.connection_key = connections.key('hbase', (), kwargs)
+        self.pool = connections.get(
+            self.connection_key,
+            lambda: happybase.ConnectionPool(pool_size, **kwargs))
+        self.deleted = False
+
+        if ensure_schema:
+            self.ensure_schema()
+
+    def create_table(self):
+        '''Create the table (if it exists it's ok)'''
+        families = {column_name(i): dict(time_to_live=self.ttl)
                     for i in range(self.num_tables)}
-        try:
-            self.connection.create_table(name, families)
-        except happybase.hbase.ttypes.AlreadyExists:
-            pass
-        self.table = self.connection.table(name)
+        with self.pool.connection() as connection:
+            try:
+                connection.create_table(self.name, families)
+            except happybase.hbase.ttypes.AlreadyExists:
+                pass
+
+    def ensure_schema(self):
+        '''Create the table, once per process'''
+        connections.once((self.connection_key, 'table', self.name),
+                         self.create_table)
+        self.deleted = False
 
     def delete(self):
         '''Delete this database of simhashes'''
-        if self.table is not None:
-            self.connection.delete_table(self.name, disable=True)
-            self.table = None
+        if not self.deleted:
+            with self.pool.connection() as connection:
+                connection.delete_table(self.name, disable=True)
+            connections.forget((self.connection_key, 'table', self.name))
+            self.deleted = True
+
+    def truncate(self):
+        '''Remove all the hashes, but keep the table. Dropping and recreating
+        the table is much faster than deleting its rows'''
+        if not self.deleted:
+            with self.pool.connection() as connection:
+                connection.delete_table(self.name, disable=True)
+        self.create_table()
+        self.deleted = False
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
+        if self.deleted:
+            return
+        with self.pool.connection() as connection:
+            table = connection.table(self.name)
+            for key, _ in table.scan(columns=[column_name(0)]):
+                yield self.corpus.tables[0].unpermute(
+                    struct.unpack('!Q', key)[0])
 
     def insert(self, hash_or_hashes):
         '''Insert one (or many) hashes into the database'''
-        if self.table is None:
+        if self.deleted:
             return
 
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        for hsh in hashes:
-            for i in range(self.num_tables):
-                row_key = struct.pack('!Q',
-                                      long(self.corpus.tables[i].permute(hsh)))
-                self.table.put(row_key, {column_name(i): None})
+        with self.metrics.timer('insert'), self.pool.connection() as conn:
+            table = conn.table(self.name)
+            for hsh in hashes:
+                for i in range(self.num_tables):
+                    row_key = struct.pack(
+                        '!Q', int(self.corpus.tables[i].permute(hsh)))
+                    table.put(row_key, {column_name(i): None})
+        self.metrics.incr('round_trips', len(hashes) * self.num_tables)
+        self.metrics.incr('inserts', len(hashes))
+        self.metrics.incr('bytes', 8 * len(hashes) * self.num_tables)
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        return ["scan '%s', {STARTROW => %r, STOPROW => %r, COLUMNS => ['%s']}"
+                % (self.name, struct.pack('!Q', ranges[table_num][0]),
+                   struct.pack('!Q', ranges[table_num][1]),
+                   column_name(table_num))]
+
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the candidates in range in this particular table'''
+        low = struct.pack('!Q', ranges[table_num][0])
+        # The stop row isn't included in a scan
+        high = None
+        if ranges[table_num][1] < 2 ** 64 - 1:
+            high = struct.pack('!Q', ranges[table_num][1] + 1)
+        with self.metrics.timer('find_in_table', table_num), \
+                self.pool.connection() as connection:
+            pairs = connection.table(self.name).scan(
+                row_start=low, row_stop=high,
+                columns=[column_name(table_num)])
+            results = [struct.unpack('!Q', k)[0] for k, v in pairs]
+        self.metrics.incr('round_trips', 1, table_num)
+        self.metrics.incr('bytes', 8 * len(results), table_num)
+        return [self.corpus.tables[table_num].unpermute(d)
+                for d in results]
 
     def find_in_table(self, hsh, table_num, ranges):
         '''Return all the results found in this particular table'''
-        low = struct.pack('!Q', ranges[table_num][0])
-        high = struct.pack('!Q', ranges[table_num][1])
-        pairs = self.table.scan(row_start=low, row_stop=high,
-                                columns=[column_name(table_num)])
-        results = [struct.unpack('!Q', k)[0] for k, v in pairs]
-        results = [self.corpus.tables[table_num].unpermute(d)
-                   for d in results]
-        return [h for h in results if
-                self.corpus.distance(h, hsh) <= self.num_bits]
+        return self.filter_candidates(
+            hsh, self.scan_table(hsh, table_num, ranges), table_num)
 
     def find_one(self, hash_or_hashes):
         '''Find one near-duplicate for the provided query (or queries)'''
-        if self.table is None:
+        if self.deleted:
             return None
 
         hashes = hash_or_hashes
@@ -98,7 +162,7 @@ class Client(BaseClient):
 
     def find_all(self, hash_or_hashes):
         '''Find all near-duplicates for the provided query (or queries)'''
-        if self.table is None:
+        if self.deleted:
             return None
 
         hashes = hash_or_hashes
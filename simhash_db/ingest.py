@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+
+'''A pipeline that turns a stream of documents into simhashes and feeds
+them to a client. Shingling and hashing are CPU-bound, so batches of texts
+are hashed in a pool of processes, with a few batches in flight so that the
+client is never left waiting on them:
+
+    pipeline = Pipeline(client, field='text')
+    pipeline.insert(documents)
+    for document, hsh, match in pipeline.dedup(documents):
+        ...
+
+Documents are either texts, or dicts whose `field` holds the text. Only the
+texts are sent to the processes, and results come back in the order of the
+input.'''
+
+import simhash
+from collections import deque
+from . import batches
+
+
+def hash_texts(texts):
+    '''Hash each of the provided texts. This runs in the worker processes'''
+    return [simhash.hash(text) for text in texts]
+
+
+class Pipeline(object):
+    '''Hash documents in `workers` processes (by default, one per core), in
+    batches of `batch_size`, keeping up to `in_flight` batches outstanding
+    (by default, two per worker). With `workers=0`, texts are hashed in this
+    process instead'''
+    def __init__(self, client, field=None, workers=None, batch_size=1000,
+                 in_flight=None):
+        self.client = client
+        self.field = field
+        self.workers = workers
+        self.batch_size = batch_size
+        self.in_flight = in_flight
+
+    def text(self, document):
+        '''The text of a document'''
+        if self.field is None:
+            return document
+        return document[self.field]
+
+    def hashes(self, documents):
+        '''Yield each batch of documents along with their hashes'''
+        if self.workers == 0:
+            for batch in batches(documents, self.batch_size):
+                yield batch, hash_texts([self.text(d) for d in batch])
+            return
+
+        from multiprocessing import cpu_count
+        from concurrent.futures import ProcessPoolExecutor
+        workers = self.workers or cpu_count()
+        in_flight = self.in_flight or 2 * workers
+        with ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for batch in batches(documents, self.batch_size):
+                pending.append((batch, executor.submit(
+                    hash_texts, [self.text(d) for d in batch])))
+                if len(pending) >= in_flight:
+                    batch, future = pending.popleft()
+                    yield batch, future.result()
+            while pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+
+    def fields(self, documents, hash_field='simhash'):
+        '''Yield batches of the documents (which must be dicts) with the
+        per-table index fields of their hashes added as `hash_field`, ready
+        to be indexed in Elasticsearch'''
+        from .elasticsearch import SimHashHelper
+        helper = SimHashHelper(self.client.num_blocks, self.client.num_bits)
+        for batch, hashes in self.hashes(documents):
+            yield helper.get_simhashes(batch, self.field, hash_field, hashes)
+
+    def insert(self, documents):
+        '''Insert the hashes of all the documents, a batch at a time, and
+        return how many were inserted'''
+        count = 0
+        for batch, hashes in self.hashes(documents):
+            self.client.insert(hashes)
+            count += len(hashes)
+        return count
+
+    def dedup(self, documents):
+        '''Yield `(document, hash, match)` for each document, where `match`
+        is a near-duplicate already in the client, or None. The hashes of
+        the documents without a match are inserted. A batch is queried as a
+        whole before it's inserted, so the hashes without a match are also
+        checked against the earlier ones of the same batch, in an in-memory
+        corpus, and a near-duplicate there is the match instead'''
+        for batch, hashes in self.hashes(documents):
+            matches = self.client.find_one(hashes)
+            seen = simhash.Corpus(self.client.num_blocks,
+                                  self.client.num_bits)
+            new = []
+            for i, hsh in enumerate(hashes):
+                if matches[i] is not None:
+                    continue
+                matches[i] = seen.find_first(hsh) or None
+                if matches[i] is None:
+                    seen.insert(hsh)
+                    new.append(hsh)
+            if new:
+                self.client.insert(new)
+            for result in zip(batch, hashes, matches):
+                yield result
@@ -1,31 +1,263 @@
 #! /usr/bin/env python
 
-'''Our code to connect to the Riak backend'''
+'''Our code for the in-memory Judy-trie backend'''
 
+import time
+import random
+import itertools
 import simhash
+from array import array
+from collections import OrderedDict
 from . import BaseClient
+from .columnar import Matches
 
 
 class Client(BaseClient):
-    '''Our in-memory Judy-trie based backend client'''
+    '''Our in-memory Judy-trie based backend client. It can be bounded to
+    `max_entries` hashes, to about `max_memory` bytes, or to hashes inserted
+    in the last `max_age` seconds. Beyond its budget, it evicts either the
+    oldest hashes first (`policy='oldest'`) or a random sample of them
+    (`policy='random'`). Only bounded clients keep track of their hashes for
+    eviction; unbounded ones just keep a compact log of them, for export'''
+    # The corpus isn't safe to share between threads
+    stream_batch_size = 10000
+    stream_in_flight = 1
+    POLICIES = ('oldest', 'random')
+    # Estimates used for memory accounting, since the corpus can't report
+    # its own size. A Judy array takes up to about 16 bytes for each 64-bit
+    # key, tracking a hash for eviction takes about 100 bytes, and logging
+    # it takes 8
+    table_bytes = 16
+    tracking_bytes = 100
+    log_bytes = 8
+    # How many hashes the log holds before it's first deduplicated
+    log_compact_size = 65536
+    # Hashes are evicted on every write. With `max_age`, reads also evict
+    # the expired hashes, but at most once every this many seconds
+    expire_interval = 1.0
+
+    def __init__(self, name, num_blocks, num_bits, max_entries=None,
+                 max_age=None, max_memory=None, policy='oldest'):
+        BaseClient.__init__(self, name, num_blocks, num_bits)
+        if policy not in self.POLICIES:
+            raise ValueError('Unsupported eviction policy %s' % policy)
+        if policy == 'random' and max_age is not None:
+            raise ValueError('max_age needs the oldest eviction policy')
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_memory = max_memory
+        self.policy = policy
+        self.bounded = any(limit is not None for limit in (
+            max_entries, max_age, max_memory))
+        self.last_evicted = 0
+        self.reset_tracking()
+
+    def reset_tracking(self):
+        '''Forget all the hashes. For the 'oldest' policy, they're kept in
+        an ordered map to the time they were inserted; for 'random', in a
+        list with each one's position, so any of them can be removed in
+        constant time'''
+        self.inserted = None
+        self.members = None
+        self.positions = None
+        # The corpus can't list its hashes, so unbounded clients log them in
+        # a uint64 array, deduplicated whenever it doubles in size
+        self.log = None
+        self.compacted = 0
+        if not self.bounded:
+            self.log = array('Q')
+            return
+        if self.policy == 'oldest':
+            self.inserted = OrderedDict()
+        else:
+            self.members = []
+            self.positions = {}
+
     def delete(self):
         '''Delete this database of simhashes'''
         self.corpus = simhash.Corpus(self.num_blocks, self.num_bits)
+        self.reset_tracking()
+
+    def compact(self):
+        '''Sort the log and remove the hashes inserted more than once'''
+        values = sorted(self.log)
+        self.log = array('Q', (value for i, value in enumerate(values)
+                               if not i or value != values[i - 1]))
+        self.compacted = len(self.log)
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database (oldest first
+        with the 'oldest' policy, and in order for unbounded clients)'''
+        if self.inserted is not None:
+            return iter(list(self.inserted))
+        if self.members is not None:
+            return iter(list(self.members))
+        self.compact()
+        return iter(array('Q', self.log))
+
+    def count(self):
+        '''How many hashes are stored. For unbounded clients, the log is
+        deduplicated first'''
+        if self.inserted is not None:
+            return len(self.inserted)
+        if self.members is not None:
+            return len(self.members)
+        self.compact()
+        return len(self.log)
+
+    def bytes_per_hash(self):
+        '''The estimated memory taken by each hash, in all the tables and
+        for tracking it'''
+        tracking = self.tracking_bytes if self.bounded else self.log_bytes
+        return self.table_bytes * self.num_tables + tracking
+
+    def estimated_memory(self):
+        '''An estimate (from `table_bytes`, and `tracking_bytes` or
+        `log_bytes`, not a measurement) of the memory used: the number of
+        hashes, and the bytes taken by each table, by tracking hashes, and in
+        total'''
+        count = self.count()
+        tables = [self.table_bytes * count] * self.num_tables
+        tracking = self.bytes_per_hash() * count - sum(tables)
+        return {
+            'hashes': count,
+            'tables': tables,
+            'tracking': tracking,
+            'total': sum(tables) + tracking
+        }
+
+    def capacity(self):
+        '''How many hashes fit in the budget, or None if there isn't one'''
+        limits = []
+        if self.max_entries is not None:
+            limits.append(self.max_entries)
+        if self.max_memory is not None:
+            limits.append(self.max_memory // self.bytes_per_hash())
+        return min(limits) if limits else None
+
+    def track(self, hashes):
+        '''Keep track of newly inserted hashes'''
+        if self.log is not None:
+            self.log.extend(hashes)
+            if len(self.log) > 2 * max(self.compacted, self.log_compact_size):
+                self.compact()
+            return
+        if self.inserted is not None:
+            now = time.time()
+            for hsh in hashes:
+                # Inserting a hash again makes it the newest
+                self.inserted.pop(hsh, None)
+                self.inserted[hsh] = now
+        elif self.members is not None:
+            for hsh in hashes:
+                if hsh not in self.positions:
+                    self.positions[hsh] = len(self.members)
+                    self.members.append(hsh)
+
+    def untrack(self, hashes):
+        '''Stop tracking evicted hashes'''
+        if self.inserted is not None:
+            for hsh in hashes:
+                del self.inserted[hsh]
+            return
+        for hsh in hashes:
+            # Move the last member into the evicted one's place
+            position = self.positions.pop(hsh)
+            last = self.members.pop()
+            if last != hsh:
+                self.members[position] = last
+                self.positions[last] = position
+
+    def evict(self):
+        '''Remove the hashes older than `max_age`, and then those beyond the
+        budget. A hash is removed from every table at once. Return how many
+        were removed'''
+        if not self.bounded:
+            return 0
+        self.last_evicted = time.time()
+        evicted = []
+        if self.max_age is not None:
+            cutoff = time.time() - self.max_age
+            for hsh, inserted in self.inserted.items():
+                if inserted >= cutoff:
+                    break
+                evicted.append(hsh)
+
+        capacity = self.capacity()
+        excess = 0
+        if capacity is not None:
+            excess = self.count() - len(evicted) - capacity
+        if excess > 0:
+            if self.policy == 'oldest':
+                # The expired hashes are already the oldest ones
+                evicted = list(itertools.islice(
+                    self.inserted, len(evicted) + excess))
+            else:
+                evicted = [self.members[i] for i in random.sample(
+                    range(len(self.members)), excess)]
+
+        if evicted:
+            self.untrack(evicted)
+            self.corpus.remove_bulk(evicted)
+            self.metrics.incr('evictions', len(evicted))
+        return len(evicted)
+
+    def expire(self):
+        '''Before a read, evict the hashes older than `max_age` if it's been
+        `expire_interval` seconds since the last eviction. Without `max_age`
+        only writes can put the client over budget, so reads don't evict'''
+        if self.max_age is None:
+            return 0
+        if time.time() - self.last_evicted < self.expire_interval:
+            return 0
+        return self.evict()
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        return ['in-memory scan of table %s' % table_num]
 
     def insert(self, hash_or_hashes):
         '''Insert one (or many) hashes into the database'''
-        if not hasattr(hash_or_hashes, '__iter__'):
-            return self.corpus.insert(hash_or_hashes)
-        return self.corpus.insert_bulk(hash_or_hashes)
+        with self.metrics.timer('insert'):
+            if not hasattr(hash_or_hashes, '__iter__'):
+                hashes = [hash_or_hashes]
+                result = self.corpus.insert(hash_or_hashes)
+            else:
+                hashes = list(hash_or_hashes)
+                result = self.corpus.insert_bulk(hashes)
+            self.track(hashes)
+            self.evict()
+        return result
 
     def find_one(self, hash_or_hashes):
         '''Find one near-duplicate for the provided query (or queries)'''
-        if not hasattr(hash_or_hashes, '__iter__'):
-            return self.corpus.find_first(hash_or_hashes) or None
-        return [i or None for i in self.corpus.find_first_bulk(hash_or_hashes)]
+        self.expire()
+        with self.metrics.timer('find_one'):
+            if not hasattr(hash_or_hashes, '__iter__'):
+                return self.corpus.find_first(hash_or_hashes) or None
+            return [i or None
+                    for i in self.corpus.find_first_bulk(hash_or_hashes)]
 
     def find_all(self, hash_or_hashes):
         '''Find all near-duplicates for the provided query (or queries)'''
-        if not hasattr(hash_or_hashes, '__iter__'):
-            return self.corpus.find_all(hash_or_hashes) or []
-        return [i or [] for i in self.corpus.find_all_bulk(hash_or_hashes)]
+        self.expire()
+        with self.metrics.timer('find_all'):
+            if not hasattr(hash_or_hashes, '__iter__'):
+                return self.corpus.find_all(hash_or_hashes) or []
+            return [i or [] for i in self.corpus.find_all_bulk(hash_or_hashes)]
+
+    def find_one_columnar(self, hashes, missing=0):
+        '''Like `find_one`, but fill a uint64 array directly'''
+        self.expire()
+        with self.metrics.timer('find_one'):
+            found = self.corpus.find_first_bulk(list(hashes))
+            return array('Q', (i or missing for i in found))
+
+    def find_all_columnar(self, hashes):
+        '''Like `find_all`, but fill a `Matches` directly'''
+        self.expire()
+        matches = Matches()
+        with self.metrics.timer('find_all'):
+            for found in self.corpus.find_all_bulk(list(hashes)):
+                matches.append(found)
+        return matches
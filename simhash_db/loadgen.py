@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+
+'''An open-loop load generator. Unlike `bench.py`, where each process sends
+its next batch as soon as the previous one returns, requests here are sent
+on a Poisson schedule at a target rate regardless of how the backend is
+keeping up. Latency is measured from when each request was scheduled to be
+sent, so time spent queued behind a slow request is counted (this corrects
+for coordinated omission).'''
+
+import time
+import random
+import threading
+from .metrics import summarize
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+
+def batch_sizes(spec):
+    '''Parse a batch size distribution, returning a function of a random
+    number generator. Supported specifications are `fixed:N`,
+    `uniform:LOW:HIGH` and `exponential:MEAN`. A bare number is fixed'''
+    parts = str(spec).split(':')
+    if len(parts) == 1:
+        parts = ['fixed'] + parts
+    kind, params = parts[0], [int(p) for p in parts[1:]]
+    if kind == 'fixed' and len(params) == 1:
+        return lambda rand: params[0]
+    elif kind == 'uniform' and len(params) == 2:
+        return lambda rand: rand.randint(params[0], params[1])
+    elif kind == 'exponential' and len(params) == 1:
+        return lambda rand: max(1, int(round(
+            rand.expovariate(1.0 / params[0]))))
+    raise ValueError('Unsupported batch size distribution %s' % spec)
+
+
+def schedule(rate, duration, rand):
+    '''Poisson arrival times (in seconds from the start) at `rate` per second
+    over `duration` seconds'''
+    times = []
+    now = rand.expovariate(rate)
+    while now < duration:
+        times.append(now)
+        now += rand.expovariate(rate)
+    return times
+
+
+def open_loop(client, rate, duration, op='find_all', sizes='fixed:1',
+              workers=16, read_ratio=None, pool=None, seed=None):
+    '''Drive `client` at `rate` requests per second for `duration` seconds.
+    Each request is a batch whose size is drawn from `sizes`. With a
+    `read_ratio`, requests are a mix of `op` and inserts. Queries are drawn
+    from `pool` (a list of hashes) when provided, and otherwise random.
+    Returns a summary of latencies per operation, achieved throughput and how
+    many requests were still outstanding at the end.
+
+    Requests still unfinished `duration` seconds (at least one) after the
+    last was sent count as outstanding. The workers are then stopped and
+    waited for as long again, so they can't add load to the next run; any
+    still running after that (on a hung request) are reported as `stuck`.
+    Clients that can't be shared between threads (a `stream_in_flight` of
+    1) get one worker'''
+    if getattr(client, 'stream_in_flight', None) == 1:
+        workers = 1
+    rand = random.Random(seed)
+    sizes = batch_sizes(sizes)
+    requests = []
+    for when in schedule(rate, duration, rand):
+        size = sizes(rand)
+        kind = op
+        if read_ratio is not None and rand.random() >= read_ratio:
+            kind = 'insert'
+        if pool and kind != 'insert':
+            hashes = [rand.choice(pool) for _ in range(size)]
+        else:
+            hashes = [rand.randint(0, 2 ** 64 - 1) for _ in range(size)]
+        requests.append((when, kind, hashes))
+
+    pending = queue.Queue()
+    stop = threading.Event()
+    latencies = {}
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        '''Run requests until told to stop'''
+        while not stop.is_set():
+            request = pending.get()
+            if request is None:
+                return
+            scheduled, kind, hashes = request
+            try:
+                getattr(client, kind)(hashes)
+            except Exception as exc:
+                with lock:
+                    errors.append(repr(exc))
+                continue
+            latency = time.time() - scheduled
+            with lock:
+                latencies.setdefault(kind, []).append(latency)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Send each request at its scheduled time, whether or not the workers
+    # have kept up
+    start = time.time()
+    for when, kind, hashes in requests:
+        delay = start + when - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        pending.put((start + when, kind, hashes))
+    for _ in threads:
+        pending.put(None)
+
+    # Give stragglers a bounded amount of time to finish
+    deadline = time.time() + max(duration, 1.0)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    elapsed = time.time() - start
+
+    # Workers that are still running mustn't change what we report
+    with lock:
+        latencies = dict((k, list(v)) for k, v in latencies.items())
+        errors = list(errors)
+    # Drop the requests that haven't started, and wait for those that have
+    stop.set()
+    try:
+        while True:
+            pending.get_nowait()
+    except queue.Empty:
+        pass
+    for _ in threads:
+        pending.put(None)
+    deadline = time.time() + max(duration, 1.0)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    stuck = sum(1 for thread in threads if thread.is_alive())
+
+    completed = sum(len(v) for v in latencies.values())
+    return {
+        'rate': rate,
+        'duration': duration,
+        'sent': len(requests),
+        'completed': completed,
+        'outstanding': len(requests) - completed - len(errors),
+        'errors': len(errors),
+        'stuck': stuck,
+        'throughput': completed / elapsed,
+        'operations': dict(
+            (kind, summarize(values)) for kind, values in latencies.items())
+    }
+
+
+def saturated(result, slo=None, tolerance=0.95):
+    '''Whether a run failed to keep up: it completed fewer requests than
+    `tolerance` of those sent, its p99 latency exceeded `slo` seconds, or
+    it left workers stuck on requests'''
+    if result.get('stuck'):
+        return True
+    if result['completed'] < tolerance * result['sent']:
+        return True
+    if slo is not None:
+        for summary in result['operations'].values():
+            if summary['count'] and summary['p99'] > slo:
+                return True
+    return False
+
+
+def sweep(client, rates, duration, slo=None, **kwargs):
+    '''Run `open_loop` at each of the provided rates in increasing order
+    until the client saturates. Returns all the results and the highest rate
+    that was sustained (None if even the lowest wasn't)'''
+    results = []
+    sustained = None
+    for rate in sorted(rates):
+        result = open_loop(client, rate, duration, **kwargs)
+        result['saturated'] = saturated(result, slo)
+        results.append(result)
+        if result['saturated']:
+            break
+        sustained = rate
+    return results, sustained
@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+
+'''Instrumentation hooks for the clients. Every client carries a `metrics`
+object; by default it's a `NullMetrics` whose methods do nothing, so the cost
+of instrumentation when disabled is a single no-op method call.'''
+
+import bisect
+import socket
+import threading
+import time
+
+
+# Default latency buckets (in seconds) for the histograms
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def percentile(values, pct):
+    '''Return the `pct` percentile (0-100) of a list of values, using the
+    nearest-rank method'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def summarize(values):
+    '''Summarize a list of latencies into count / min / mean / percentiles'''
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'min': min(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values)
+    }
+
+
+class _NullTimer(object):
+    '''A context manager that doesn't time anything'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Timer(object):
+    '''A context manager that reports its elapsed time to a metrics object'''
+    def __init__(self, metrics, name, table):
+        self.metrics = metrics
+        self.name = name
+        self.table = table
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.time() - self.start, self.table)
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class NullMetrics(object):
+    '''Metrics that are discarded. This is what clients use by default'''
+    enabled = False
+
+    def incr(self, name, value=1, table=None):
+        '''Increment the counter `name` (optionally for a given table)'''
+        pass
+
+    def observe(self, name, seconds, table=None):
+        '''Record a latency observation for the phase `name`'''
+        pass
+
+    def timer(self, name, table=None):
+        '''A context manager timing the enclosed block as phase `name`'''
+        return NULL_TIMER
+
+
+class Histogram(object):
+    '''A cumulative latency histogram with fixed buckets'''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        '''Add an observation'''
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        '''Return a list of (upper bound, cumulative count) pairs, ending with
+        the +Inf bucket'''
+        results = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            results.append((bound, total))
+        return results
+
+
+class Registry(NullMetrics):
+    '''Metrics that are kept in memory. Counters and histograms are keyed on
+    (name, table), where table is None for client-wide measurements. Any
+    number of listeners may be attached; each one is called as
+    `listener(kind, name, value, table)` with kind being 'counter' or
+    'timing', which is how the StatsD exporter gets fed.'''
+    enabled = True
+
+    def __init__(self, buckets=BUCKETS, listeners=None):
+        self.buckets = buckets
+        self.listeners = list(listeners or [])
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        '''Add a callback to be notified of every measurement'''
+        self.listeners.append(listener)
+
+    def incr(self, name, value=1, table=None):
+        '''Increment the counter `name` (optionally for a given table)'''
+        key = (name, table)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for listener in self.listeners:
+            listener('counter', name, value, table)
+
+    def observe(self, name, seconds, table=None):
+        '''Record a latency observation for the phase `name`'''
+        key = (name, table)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        for listener in self.listeners:
+            listener('timing', name, seconds, table)
+
+    def timer(self, name, table=None):
+        '''A context manager timing the enclosed block as phase `name`'''
+        return _Timer(self, name, table)
+
+    def counter(self, name, table=None):
+        '''Return the current value of a counter'''
+        return self.counters.get((name, table), 0)
+
+    def total(self, name):
+        '''Return the value of a counter summed across all tables'''
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def reset(self):
+        '''Forget everything that's been recorded'''
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+def prometheus_text(registry, prefix='simhash_db'):
+    '''Render a registry in the Prometheus text exposition format'''
+    lines = []
+    with registry.lock:
+        counters = sorted(registry.counters.items(), key=repr)
+        histograms = sorted(registry.histograms.items(), key=repr)
+
+    def labels(table, extra=''):
+        parts = []
+        if table is not None:
+            parts.append('table="%s"' % table)
+        if extra:
+            parts.append(extra)
+        return ('{%s}' % ','.join(parts)) if parts else ''
+
+    seen = set()
+    for (name, table), value in counters:
+        metric = '%s_%s_total' % (prefix, name)
+        if metric not in seen:
+            lines.append('# TYPE %s counter' % metric)
+            seen.add(metric)
+        lines.append('%s%s %s' % (metric, labels(table), value))
+
+    for (name, table), histogram in histograms:
+        metric = '%s_%s_seconds' % (prefix, name)
+        if metric not in seen:
+            lines.append('# TYPE %s histogram' % metric)
+            seen.add(metric)
+        for bound, count in histogram.cumulative():
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket%s %s' % (
+                metric, labels(table, 'le="%s"' % le), count))
+        lines.append('%s_sum%s %s' % (metric, labels(table), histogram.sum))
+        lines.append('%s_count%s %s' % (
+            metric, labels(table), histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdListener(object):
+    '''A registry listener that forwards every measurement to a StatsD server
+    over UDP. Counters are sent as `c` and timings as `ms`'''
+    def __init__(self, host='localhost', port=8125, prefix='simhash_db'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, kind, name, value, table):
+        if table is not None:
+            name = '%s.table_%s' % (name, table)
+        if kind == 'counter':
+            line = '%s.%s:%s|c' % (self.prefix, name, value)
+        else:
+            line = '%s.%s:%f|ms' % (self.prefix, name, value * 1000.0)
+        try:
+            self.sock.sendto(line.encode('ascii'), self.address)
+        except socket.error:
+            # Metrics must never take the client down
+            pass
@@ -2,101 +2,104 @@
 
 '''Our code to connect to the MongoDB backend'''
 
-from gevent import monkey
-monkey.patch_all()
-
-import struct
 import pymongo
 from pymongo import common
-from . import BaseClient
-import calendar
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import dateutil.parser
+from . import BaseClient, signed_to_unsigned, unsigned_to_signed
+from .pool import connections
+from .retention import Retention
 
 pymongo.common.VALIDATORS['months'] = pymongo.common.validate_positive_integer
 pymongo.common.VALIDATORS['weeks'] = pymongo.common.validate_positive_integer
 
 
-def unsigned_to_signed(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!q', struct.pack('!Q', integer))[0]
-
-
-def signed_to_unsigned(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!Q', struct.pack('!q', integer))[0]
-
-
 class Client(BaseClient):
     '''Our Mongo backend client'''
+    export_partitions = 8
+
     def __init__(self, name, num_blocks, num_bits, *args, **kwargs):
         BaseClient.__init__(self, name, num_blocks, num_bits)
         self.months = kwargs.pop('months', None)
         self.weeks = kwargs.pop('weeks', None)
-        if (self.months is not None) and (self.weeks is not None):
-            raise ValueError
-
-        self.client = pymongo.Connection(*args, **kwargs)
+        self.retention = Retention(name, self.months, self.weeks)
+        ensure_schema = kwargs.pop('ensure_schema', True)
+
+        # An existing connection (or stand-in) may be provided; otherwise
+        # clients with the same configuration share a connection pool
+        self.client = kwargs.pop('connection', None)
+        if self.client is not None:
+            self.connection_key = ('mongo', id(self.client))
+        else:
+            self.connection_key = connections.key('mongo', args, kwargs)
+            self.client = connections.get(
+                self.connection_key,
+                lambda: pymongo.Connection(*args, **kwargs),
+                check=lambda client: client.server_info())
         self.namePrefix = name + '-'
 
-        if (self.months is None) and (self.weeks is None):
-            self.names = [name]
-            self.docsList = [getattr(self.client, name).documents]
-        elif self.weeks is not None:
-            today = datetime.now()
-            wd = today.weekday()
-            self.names = [self.namePrefix
-                          + (today -
-                             relativedelta(weeks=i) -
-                             relativedelta(days=wd)).strftime(
-                                 '%Y-%m-%d')
-                          for i in range(self.weeks)]
-            self.docsList = [getattr(self.client, n).documents
-                             for n in self.names]
-        else:
-            today = datetime.now()
-            self.names = [self.namePrefix
-                          + (today -
-                             relativedelta(months=i)).strftime(
-                                 '%Y-%m')
-                          for i in range(self.months)]
-            self.docsList = [getattr(self.client, n).documents
-                             for n in self.names]
-
-        # Create the indexes (if they exist it's ok)
-        for j in range(len(self.names)):
-            for i in range(self.num_tables):
-                self.docsList[j].create_index(str(i), pymongo.ASCENDING)
+        if ensure_schema:
+            self.ensure_schema()
+
+    @property
+    def names(self):
+        '''The databases in the retention window, newest first'''
+        return self.retention.names()
+
+    @property
+    def docsList(self):
+        '''The collections in the retention window, newest first'''
+        return self.collections(self.names)
+
+    def collections(self, names):
+        '''The collections of documents for the provided databases'''
+        return [getattr(self.client, n).documents for n in names]
+
+    def schema_key(self, name):
+        '''The marker for the indexes of one database having been created'''
+        return (self.connection_key, 'indexes', name, self.num_tables)
+
+    def create_indexes(self, docs):
+        '''Create the indexes (if they exist it's ok)'''
+        for i in range(self.num_tables):
+            docs.create_index(str(i), pymongo.ASCENDING)
+
+    def ensure_schema(self):
+        '''Create the indexes for every database, once per process'''
+        for name, docs in zip(self.names, self.docsList):
+            connections.once(self.schema_key(name),
+                             lambda: self.create_indexes(docs))
+
+    def drop_database(self, name):
+        '''Drop one database, and forget that its indexes were created'''
+        self.client.drop_database(name)
+        connections.forget(self.schema_key(name))
 
     def delete(self):
         '''Delete this database of simhashes'''
         for name in self.names:
-            self.client.drop_database(name)
+            self.drop_database(name)
 
     def delete_old(self):
         '''Delete data that's older than the retention period.'''
-        names = self.client.database_names()
-        today = datetime.now()
-        if self.months is not None:
-            cutoff = today - relativedelta(months=self.months)
-            for name in names:
-                if name.startswith(self.namePrefix):
-                    dbDateString = name[len(self.namePrefix):] + '-01'
-                    dbDate = dateutil.parser.parse(dbDateString)
-                    if dbDate < cutoff:
-                        self.client.drop_database(name)
-        elif self.weeks is not None:
-            wd = today.weekday()
-            cutoff = (today -
-                      relativedelta(weeks=self.weeks) -
-                      relativedelta(days=wd))
-            for name in names:
-                if name.startswith(self.namePrefix):
-                    dbDateString = name[len(self.namePrefix):]
-                    dbDate = dateutil.parser.parse(dbDateString)
-                    if dbDate < cutoff:
-                        self.client.drop_database(name)
+        names = self.retention.expired(self.client.database_names())
+        for name in names:
+            self.drop_database(name)
+        return names
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
+        for docs in self.docsList:
+            for doc in docs.find({}, fields=['0']):
+                yield self.corpus.tables[0].unpermute(
+                    signed_to_unsigned(int(doc['0'])))
+
+    def documents(self, hashes):
+        '''Build the documents to insert for the provided hashes'''
+        return [
+            dict((
+                str(i),
+                unsigned_to_signed(int(self.corpus.tables[i].permute(hsh)))
+            ) for i in range(self.num_tables)) for hsh in hashes
+        ]
 
     def insert(self, hash_or_hashes):
         '''Insert one (or many) hashes into the database'''
@@ -105,68 +108,110 @@ class Client(BaseClient):
             hashes = [hash_or_hashes]
 
         # Construct the docs, and then we'll do an insert
-        docs = [
-            dict((
-                str(i),
-                unsigned_to_signed(int(self.corpus.tables[i].permute(hsh)))
-            ) for i in range(self.num_tables)) for hsh in hashes
-        ]
-        # And now insert them
-        self.docsList[0].insert(docs)
+        docs = self.documents(hashes)
+        # And now insert them into the current database, which may have
+        # rotated since this client was created
+        name = self.retention.current()
+        collection = self.collections([name])[0]
+        connections.once(self.schema_key(name),
+                         lambda: self.create_indexes(collection))
+        with self.metrics.timer('insert'):
+            collection.insert(docs)
+        self.metrics.incr('round_trips')
+        self.metrics.incr('inserts', len(docs))
+        self.metrics.incr('bytes', 8 * len(docs) * self.num_tables)
+
+    def range_query(self, table_num, ranges):
+        '''The query document for the range of this particular table'''
+        return {str(table_num): {
+            '$gte': unsigned_to_signed(ranges[table_num][0]),
+            '$lte': unsigned_to_signed(ranges[table_num][1])
+        }}
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        return ['%s.documents.find(%r)' % (
+            name, self.range_query(table_num, ranges)) for name in self.names]
+
+    def scan_table(self, hsh, table_num, ranges, docsList=None):
+        '''Return all the candidates in range in this particular table, across
+        all the databases (or only those in `docsList`)'''
+        query = self.range_query(table_num, ranges)
+        results = []
+        for docs in (docsList or self.docsList):
+            with self.metrics.timer('find_in_table', table_num):
+                results.extend([self.corpus.tables[table_num].unpermute(
+                    signed_to_unsigned(int(d[str(table_num)])))
+                    for d in docs.find(query)])
+            self.metrics.incr('round_trips', 1, table_num)
+        self.metrics.incr('bytes', 8 * self.num_tables * len(results),
+                          table_num)
+        return results
 
     def find_in_table(self, docs, hsh, table_num, ranges):
         '''Return all the results found in this particular table'''
-        low = unsigned_to_signed(ranges[table_num][0])
-        high = unsigned_to_signed(ranges[table_num][1])
-        results = docs.find({str(table_num): {
-            '$gte': low,
-            '$lte': high
-        }})
-        results = [self.corpus.tables[table_num].unpermute(
-            signed_to_unsigned(int(d[str(table_num)]))) for d in results]
-        return [h for h in results if
-                self.corpus.distance(h, hsh) <= self.num_bits]
-
-    def find_one(self, hash_or_hashes):
-        '''Find one near-duplicate for the provided query (or queries)'''
+        return self.filter_candidates(
+            hsh, self.scan_table(hsh, table_num, ranges, [docs]), table_num)
+
+    def find_one_in(self, docs, hsh, ranges):
+        '''Return the first near-duplicate found in one database, or None'''
+        for i in range(self.num_tables):
+            found = self.find_in_table(docs, hsh, i, ranges)
+            if found:
+                return found[0]
+        return None
+
+    def find_all_in(self, docs, hsh, ranges):
+        '''Return all the near-duplicates found in one database'''
+        found = []
+        for i in range(self.num_tables):
+            found.extend(self.find_in_table(docs, hsh, i, ranges))
+        return found
+
+    def find_one(self, hash_or_hashes, since=None):
+        '''Find one near-duplicate for the provided query (or queries). With
+        `since` (a datetime or a timedelta), only the databases that may hold
+        hashes inserted since then are searched. The databases are probed
+        concurrently, and the first match found is returned'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
+        docsList = self.collections(self.retention.since(since))
         results = []
         for hsh in hashes:
             ranges = self.ranges(hsh)
-            found = []
-            for docs in self.docsList:
-                for i in range(self.num_tables):
-                    found = self.find_in_table(docs, hsh, i, ranges)
-                    if found:
-                        results.append(found[0])
-                        break
-                if found:
+            probes = self.probe(
+                lambda docs: self.find_one_in(docs, hsh, ranges), docsList)
+            found = None
+            for found in probes:
+                if found is not None:
                     break
-            if not found:
-                results.append(None)
+            probes.close()
+            results.append(found)
 
         if not hasattr(hash_or_hashes, '__iter__'):
             return results[0]
         return results
 
-    def find_all(self, hash_or_hashes):
-        '''Find all near-duplicates for the provided query (or queries)'''
+    def find_all(self, hash_or_hashes, since=None):
+        '''Find all near-duplicates for the provided query (or queries). With
+        `since` (a datetime or a timedelta), only the databases that may hold
+        hashes inserted since then are searched, concurrently'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
+        docsList = self.collections(self.retention.since(since))
         results = []
         for hsh in hashes:
             ranges = self.ranges(hsh)
-            found = []
-            for docs in self.docsList:
-                for i in range(self.num_tables):
-                    found.extend(self.find_in_table(docs, hsh, i, ranges))
-            found = list(set(found))
-            results.append(found)
+            found = set()
+            for fnd in self.probe(
+                    lambda docs: self.find_all_in(docs, hsh, ranges),
+                    docsList):
+                found.update(fnd)
+            results.append(list(found))
 
         if not hasattr(hash_or_hashes, '__iter__'):
             return results[0]
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+
+'''A process-wide registry of backend connections, so that clients created
+with the same backend and host configuration share one connection (pool)
+rather than each opening their own. Connections are never shared across
+`os.fork`: a forked child starts with an empty registry.'''
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+def close(connection):
+    '''Close a connection with whichever of the usual methods it has. An
+    entry made of several parts (like a connection and its lock) has each
+    part closed'''
+    if isinstance(connection, tuple):
+        for part in connection:
+            close(part)
+        return
+    for name in ('close', 'disconnect', 'shutdown'):
+        method = getattr(connection, name, None)
+        if callable(method):
+            try:
+                method()
+            except Exception:
+                pass
+            return
+
+
+class Connections(object):
+    '''Hand out shared connections keyed on the backend and the arguments
+    used to create them. At most `limit` connections are kept; past that,
+    the least recently used is closed and forgotten'''
+    def __init__(self, limit=64):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.entries = OrderedDict()
+        # Connections are made and checked under a lock for their key, so
+        # one slow server doesn't hold up clients of the others
+        self.locks = {}
+        # Markers for one-time setup (like creating indexes) that's been done
+        # in this process. Unlike connections, these survive a fork
+        self.done = set()
+        self.done_lock = threading.RLock()
+
+    @staticmethod
+    def key(backend, args, kwargs):
+        '''A key identifying a backend and its connection arguments'''
+        return (backend, repr(args), repr(sorted(kwargs.items())))
+
+    def after_fork(self):
+        '''Forget connections inherited from a parent process. Sockets can't
+        be shared between processes, so the child makes its own'''
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.entries = OrderedDict()
+        self.locks = {}
+        self.done_lock = threading.RLock()
+
+    def lookup(self, key, check, interval):
+        '''Return the connection for `key` if there's one that doesn't need
+        checking, and otherwise the lock for making or checking it'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.pop(key)
+                self.entries[key] = entry
+                if check is None or time.time() - entry[1] <= interval:
+                    return entry[0], None
+            return None, self.locks.setdefault(key, threading.Lock())
+
+    def store(self, key, connection):
+        '''Keep a connection made or checked just now, closing any evicted
+        to make room for it'''
+        evicted = []
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (connection, time.time())
+            while len(self.entries) > self.limit:
+                oldest, entry = self.entries.popitem(last=False)
+                self.locks.pop(oldest, None)
+                evicted.append(entry[0])
+        # Closed outside the lock, since it may have to wait on the server
+        for old in evicted:
+            close(old)
+
+    def get(self, key, factory, check=None, interval=30):
+        '''Return the connection for `key`, creating it with `factory` if
+        there isn't one. If `check` is provided, it's called with the
+        connection at most every `interval` seconds; if it raises, the
+        connection is replaced'''
+        if os.getpid() != self.pid:
+            self.after_fork()
+
+        connection, lock = self.lookup(key, check, interval)
+        if lock is None:
+            return connection
+
+        with lock:
+            # Another thread may have made or checked it in the meantime
+            connection, _ = self.lookup(key, check, interval)
+            if connection is not None:
+                return connection
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None:
+                try:
+                    check(entry[0])
+                    connection = entry[0]
+                except Exception:
+                    pass
+            if connection is None:
+                connection = factory()
+            self.store(key, connection)
+            return connection
+
+    def once(self, key, function):
+        '''Call `function` unless it's already been called for `key` in this
+        process. If it raises, it will be tried again next time. Other
+        threads wait for it rather than calling it too'''
+        if key in self.done:
+            return
+        with self.done_lock:
+            if key in self.done:
+                return
+            function()
+            self.done.add(key)
+
+    def forget(self, key):
+        '''Forget that the setup for `key` was done'''
+        self.done.discard(key)
+
+    def discard(self, key):
+        '''Forget the connection for `key`, so the next `get` makes one'''
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        '''Forget all the connections'''
+        with self.lock:
+            self.entries = OrderedDict()
+
+
+connections = Connections()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=connections.after_fork)
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+
+'''The binary protocol spoken between `simhash_db.server` and the remote
+client. Every message is a header followed by a payload of big-endian
+integers:
+
+    request:  !IBI (request id, opcode, number of hashes), then that many
+              uint64 hashes
+    response: !IBI (request id, status, count), then the payload:
+                insert   - nothing (count is 0)
+                find_one - count uint64 matches, then count uint8 flags of
+                           whether each was found (its match is 0 if not)
+                find_all - count uint32 match counts, then all the uint64
+                           matches back to back
+                delete   - nothing (count is 0)
+              or, if status is ERROR, a utf-8 message of count bytes
+
+Requests on one connection may be pipelined, and responses may come back in
+any order; the request id ties them together.'''
+
+import struct
+
+HEADER = struct.Struct('!IBI')
+
+INSERT = 1
+FIND_ONE = 2
+FIND_ALL = 3
+DELETE = 4
+
+OPERATIONS = {
+    INSERT: 'insert',
+    FIND_ONE: 'find_one',
+    FIND_ALL: 'find_all',
+    DELETE: 'delete'
+}
+
+OK = 0
+ERROR = 1
+
+# The match sent by find_one when there isn't one. Any hash (0 included) may
+# be a real match, so a flag for each says whether it was found
+NO_MATCH = 0
+
+
+def pack_hashes(hashes):
+    '''Pack a list of unsigned 64-bit integers'''
+    return struct.pack('!%iQ' % len(hashes), *hashes)
+
+
+def unpack_hashes(data):
+    '''Unpack a string of unsigned 64-bit integers'''
+    return list(struct.unpack('!%iQ' % (len(data) // 8), data))
+
+
+def request(request_id, opcode, hashes):
+    '''Encode a request'''
+    return HEADER.pack(request_id, opcode, len(hashes)) + pack_hashes(hashes)
+
+
+def response(request_id, opcode, results):
+    '''Encode a successful response to a request'''
+    if opcode == FIND_ONE:
+        return (HEADER.pack(request_id, OK, len(results)) +
+                pack_hashes([NO_MATCH if r is None else r for r in results]) +
+                struct.pack('!%iB' % len(results),
+                            *[r is not None for r in results]))
+    elif opcode == FIND_ALL:
+        counts = [len(r) for r in results]
+        matches = [m for r in results for m in r]
+        return (HEADER.pack(request_id, OK, len(results)) +
+                struct.pack('!%iI' % len(counts), *counts) +
+                pack_hashes(matches))
+    return HEADER.pack(request_id, OK, 0)
+
+
+def error(request_id, message):
+    '''Encode an error response'''
+    data = message.encode('utf-8')
+    return HEADER.pack(request_id, ERROR, len(data)) + data
@@ -2,56 +2,254 @@
 
 '''Our code to connect to the Redis backend'''
 
+import re
 import redis
+import bisect
 import struct
+import hashlib
 from . import BaseClient
-import calendar
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import dateutil.parser
+from . import runtime as runtimes
+from .columnar import Matches, first_matches
+from .pool import connections
+from .retention import Retention
+
+
+def glob_escape(text):
+    '''Escape the characters that are special in a SCAN MATCH pattern'''
+    return re.sub(r'([\\*?\[\]])', r'\\\1', text)
+
+
+class HashRing(object):
+    '''A consistent-hash ring mapping keys onto nodes, so that adding or
+    removing a node only moves the keys nearest to it'''
+    def __init__(self, labels, replicas=160):
+        points = sorted(
+            (self.hash('%s-%s' % (label, replica)), node)
+            for node, label in enumerate(labels)
+            for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(key):
+        '''Where a key falls on the ring'''
+        return struct.unpack(
+            '!I', hashlib.md5(key.encode('utf-8')).digest()[:4])[0]
+
+    def node(self, key):
+        '''The index of the node that owns a key'''
+        index = bisect.bisect(self.hashes, self.hash(key))
+        return self.nodes[index % len(self.nodes)]
 
 
 class Client(BaseClient):
-    '''Our Redis backend client'''
+    '''Our Redis backend client. Keys can be spread over several nodes,
+    either with a consistent-hash ring over plain instances (`nodes`, a list
+    of connection arguments for each) or with Redis Cluster (`cluster=True`).
+    With `shard_bits`, each table is also split on the top bits of the
+    permuted values into 2 ** shard_bits sorted sets, so that even a single
+    table is spread over the nodes'''
+    export_partitions = 8
+    node_executor = None
+
     def __init__(self, name, num_blocks, num_bits, *args, **kwargs):
         BaseClient.__init__(self, name, num_blocks, num_bits)
         self.months = kwargs.pop('months', None)
         self.weeks = kwargs.pop('weeks', None)
-        if (self.months is not None) and (self.weeks is not None):
-            raise ValueError
+        self.retention = Retention(name, self.months, self.weeks)
+        # With index_mode='exact', each table is a set per key rather than
+        # one sorted set, and queries are point lookups
+        self.set_index_mode(kwargs.pop('index_mode', 'range'))
+        if self.index_mode == 'exact':
+            self.export_partitions = 1
+        self.shard_bits = kwargs.pop('shard_bits', 0)
+        self.cluster = kwargs.pop('cluster', False)
+        nodes = kwargs.pop('nodes', None)
 
-        self.client = redis.Redis(*args, **kwargs)
+        # Existing connections (or stand-ins) may be provided; otherwise
+        # clients with the same configuration share a connection pool
+        connection = kwargs.pop('connection', None)
+        if connection is not None:
+            if not isinstance(connection, list):
+                connection = [connection]
+            self.nodes = connection
+            labels = [str(i) for i in range(len(connection))]
+        elif nodes:
+            self.nodes = [self.connect(args, dict(kwargs, **node))
+                          for node in nodes]
+            labels = ['%s:%s' % (node.get('host', 'localhost'),
+                                 node.get('port', 6379)) for node in nodes]
+        else:
+            self.nodes = [self.connect(args, kwargs)]
+            labels = ['0']
+        self.client = self.nodes[0]
+        self.ring = HashRing(labels)
         self.name_prefix = name + '-'
 
-        if (self.months is None) and (self.weeks is None):
-            self.names = [name]
-            self.retention_seconds = 0
-        elif self.weeks is not None:
-            today = datetime.now()
-            wd = today.weekday()
-            self.names = [self.name_prefix
-                          + (today -
-                             relativedelta(weeks=i) -
-                             relativedelta(days=wd)).strftime(
-                                 '%Y-%m-%d')
-                          for i in range(self.weeks)]
-            self.retention_seconds = self.weeks * 7 * 86400
+        # Whether the server supports UNLINK (Redis 4.0 and later)
+        self.unlink = True
+
+    def connect(self, args, kwargs):
+        '''Get the shared connection for one node (or the cluster)'''
+        factory = redis.RedisCluster if self.cluster else redis.Redis
+        return connections.get(
+            connections.key('redis-cluster' if self.cluster else 'redis',
+                            args, kwargs),
+            lambda: factory(*args, **kwargs),
+            check=lambda client: client.ping())
+
+    @property
+    def names(self):
+        '''The buckets in the retention window, newest first'''
+        return self.retention.names()
+
+    def node(self, key):
+        '''The index of the node holding a key'''
+        if len(self.nodes) == 1:
+            return 0
+        return self.ring.node(key)
+
+    def shard(self, permuted):
+        '''The shard of a table holding a permuted value'''
+        if not self.shard_bits:
+            return None
+        return permuted >> (64 - self.shard_bits)
+
+    def shards(self, low=0, high=2 ** 64 - 1):
+        '''The shards of a table that overlap a range of permuted values'''
+        if not self.shard_bits:
+            return [None]
+        return range(self.shard(low), self.shard(high) + 1)
+
+    def table_key(self, name, table_num, shard=None):
+        '''The sorted set holding (a shard of) a table'''
+        if shard is None:
+            return '%s.%s' % (name, table_num)
+        return '%s.%s.%s' % (name, table_num, shard)
+
+    def execute(self, commands, table_num=None):
+        '''Run `(key, method, args)` commands with a pipeline per node, the
+        nodes all at once, and return the replies in order. The nodes get
+        their own executor: this runs inside `probe` (for `export` and the
+        like), and waiting there on more probes could take every worker'''
+        by_node = {}
+        for index, command in enumerate(commands):
+            by_node.setdefault(self.node(command[0]), []).append(index)
+
+        def run(node):
+            with self.nodes[node].pipeline(transaction=False) as pipe:
+                for index in by_node[node]:
+                    key, method, args = commands[index]
+                    getattr(pipe, method)(key, *args)
+                return node, pipe.execute()
+
+        if len(by_node) <= 1:
+            results = [run(node) for node in by_node]
         else:
-            today = datetime.now()
-            self.names = [self.name_prefix
-                          + (today -
-                             relativedelta(months=i)).strftime(
-                                 '%Y-%m')
-                          for i in range(self.months)]
-            self.retention_seconds = self.months * 31 * 86400
+            if self.node_executor is None:
+                self.node_executor = runtimes.executor(
+                    self.runtime, len(self.nodes))
+            results = [future.result() for future in [
+                self.node_executor.submit(run, node) for node in by_node]]
 
-        self.expiration_set = False
+        replies = [None] * len(commands)
+        for node, node_replies in results:
+            for index, result in zip(by_node[node], node_replies):
+                replies[index] = result
+        self.metrics.incr('round_trips', len(by_node), table_num)
+        return replies
+
+    def scan_keys(self, match):
+        '''Iterate over the keys matching a pattern, on every node'''
+        for client in self.nodes:
+            for key in client.scan_iter(match=match, count=1000):
+                if not isinstance(key, str):
+                    key = key.decode('utf-8')
+                yield key
+
+    def purge(self, keys, batch_size=1000):
+        '''Delete the provided keys, with one command per batch on each
+        node. UNLINK frees the memory in the background, so large sorted sets
+        don't block the server; older servers fall back to DEL'''
+        by_node = {}
+        for key in keys:
+            by_node.setdefault(self.node(key), []).append(key)
+        for node, keys in by_node.items():
+            for start in range(0, len(keys), batch_size):
+                self.purge_batch(self.nodes[node],
+                                 keys[start:start + batch_size])
+                self.metrics.incr('round_trips')
+
+    def purge_batch(self, client, batch):
+        '''Delete one batch of keys from one node. Redis Cluster can't delete
+        keys in different slots with one command, so it gets a pipeline of
+        single-key deletes instead'''
+        command = 'UNLINK' if self.unlink else 'DEL'
+        try:
+            if self.cluster:
+                with client.pipeline(transaction=False) as pipe:
+                    for key in batch:
+                        pipe.execute_command(command, key)
+                    pipe.execute()
+            else:
+                client.execute_command(command, *batch)
+        except redis.ResponseError as exc:
+            # Only servers without UNLINK fall back; other errors (like
+            # WRONGTYPE or a missing permission) are the caller's to see
+            if not self.unlink or 'unknown command' not in str(exc).lower():
+                raise
+            self.unlink = False
+            self.purge_batch(client, batch)
+
+    def table_keys(self, name, table_num='*'):
+        '''Iterate over the keys of a bucket's table (or all its tables) in
+        the 'exact' index mode'''
+        return self.scan_keys('%s.%s.*' % (glob_escape(name), table_num))
 
     def delete(self):
         '''Delete this database of simhashes'''
+        if self.index_mode == 'exact':
+            self.purge([key for name in self.names
+                        for key in self.table_keys(name)])
+        else:
+            self.purge([self.table_key(name, num, shard)
+                        for name in self.names
+                        for num in range(self.num_tables)
+                        for shard in self.shards()])
+
+    def delete_old(self):
+        '''Delete the buckets that have fallen out of the retention window.
+        Their keys expire by themselves, so this only finds buckets written
+        without an expiry (or whose expiry was removed)'''
+        if not self.retention.enabled:
+            return []
+        # Keys are bucket.table, followed by the shard or prefix if any
+        levels = 1
+        if self.index_mode == 'exact' or self.shard_bits:
+            levels = 2
+        keys = {}
+        for key in self.scan_keys(glob_escape(self.name_prefix) + '*'):
+            keys.setdefault(key.rsplit('.', levels)[0], []).append(key)
+        names = self.retention.expired(sorted(keys))
+        self.purge([key for name in names for key in keys[name]])
+        return names
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
         for name in self.names:
-            for num in range(self.num_tables):
-                self.client.delete('%s.%s' % (name, num))
+            if self.index_mode == 'exact':
+                keys = self.table_keys(name, 0)
+            else:
+                keys = [self.table_key(name, 0, shard)
+                        for shard in self.shards()]
+            for key in keys:
+                client = self.nodes[self.node(key)]
+                if self.index_mode == 'exact':
+                    members = client.sscan_iter(key)
+                else:
+                    members = (m for m, _ in client.zscan_iter(key))
+                for member in members:
+                    yield struct.unpack('!Q', member)[0]
 
     def insert(self, hash_or_hashes):
         '''Insert one (or many) hashes into the database'''
@@ -59,72 +257,170 @@ class Client(BaseClient):
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        if self.retention_seconds > 0 and not self.expiration_set:
-            for num in range(self.num_tables):
-                name = '%s.%s' % (self.names[0], num)
-                if self.client.ttl(name) <= 0:
-                    self.client.expire(name, 1000 * self.retention_seconds)
-                self.expiration_set = True
-
-        with self.client.pipeline() as pipe:
-            for num in range(self.num_tables):
-                name = '%s.%s' % (self.names[0], num)
-                for hsh in hashes:
-                    permuted = self.corpus.tables[num].permute(hsh)
-                    pipe.zadd(name, struct.pack('!Q', hsh), permuted)
-            pipe.execute()
-
-    def find_in_table(self, hsh, table_num, ranges):
+        bucket = self.retention.current()
+        commands = []
+        for hsh in hashes:
+            packed = struct.pack('!Q', hsh)
+            if self.index_mode == 'exact':
+                commands.extend((key, 'sadd', (packed,))
+                                for key in self.exact_keys(hsh, bucket))
+                continue
+            for num, table in enumerate(self.corpus.tables):
+                permuted = table.permute(hsh)
+                commands.append((
+                    self.table_key(bucket, num, self.shard(permuted)),
+                    'zadd', ({packed: permuted},)))
+
+        # Each key expires when its bucket falls out of the window. The expiry
+        # is set again on every write, since the key may have expired or been
+        # deleted (and recreated without one) since it was last written
+        if self.retention.enabled:
+            expires = self.retention.expires_at(bucket)
+            keys = set(command[0] for command in commands)
+            commands.extend((key, 'expireat', (expires,)) for key in keys)
+
+        with self.metrics.timer('insert'):
+            self.execute(commands)
+        self.metrics.incr('inserts', len(hashes))
+        self.metrics.incr('bytes', 16 * len(hashes) * self.num_tables)
+
+    def describe_scan(self, table_num, ranges, names=None):
+        '''Return the commands `scan_table` issues for this table'''
+        low, high = ranges[table_num]
+        if self.index_mode == 'exact':
+            return ['SMEMBERS %s' % self.exact_key(name, table_num, low)
+                    for name in (names or self.names)]
+        return ['ZRANGEBYSCORE %s %s %s' % (
+            self.table_key(name, table_num, shard), low, high)
+            for name in (names or self.names)
+            for shard in self.shards(low, high)]
+
+    def scan_tables(self, table_nums, ranges, names=None):
+        '''Return the candidates in range in each of the provided tables, in
+        all the buckets (or only those in `names`). Each range query only
+        goes to the shards overlapping the range, and they're all pipelined
+        in one round trip per node. In the 'exact' index mode, each is a
+        lookup of one key'''
+        names = names or self.names
+        commands = []
+        tables = []
+        for table_num in table_nums:
+            low, high = ranges[table_num]
+            for name in names:
+                if self.index_mode == 'exact':
+                    commands.append((self.exact_key(name, table_num, low),
+                                     'smembers', ()))
+                    tables.append(table_num)
+                    continue
+                for shard in self.shards(low, high):
+                    commands.append((self.table_key(name, table_num, shard),
+                                     'zrangebyscore', (low, high)))
+                    tables.append(table_num)
+
+        table = table_nums[0] if len(table_nums) == 1 else None
+        with self.metrics.timer('find_in_table', table):
+            replies = self.execute(commands, table)
+
+        found = dict((table_num, []) for table_num in table_nums)
+        for table_num, reply in zip(tables, replies):
+            found[table_num].extend(struct.unpack('!Q', h)[0] for h in reply)
+        for table_num in table_nums:
+            self.metrics.incr('bytes', 8 * len(found[table_num]), table_num)
+        return [found[table_num] for table_num in table_nums]
+
+    def scan_partition(self, low, high):
+        '''Return the hashes whose permuted value in the first table is in
+        [low, high]. Scores are doubles, so values near a bound can round
+        onto it and be read by the neighbouring partition too; only those
+        whose exact permuted value is in range are kept'''
+        table = self.corpus.tables[0]
+        return [hsh for hsh in self.scan_table(None, 0, [(low, high)])
+                if low <= table.permute(hsh) <= high]
+
+    def scan_table(self, hsh, table_num, ranges, names=None):
+        '''Return all the candidates in range in this particular table, in
+        all the buckets (or only those in `names`)'''
+        return self.scan_tables([table_num], ranges, names)[0]
+
+    def find_in_table(self, hsh, table_num, ranges, names=None):
         '''Return all the results found in this particular table'''
-        low = ranges[table_num][0]
-        high = ranges[table_num][1]
-        results = []
-        for name in self.names:
-            table_name = '%s.%s' % (name, table_num)
-            results.extend([struct.unpack('!Q', h)[0] for h in
-                            self.client.zrangebyscore(table_name, low, high)])
+        return self.filter_candidates(
+            hsh, self.scan_table(hsh, table_num, ranges, names), table_num)
+
+    def first_match(self, hsh, names=None):
+        '''Return one near-duplicate of the provided hash, or None'''
+        ranges = self.ranges(hsh)
+        for i in range(self.num_tables):
+            found = self.find_in_table(hsh, i, ranges, names)
+            if found:
+                return found[0]
+        return None
 
-        return [h for h in results if
-                self.corpus.distance(h, hsh) <= self.num_bits]
+    def all_matches(self, hsh, names=None):
+        '''Return the set of all near-duplicates of the provided hash'''
+        ranges = self.ranges(hsh)
+        tables = list(range(self.num_tables))
+        found = set()
+        for i, candidates in zip(
+                tables, self.scan_tables(tables, ranges, names)):
+            found.update(self.filter_candidates(hsh, candidates, i))
+        return found
 
-    def find_one(self, hash_or_hashes):
-        '''Find one near-duplicate for the provided query (or queries)'''
+    def find_one(self, hash_or_hashes, since=None):
+        '''Find one near-duplicate for the provided query (or queries). With
+        `since` (a datetime or a timedelta), only the buckets that may hold
+        hashes inserted since then are searched'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        results = []
-        for hsh in hashes:
-            ranges = self.ranges(hsh)
-            found = []
-            for i in range(self.num_tables):
-                found = self.find_in_table(hsh, i, ranges)
-                if found:
-                    results.append(found[0])
-                    break
-            if not found:
-                results.append(None)
+        names = self.retention.since(since)
+        results = [self.first_match(hsh, names) for hsh in hashes]
 
         if not hasattr(hash_or_hashes, '__iter__'):
             return results[0]
         return results
 
-    def find_all(self, hash_or_hashes):
-        '''Find all near-duplicates for the provided query (or queries)'''
+    def find_all(self, hash_or_hashes, since=None):
+        '''Find all near-duplicates for the provided query (or queries). With
+        `since` (a datetime or a timedelta), only the buckets that may hold
+        hashes inserted since then are searched'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        results = []
-        for hsh in hashes:
-            ranges = self.ranges(hsh)
-            found = []
-            for i in range(self.num_tables):
-                fnd = self.find_in_table(hsh, i, ranges)
-                found.extend(fnd)
-            found = list(set(found))
-            results.append(found)
+        names = self.retention.since(since)
+        results = [list(self.all_matches(hsh, names)) for hsh in hashes]
 
         if not hasattr(hash_or_hashes, '__iter__'):
             return results[0]
         return results
+
+    def find_one_columnar(self, hashes, missing=0, since=None):
+        '''Like `find_one`, but fill a uint64 array directly'''
+        names = self.retention.since(since)
+        return first_matches(
+            (self.first_match(hsh, names) for hsh in hashes), missing)
+
+    def find_all_columnar(self, hashes, since=None):
+        '''Like `find_all`, but fill a `Matches` directly'''
+        names = self.retention.since(since)
+        matches = Matches()
+        values = matches.values
+        tables = list(range(self.num_tables))
+        for hsh in hashes:
+            start = len(values)
+            ranges = self.ranges(hsh)
+            for i, candidates in zip(
+                    tables, self.scan_tables(tables, ranges, names)):
+                values.extend(self.filter_candidates(hsh, candidates, i))
+            if len(values) - start > 1:
+                # A match may be found in several tables, so keep each once
+                found = sorted(values[start:])
+                del values[start:]
+                values.append(found[0])
+                for previous, value in zip(found, found[1:]):
+                    if value != previous:
+                        values.append(value)
+            matches.offsets.append(len(values))
+        return matches
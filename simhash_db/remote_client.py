@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+
+'''Our code to connect to a `simhash_db.server`'''
+
+import socket
+import struct
+import threading
+from . import BaseClient, GeneralException, protocol
+
+
+class Client(BaseClient):
+    '''A client for a simhash_db server hosting any other backend. Large
+    batches are split into several requests that are pipelined over the one
+    connection'''
+    def __init__(self, name, num_blocks, num_bits, host='127.0.0.1',
+                 port=9199, timeout=None, max_request=10000):
+        BaseClient.__init__(self, name, num_blocks, num_bits)
+        self.max_request = max_request
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+        self.connect()
+        self.lock = threading.Lock()
+        self.request_id = 0
+
+    def connect(self):
+        '''Open the connection to the server'''
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def recv(self, size):
+        '''Read exactly `size` bytes from the connection'''
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise GeneralException('Connection closed by server')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_response(self, opcode):
+        '''Read one response, returning its request id and results, or the
+        error the server reported for it'''
+        request_id, status, count = protocol.HEADER.unpack(
+            self.recv(protocol.HEADER.size))
+        if status == protocol.ERROR:
+            return request_id, GeneralException(
+                self.recv(count).decode('utf-8'))
+        if opcode == protocol.FIND_ONE:
+            results = protocol.unpack_hashes(self.recv(8 * count))
+            found = struct.unpack('!%iB' % count, self.recv(count))
+            results = [r if f else None for r, f in zip(results, found)]
+        elif opcode == protocol.FIND_ALL:
+            counts = struct.unpack('!%iI' % count, self.recv(4 * count))
+            matches = protocol.unpack_hashes(self.recv(8 * sum(counts)))
+            results = []
+            offset = 0
+            for num in counts:
+                results.append(matches[offset:offset + num])
+                offset += num
+        else:
+            results = None
+        return request_id, results
+
+    def call(self, opcode, hashes):
+        '''Send the hashes in pipelined requests and collect the results in
+        order. Every response is read before an error is raised, so none are
+        left on the connection; if that fails, the connection is closed, and
+        opened again by the next call'''
+        chunks = [hashes[i:i + self.max_request]
+                  for i in range(0, len(hashes), self.max_request)] or [[]]
+        with self.metrics.timer(protocol.OPERATIONS[opcode]), self.lock:
+            ids = []
+            data = []
+            for chunk in chunks:
+                self.request_id = (self.request_id + 1) % (2 ** 32)
+                ids.append(self.request_id)
+                data.append(protocol.request(self.request_id, opcode, chunk))
+            responses = {}
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(b''.join(data))
+                for _ in ids:
+                    request_id, results = self.read_response(opcode)
+                    responses[request_id] = results
+            except (GeneralException, socket.error):
+                # We can't tell which responses are still to come
+                self.close()
+                raise
+        self.metrics.incr('round_trips')
+        self.metrics.incr('bytes', sum(len(d) for d in data))
+
+        for request_id in ids:
+            if isinstance(responses[request_id], GeneralException):
+                raise responses[request_id]
+
+        if opcode not in (protocol.FIND_ONE, protocol.FIND_ALL):
+            return None
+        results = []
+        for request_id in ids:
+            results.extend(responses[request_id])
+        return results
+
+    def close(self):
+        '''Close the connection to the server'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def delete(self):
+        '''Delete this database of simhashes'''
+        self.call(protocol.DELETE, [])
+
+    def iter_hashes(self):
+        '''The protocol has no way to list the hashes, so export from the
+        server's own client instead'''
+        raise NotImplementedError(
+            'The remote client can\'t list hashes; export them on the server')
+
+    def insert(self, hash_or_hashes):
+        '''Insert one (or many) hashes into the database'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+        self.call(protocol.INSERT, list(hashes))
+
+    def find_one(self, hash_or_hashes):
+        '''Find one near-duplicate for the provided query (or queries)'''
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return self.call(protocol.FIND_ONE, [hash_or_hashes])[0]
+        return self.call(protocol.FIND_ONE, list(hash_or_hashes))
+
+    def find_all(self, hash_or_hashes):
+        '''Find all near-duplicates for the provided query (or queries)'''
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return self.call(protocol.FIND_ALL, [hash_or_hashes])[0]
+        return self.call(protocol.FIND_ALL, list(hash_or_hashes))
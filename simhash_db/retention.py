@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+
+'''Time buckets for clients that only keep a window of recent data. With
+`weeks=N`, hashes are inserted into a bucket per week (named after its
+Monday, `name-YYYY-MM-DD`) and queries look at the last N buckets; with
+`months=N`, there's a bucket per month (`name-YYYY-MM`). Buckets are
+recomputed whenever the clock crosses into a new one, so long-running
+processes keep writing to the right bucket.'''
+
+import time
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+
+
+class Retention(object):
+    '''Which buckets a client should write to, read from and drop'''
+    def __init__(self, name, months=None, weeks=None, clock=datetime.now):
+        if (months is not None) and (weeks is not None):
+            raise ValueError('Only one of months and weeks may be provided')
+        self.name = name
+        self.prefix = name + '-'
+        self.months = months
+        self.weeks = weeks
+        self.clock = clock
+        self.cached = None
+        self.rotation = None
+
+    @property
+    def enabled(self):
+        '''Whether there is a retention window at all'''
+        return (self.months is not None) or (self.weeks is not None)
+
+    @property
+    def count(self):
+        '''How many buckets are in the window'''
+        return self.weeks if self.weeks is not None else self.months
+
+    def period(self, count=1):
+        '''The length of `count` buckets'''
+        if self.weeks is not None:
+            return relativedelta(weeks=count)
+        return relativedelta(months=count)
+
+    def start(self, when):
+        '''The start of the bucket containing `when`'''
+        when = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.weeks is not None:
+            return when - relativedelta(days=when.weekday())
+        return when.replace(day=1)
+
+    def bucket(self, start):
+        '''The name of the bucket starting at `start`'''
+        if self.weeks is not None:
+            return self.prefix + start.strftime('%Y-%m-%d')
+        return self.prefix + start.strftime('%Y-%m')
+
+    def parse(self, name):
+        '''The start of a bucket given its name, or None if it isn't one of
+        this client's buckets'''
+        if not name.startswith(self.prefix):
+            return None
+        try:
+            if self.weeks is not None:
+                return datetime.strptime(name[len(self.prefix):], '%Y-%m-%d')
+            return datetime.strptime(name[len(self.prefix):], '%Y-%m')
+        except ValueError:
+            return None
+
+    def starts(self, now=None):
+        '''The starts of all the buckets in the window, newest first'''
+        current = self.start(now or self.clock())
+        return [current - self.period(i) for i in range(self.count)]
+
+    def names(self, now=None):
+        '''The names of all the buckets in the window, newest first. These are
+        cached until the clock crosses into the next bucket'''
+        if not self.enabled:
+            return [self.name]
+        if now is not None:
+            return [self.bucket(s) for s in self.starts(now)]
+
+        now = self.clock()
+        if self.cached is None or now >= self.rotation:
+            starts = self.starts(now)
+            self.cached = [self.bucket(s) for s in starts]
+            self.rotation = starts[0] + self.period()
+        return self.cached
+
+    def current(self):
+        '''The name of the bucket new hashes go into'''
+        return self.names()[0]
+
+    def since(self, since):
+        '''The names of the buckets that may hold hashes inserted since
+        `since`, which is a datetime or a timedelta before now'''
+        names = self.names()
+        if since is None or not self.enabled:
+            return names
+        if isinstance(since, timedelta):
+            since = self.clock() - since
+        oldest = self.bucket(self.start(since))
+        return [n for n in names if n >= oldest] or names[:1]
+
+    def expires(self, name):
+        '''When the provided bucket falls out of the window'''
+        return self.parse(name) + self.period(self.count)
+
+    def expires_at(self, name):
+        '''When the provided bucket falls out of the window, as a unix
+        timestamp (for setting TTLs)'''
+        return int(time.mktime(self.expires(name).timetuple()))
+
+    def expired(self, names, now=None):
+        '''Which of the provided names are buckets that have fallen out of the
+        window'''
+        if not self.enabled:
+            return []
+        oldest = self.starts(now)[-1]
+        results = []
+        for name in names:
+            start = self.parse(name)
+            if start is not None and start < oldest:
+                results.append(name)
+        return results
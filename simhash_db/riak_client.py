@@ -1,90 +1,299 @@
 #! /usr/bin/env python
 
-'''Our code to connect to the Riak backend'''
+'''Our code to connect to the Riak backend. It uses the 2.x `riak` client
+over protocol buffers, for bucket types and the set datatype'''
 
 import riak
-import struct
-from . import BaseClient
+from contextlib import closing, contextmanager
+from . import BaseClient, unsigned_to_signed
+from .pool import connections
 
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
-def pack_as_signed(integer):
-    '''Convert an unsigned integer into a signed integer with the same bits'''
-    return struct.unpack('!q', struct.pack('!Q', integer))[0]
+
+class ClientPool(object):
+    '''A pool of Riak clients. A client's protobuf transport can't be shared
+    between threads, so each concurrent request checks one out'''
+    def __init__(self, size, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.clients = Queue()
+        for _ in range(size):
+            self.clients.put(None)
+
+    def connect(self):
+        '''Make a new client, outside of the pool'''
+        return riak.RiakClient(*self.args, **self.kwargs)
+
+    def discard(self, client):
+        '''Close a client that won't be returned to the pool'''
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def client(self):
+        '''Check out a client, connecting it the first time it's used'''
+        client = self.clients.get()
+        try:
+            if client is None:
+                client = self.connect()
+            yield client
+        except Exception:
+            # Don't return a client that may be in a bad state
+            if client is not None:
+                self.discard(client)
+            client = None
+            raise
+        finally:
+            self.clients.put(client)
+
+    def ping(self):
+        '''Make sure that an idle client can reach the cluster'''
+        with self.client() as client:
+            if not client.ping():
+                raise riak.RiakError('Ping failed')
 
 
 class Client(BaseClient):
-    '''Our Riak backend client'''
+    '''Our Riak backend client. Stores and secondary index queries run
+    concurrently, each over its own connection from a pool of `pool_size`'''
+    export_partitions = 8
+
     def __init__(self, name, num_blocks, num_bits, *args, **kwargs):
         BaseClient.__init__(self, name, num_blocks, num_bits)
-        kwargs['transport_class'] = riak.RiakPbcTransport
-        kwargs['port'] = kwargs.get('port', 8087)
-        self.client = riak.RiakClient(*args, **kwargs)
-        self.bucket = self.client.bucket(name)
+        # A bucket type whose backend expires objects (like bitcask with
+        # `expiry_secs`) gives the hashes a TTL without any purging
+        self.bucket_type = kwargs.pop('bucket_type', None)
+        # With index_mode='exact', each hash is added to a set per table
+        # rather than indexed; `bucket_type` must then have datatype = set
+        self.set_index_mode(kwargs.pop('index_mode', 'range'))
+        if self.index_mode == 'exact':
+            if self.bucket_type is None:
+                raise ValueError('The exact index mode needs a bucket_type '
+                                 'with datatype = set')
+            self.export_partitions = 1
+        # Listing keys holds a client while others delete them, so there
+        # must be at least two
+        pool_size = max(2, kwargs.pop('pool_size', 10))
+        kwargs['protocol'] = 'pbc'
+        kwargs['pb_port'] = kwargs.pop('port', kwargs.get('pb_port', 8087))
+        # Clients with different pool sizes get pools of their own
+        self.pool = connections.get(
+            connections.key('riak', args, dict(kwargs, pool_size=pool_size)),
+            lambda: ClientPool(pool_size, *args, **kwargs),
+            check=lambda pool: pool.ping())
+        self.probe_workers = pool_size
+
+    def bucket(self, client):
+        '''This database's bucket, through the provided client'''
+        if self.bucket_type is None:
+            return client.bucket(self.name)
+        return client.bucket_type(self.bucket_type).bucket(self.name)
 
-    def delete(self):
-        '''Delete this database of simhashes'''
-        for key in self.bucket.get_keys():
-            self.bucket.get_binary(key).delete()
+    def keys(self):
+        '''Iterate over the keys in the bucket, streaming them in chunks
+        rather than listing them all at once. The listing holds one of the
+        pool's clients until it's done (or the generator is closed)'''
+        with self.pool.client() as client:
+            with closing(self.bucket(client).stream_keys()) as stream:
+                for keys in stream:
+                    for key in keys:
+                        yield key
+
+    def delete_keys(self, keys):
+        '''Delete the provided keys, without fetching the objects first'''
+        with self.pool.client() as client:
+            bucket = self.bucket(client)
+            for key in keys:
+                bucket.delete(key)
+        return len(keys)
+
+    def delete(self, batch_size=100):
+        '''Delete this database of simhashes. Keys are deleted in batches,
+        concurrently, as they're streamed'''
+        count = 0
+        batches = []
+        keys = []
+        for key in self.keys():
+            keys.append(key)
+            if len(keys) >= batch_size:
+                batches.append(keys)
+                keys = []
+            if len(batches) >= self.probe_workers:
+                count += sum(self.probe(self.delete_keys, batches))
+                batches = []
+        if keys:
+            batches.append(keys)
+        count += sum(self.probe(self.delete_keys, batches))
+        self.metrics.incr('round_trips', count)
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the database'''
+        if self.index_mode == 'exact':
+            prefix = '%s.0.' % self.name
+            for key in self.keys():
+                if key.startswith(prefix):
+                    for hsh in self.members(key):
+                        yield hsh
+            return
+        for key in self.keys():
+            yield int(key)
+
+    def members(self, key):
+        '''The hashes in the set at `key`, in the 'exact' index mode. A set
+        that doesn't exist yet is empty'''
+        with self.pool.client() as client:
+            members = self.bucket(client).get(key)
+        if members is None or not members.value:
+            return []
+        return [int(h) for h in members.value]
+
+    def add(self, item):
+        '''Add hashes to the set at a key, in the 'exact' index mode'''
+        key, hashes = item
+        with self.pool.client() as client:
+            members = self.bucket(client).new(key)
+            for hsh in hashes:
+                members.add(str(hsh))
+            members.store()
+
+    def store(self, hsh):
+        '''Store one hash, with a secondary index per table'''
+        permutations = self.permute(hsh)
+        with self.pool.client() as client:
+            obj = self.bucket(client).new(
+                str(hsh), encoded_data=b'',
+                content_type='application/simhash')
+            for i in range(self.num_tables):
+                obj.add_index('%s_int' % str(i), permutations[i])
+            obj.store()
 
     def insert(self, hash_or_hashes):
-        '''Insert one (or many) hashes into the database'''
+        '''Insert one (or many) hashes into the database. Up to `pool_size`
+        stores are in flight at once'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        for hsh in hashes:
-            permutations = self.permute(hsh)
-            obj = riak.RiakObject(self.client, self.bucket, str(hsh))
-            for i in range(self.num_tables):
-                obj.add_index('%s_int' % str(i), permutations[i])
-            obj.set_content_type('application/simhash')
-            obj.set_encoded_data('')
-            obj.store()
+        if self.index_mode == 'exact':
+            keys = {}
+            for hsh in hashes:
+                for key in self.exact_keys(hsh):
+                    keys.setdefault(key, []).append(hsh)
+            with self.metrics.timer('insert'):
+                for _ in self.probe(self.add, keys.items()):
+                    pass
+            self.metrics.incr('round_trips', len(keys))
+            self.metrics.incr('inserts', len(hashes))
+            self.metrics.incr('bytes', 8 * len(hashes) * self.num_tables)
+            return
+
+        with self.metrics.timer('insert'):
+            for _ in self.probe(self.store, hashes):
+                pass
+        self.metrics.incr('round_trips', len(hashes))
+        self.metrics.incr('inserts', len(hashes))
+        self.metrics.incr('bytes', 8 * len(hashes) * (self.num_tables + 1))
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        if self.index_mode == 'exact':
+            return ['GET %s/%s' % (self.name, self.exact_key(
+                self.name, table_num, ranges[table_num][0]))]
+        return ['2i %s/%s_int %s..%s' % (
+            self.name, table_num, ranges[table_num][0], ranges[table_num][1])]
+
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the candidates in range in this particular table. The
+        results are streamed. In the 'exact' index mode, this is a lookup of
+        one key'''
+        low, high = ranges[table_num]
+        if self.index_mode == 'exact':
+            with self.metrics.timer('find_in_table', table_num):
+                found = self.members(self.exact_key(self.name, table_num, low))
+            self.metrics.incr('round_trips', 1, table_num)
+            self.metrics.incr('bytes', 8 * len(found), table_num)
+            return found
+        index = '%s_int' % str(table_num)
+        with self.metrics.timer('find_in_table', table_num):
+            with self.pool.client() as client:
+                found = []
+                with closing(self.bucket(client).stream_index(
+                        index, low, high)) as stream:
+                    for keys in stream:
+                        found.extend(int(f) for f in keys)
+        self.metrics.incr('round_trips', 1, table_num)
+        self.metrics.incr('bytes', 8 * len(found), table_num)
+        return found
 
     def find_one(self, hash_or_hashes):
-        '''Find one near-duplicate for the provided query (or queries)'''
+        '''Find one near-duplicate for the provided query (or queries). The
+        range queries for every hash and table in the batch run
+        concurrently. Once a hash has a match, its queries that haven't
+        started are skipped, and the rest stop once every hash has one'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        results = []
-        for hsh in hashes:
-            ranges = self.ranges(hsh)
-            found = []
-            for i in range(self.num_tables):
-                low, high = ranges[i]
-                found = [int(f) for f in self.bucket.get_index(
-                    '%s_int' % str(i), low, high)]
-                found = [f for f in found if
-                    self.corpus.distance(hsh, f) < self.num_bits]
+        hashes = list(hashes)
+        ranges = [self.ranges(hsh) for hsh in hashes]
+        results = [None] * len(hashes)
+
+        def scan(query):
+            table_num, index = query
+            if results[index] is not None:
+                return table_num, index, []
+            return table_num, index, self.scan_table(
+                hashes[index], table_num, ranges[index])
+        # The first tables of every hash go first, so later tables are the
+        # ones skipped
+        queries = [(table_num, index) for table_num in range(self.num_tables)
+                   for index in range(len(hashes))]
+        remaining = len(hashes)
+        with closing(self.probe(scan, queries)) as probes:
+            for table_num, index, found in probes:
+                if results[index] is not None:
+                    continue
+                found = self.filter_candidates(
+                    hashes[index], found, table_num)
                 if found:
-                    # If we found /anything/, we should return it immediately
-                    results.append(found[0])
-                    break
-            if not found:
-                results.append(None)
+                    results[index] = found[0]
+                    remaining -= 1
+                    if not remaining:
+                        break
 
         if not hasattr(hash_or_hashes, '__iter__'):
             return results[0]
         return results
 
     def find_all(self, hash_or_hashes):
-        '''Find all near-duplicates for the provided query (or queries)'''
+        '''Find all near-duplicates for the provided query (or queries). The
+        range queries for every hash and table in the batch run
+        concurrently'''
         hashes = hash_or_hashes
         if not hasattr(hash_or_hashes, '__iter__'):
             hashes = [hash_or_hashes]
 
-        results = []
-        for hsh in hashes:
-            ranges = self.ranges(hsh)
-            found = []
-            for i in range(self.num_tables):
-                low, high = ranges[i]
-                found.extend([int(f) for f in self.bucket.get_index(
-                    '%s_int' % str(i), low, high)])
-            found = list(set([f for f in found
-                if self.corpus.distance(f, hsh) < self.num_bits]))
-            results.append(found)
+        hashes = list(hashes)
+        ranges = [self.ranges(hsh) for hsh in hashes]
+        candidates = [set() for _ in hashes]
+
+        def scan(query):
+            index, table_num = query
+            return index, self.scan_table(
+                hashes[index], table_num, ranges[index])
+        queries = [(index, table_num) for index in range(len(hashes))
+                   for table_num in range(self.num_tables)]
+        for index, found in self.probe(scan, queries):
+            candidates[index].update(found)
+
+        results = [self.filter_candidates(hsh, found)
+                   for hsh, found in zip(hashes, candidates)]
 
         if not hasattr(hash_or_hashes, '__iter__'):
             return results[0]
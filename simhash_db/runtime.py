@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+'''The concurrency runtime a client uses for its concurrent work (streaming
+batches, probing buckets and so on). It's chosen when the client is created
+with `runtime=`:
+
+    threads - a thread pool (the default)
+    gevent  - a pool of greenlets. The standard library is monkey-patched the
+              first time a gevent client is created, not at import
+    asyncio - threads underneath, but the client is wrapped so that its
+              methods return awaitables
+
+To keep importing the package cheap, nothing is imported for a runtime until
+it's used.'''
+
+import functools
+
+RUNTIMES = ('threads', 'gevent', 'asyncio')
+
+_patched = []
+
+
+def setup(runtime):
+    '''Prepare the process for the provided runtime. This must run before the
+    client makes any connections'''
+    if runtime not in RUNTIMES:
+        raise ValueError('Unsupported runtime %s' % runtime)
+    if runtime == 'gevent' and not _patched:
+        from gevent import monkey
+        monkey.patch_all()
+        _patched.append(True)
+
+
+class GeventExecutor(object):
+    '''Enough of the `concurrent.futures.Executor` interface on top of a
+    gevent pool'''
+    def __init__(self, workers):
+        from gevent.pool import Pool
+        self.pool = Pool(workers)
+
+    def submit(self, function, *args, **kwargs):
+        '''Run the function in a greenlet. Like a future, the greenlet's
+        `get` is exposed as `result`'''
+        greenlet = self.pool.spawn(function, *args, **kwargs)
+        greenlet.result = greenlet.get
+        greenlet.cancel = lambda: greenlet.kill(block=False)
+        return greenlet
+
+    def shutdown(self, wait=True):
+        '''Wait for all the greenlets to finish'''
+        if wait:
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        return False
+
+
+def executor(runtime, workers):
+    '''An executor for the provided runtime with `workers` workers'''
+    if runtime == 'gevent':
+        return GeventExecutor(workers)
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(workers)
+
+
+def as_completed(runtime, futures):
+    '''Iterate over the futures from `executor` as they complete'''
+    if runtime == 'gevent':
+        import gevent
+        return gevent.iwait(futures)
+    import concurrent.futures
+    return concurrent.futures.as_completed(futures)
+
+
+class AsyncClient(object):
+    '''Wrap a client so that its methods return awaitables, run in a thread
+    pool. Anything else is passed through to the client'''
+    methods = ('insert', 'find_one', 'find_all', 'delete', 'explain')
+
+    def __init__(self, client, workers=4):
+        self.client = client
+        self.executor = executor('threads', workers)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in self.methods:
+            return attribute
+
+        def method(*args, **kwargs):
+            import asyncio
+            return asyncio.get_event_loop().run_in_executor(
+                self.executor, functools.partial(attribute, *args, **kwargs))
+        return method
@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+
+'''A near-duplicate query server. It hosts one client (of any backend) and
+exposes insert / find_one / find_all over the binary protocol in
+`simhash_db.protocol`, so many application processes can share one index.
+Requests from all the connections are batched together: those arriving
+within `max_delay` seconds of each other (up to `max_batch` hashes) are sent
+to the client as one call. Calls to the client are made from a single
+thread, so any backend can be hosted.
+
+Run it with:
+
+    python -m simhash_db.server --backend judy --name testing --port 9199'''
+
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from . import Client, protocol
+
+
+class Batcher(object):
+    '''Collect requests for the same operation across connections and run
+    them against the client together'''
+    def __init__(self, client, loop, max_delay=0.0005, max_batch=4096):
+        self.client = client
+        self.loop = loop
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = dict((op, []) for op in protocol.OPERATIONS)
+        self.counts = dict((op, 0) for op in protocol.OPERATIONS)
+        self.timers = {}
+
+    def submit(self, opcode, hashes):
+        '''Queue a request, returning a future for its results'''
+        future = self.loop.create_future()
+        if opcode == protocol.DELETE:
+            # Nothing to batch, but it has to be ordered with everything else
+            self.flush_all()
+            self.pending[opcode].append((hashes, future))
+            self.flush(opcode)
+            return future
+
+        if opcode != protocol.INSERT and self.pending[protocol.INSERT]:
+            # Queries have to see the inserts sent before them, and calls to
+            # the client are made in order, so the inserts go first
+            self.flush(protocol.INSERT)
+        self.pending[opcode].append((hashes, future))
+        self.counts[opcode] += len(hashes)
+        if self.counts[opcode] >= self.max_batch:
+            self.flush(opcode)
+        elif opcode not in self.timers:
+            self.timers[opcode] = self.loop.call_later(
+                self.max_delay, self.flush, opcode)
+        return future
+
+    def flush_all(self):
+        '''Dispatch everything that's queued'''
+        for opcode in protocol.OPERATIONS:
+            if self.pending[opcode]:
+                self.flush(opcode)
+
+    def flush(self, opcode):
+        '''Dispatch all the queued requests for an operation'''
+        timer = self.timers.pop(opcode, None)
+        if timer is not None:
+            timer.cancel()
+        items = self.pending[opcode]
+        self.pending[opcode] = []
+        self.counts[opcode] = 0
+        if not items:
+            return
+
+        hashes = []
+        for batch, _ in items:
+            hashes.extend(batch)
+        method = getattr(self.client, protocol.OPERATIONS[opcode])
+        if opcode == protocol.DELETE:
+            call = self.loop.run_in_executor(self.executor, method)
+        else:
+            call = self.loop.run_in_executor(self.executor, method, hashes)
+        call.add_done_callback(
+            lambda done: self.distribute(opcode, items, done))
+
+    def distribute(self, opcode, items, done):
+        '''Hand each request its share of the results'''
+        if done.exception() is not None:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+
+        results = done.result()
+        offset = 0
+        for batch, future in items:
+            if opcode in (protocol.FIND_ONE, protocol.FIND_ALL):
+                share = results[offset:offset + len(batch)]
+            else:
+                share = None
+            offset += len(batch)
+            if not future.done():
+                future.set_result(share)
+
+
+class Server(object):
+    '''Serve a client to any number of pipelined connections. A request of
+    more than `max_request` hashes is skipped over and gets an error'''
+    def __init__(self, client, host='127.0.0.1', port=9199, loop=None,
+                 max_request=100000, **kwargs):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.max_request = max_request
+        self.loop = loop or asyncio.get_event_loop()
+        self.batcher = Batcher(client, self.loop, **kwargs)
+        self.server = None
+        # The tasks handling each connection, and their writers
+        self.connections = {}
+
+    async def start(self):
+        '''Start listening'''
+        self.server = await asyncio.start_server(
+            self.handle, self.host, self.port)
+        return self.server
+
+    def close(self):
+        '''Stop listening'''
+        if self.server is not None:
+            self.server.close()
+
+    async def stop(self):
+        '''Stop listening, close every connection and wait for them'''
+        self.close()
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    async def skip(self, reader, size):
+        '''Read and discard `size` bytes, a bit at a time'''
+        while size:
+            size -= len(await reader.readexactly(min(size, 65536)))
+
+    async def handle(self, reader, writer):
+        '''Read pipelined requests from a connection until it's closed,
+        answering each as soon as its batch completes. Requests stop being
+        read while the responses aren't, so a slow reader can't make the
+        server buffer without limit'''
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                await writer.drain()
+                header = await reader.readexactly(protocol.HEADER.size)
+                request_id, opcode, count = protocol.HEADER.unpack(header)
+                if count > self.max_request:
+                    writer.write(protocol.error(
+                        request_id, 'Request of %i hashes is over the limit '
+                        'of %i' % (count, self.max_request)))
+                    await self.skip(reader, 8 * count)
+                    continue
+                data = await reader.readexactly(8 * count)
+                if opcode not in protocol.OPERATIONS:
+                    writer.write(protocol.error(
+                        request_id, 'Unknown opcode %i' % opcode))
+                    continue
+                future = self.batcher.submit(
+                    opcode, protocol.unpack_hashes(data))
+                future.add_done_callback(
+                    lambda done, r=request_id, o=opcode: self.respond(
+                        writer, r, o, done))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    def respond(self, writer, request_id, opcode, done):
+        '''Write the response for a completed request'''
+        if writer.transport.is_closing():
+            return
+        if done.exception() is not None:
+            writer.write(protocol.error(request_id, repr(done.exception())))
+        else:
+            writer.write(protocol.response(request_id, opcode, done.result()))
+
+
+def main():
+    '''Run a server from the command line'''
+    parser = argparse.ArgumentParser(
+        description='Serve a simhash_db client over the network')
+    parser.add_argument('--backend', type=str, required=True,
+                        help='Which backend to host')
+    parser.add_argument('--name', type=str, default='testing',
+                        help='The name of the set of simhashes to use')
+    parser.add_argument('--num-blocks', dest='num_blocks', type=int,
+                        default=6, help='How many blocks to use')
+    parser.add_argument('--num-bits', dest='num_bits', type=int, default=3,
+                        help='How many bits to use')
+    parser.add_argument('--config', type=str, required=False,
+                        help='Path to a yaml file with the host configuration')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The address to listen on')
+    parser.add_argument('--port', type=int, default=9199,
+                        help='The port to listen on')
+    parser.add_argument('--max-delay', dest='max_delay', type=float,
+                        default=0.0005,
+                        help='How long to wait to collect a batch (s)')
+    parser.add_argument('--max-batch', dest='max_batch', type=int,
+                        default=4096, help='The most hashes in one batch')
+    parser.add_argument('--max-request', dest='max_request', type=int,
+                        default=100000,
+                        help='The most hashes a client may send at once')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.config:
+        from yaml import load
+        with open(args.config) as fin:
+            kwargs = load(fin.read())
+    client = Client(args.backend, args.name, args.num_blocks, args.num_bits,
+                    **kwargs)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = Server(client, args.host, args.port, loop,
+                    max_request=args.max_request, max_delay=args.max_delay,
+                    max_batch=args.max_batch)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+
+'''Our code to keep simhashes in an SQLite database, for single-host
+deployments that need to persist without running a database server.
+
+There's a WITHOUT ROWID table per permutation, keyed on the permuted value.
+SQLite integers are signed, so values are stored with the same bits as a
+signed integer. The ranges searched never cross the sign bit, so they keep
+their order. A batch of queries is written to a temporary table of ranges,
+which is joined against each permutation's table.'''
+
+import sqlite3
+import threading
+from array import array
+from . import BaseClient, signed_to_unsigned, unsigned_to_signed
+from .columnar import Matches
+from .pool import connections
+
+
+def connect(path, timeout):
+    '''Open the database in WAL mode, so readers don't block the writer'''
+    connection = sqlite3.connect(path, timeout=timeout,
+                                 check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS ranges ('
+        'table_num INTEGER, query INTEGER, low INTEGER, high INTEGER)')
+    return connection
+
+
+class Client(BaseClient):
+    '''Our SQLite backend client'''
+    export_partitions = 8
+
+    def __init__(self, name, num_blocks, num_bits, path=None, timeout=5.0,
+                 ensure_schema=True):
+        BaseClient.__init__(self, name, num_blocks, num_bits)
+        self.path = path or ('%s.db' % name)
+
+        # Clients of the same file share a connection, and take turns with
+        # its lock. They're one entry, so they're always shared together
+        self.connection_key = connections.key('sqlite', (self.path,), {})
+        self.connection, self.lock = connections.get(
+            self.connection_key,
+            lambda: (connect(self.path, timeout), threading.Lock()))
+
+        if ensure_schema:
+            self.ensure_schema()
+
+    def table_name(self, table_num):
+        '''The quoted name of the table for this permutation'''
+        return '"%s_%s"' % (self.name.replace('"', '""'), table_num)
+
+    def create_tables(self):
+        '''Create the tables (if they exist it's ok)'''
+        with self.lock, self.connection:
+            for i in range(self.num_tables):
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS %s ('
+                    'permuted INTEGER PRIMARY KEY) WITHOUT ROWID' %
+                    self.table_name(i))
+
+    def ensure_schema(self):
+        '''Create the tables, once per process (or again after `delete`)'''
+        connections.once((self.connection_key, 'tables', self.name),
+                         self.create_tables)
+
+    def delete(self):
+        '''Delete this database of simhashes'''
+        with self.lock, self.connection:
+            for i in range(self.num_tables):
+                self.connection.execute(
+                    'DROP TABLE IF EXISTS %s' % self.table_name(i))
+        connections.forget((self.connection_key, 'tables', self.name))
+
+    def iter_hashes(self, page_size=10000):
+        '''Iterate over all the hashes stored in the database. They're read
+        a page at a time in order, so the lock isn't held between pages'''
+        table = self.corpus.tables[0]
+        query = 'SELECT permuted FROM %s %%s ORDER BY permuted LIMIT %i' % (
+            self.table_name(0), page_size)
+        last = None
+        while True:
+            with self.lock:
+                if last is None:
+                    cursor = self.connection.execute(query % '')
+                else:
+                    cursor = self.connection.execute(
+                        query % 'WHERE permuted > ?', (last,))
+                values = [row[0] for row in cursor]
+            for value in values:
+                yield table.unpermute(signed_to_unsigned(value))
+            if len(values) < page_size:
+                return
+            last = values[-1]
+
+    def insert(self, hash_or_hashes):
+        '''Insert one (or many) hashes into the database, in one
+        transaction'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+
+        self.ensure_schema()
+        with self.metrics.timer('insert'), self.lock, self.connection:
+            for i in range(self.num_tables):
+                table = self.corpus.tables[i]
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO %s (permuted) VALUES (?)' %
+                    self.table_name(i),
+                    [(unsigned_to_signed(table.permute(hsh)),)
+                     for hsh in hashes])
+        self.metrics.incr('round_trips')
+        self.metrics.incr('inserts', len(hashes))
+        self.metrics.incr('bytes', 8 * len(hashes) * self.num_tables)
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        low, high = ranges[table_num]
+        return ['SELECT permuted FROM %s WHERE permuted BETWEEN %s AND %s' % (
+            self.table_name(table_num), unsigned_to_signed(low),
+            unsigned_to_signed(high))]
+
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the candidates in range in this particular table'''
+        low, high = ranges[table_num]
+        self.ensure_schema()
+        table = self.corpus.tables[table_num]
+        with self.metrics.timer('find_in_table', table_num), self.lock:
+            cursor = self.connection.execute(
+                'SELECT permuted FROM %s WHERE permuted BETWEEN ? AND ?' %
+                self.table_name(table_num),
+                (unsigned_to_signed(low), unsigned_to_signed(high)))
+            results = [table.unpermute(signed_to_unsigned(row[0]))
+                       for row in cursor]
+        self.metrics.incr('round_trips', 1, table_num)
+        self.metrics.incr('bytes', 8 * len(results), table_num)
+        return results
+
+    def find_in_table(self, hsh, table_num, ranges):
+        '''Return all the results found in this particular table'''
+        return self.filter_candidates(
+            hsh, self.scan_table(hsh, table_num, ranges), table_num)
+
+    def find_tables(self, hashes):
+        '''Return the matches for each of the provided hashes, table by
+        table. The ranges of the whole batch are written to the temporary
+        ranges table, and then each table is searched with one join'''
+        ranges = [self.ranges(hsh) for hsh in hashes]
+        results = [[[] for _ in range(self.num_tables)] for _ in hashes]
+        self.ensure_schema()
+        with self.metrics.timer('find_in_table'), self.lock, self.connection:
+            self.connection.execute('DELETE FROM temp.ranges')
+            self.connection.executemany(
+                'INSERT INTO temp.ranges VALUES (?, ?, ?, ?)', [
+                    (i, query, unsigned_to_signed(rngs[i][0]),
+                     unsigned_to_signed(rngs[i][1]))
+                    for query, rngs in enumerate(ranges)
+                    for i in range(self.num_tables)])
+            for i in range(self.num_tables):
+                table = self.corpus.tables[i]
+                rows = self.connection.execute(
+                    'SELECT r.query, t.permuted FROM temp.ranges AS r '
+                    'CROSS JOIN %s AS t '
+                    'ON t.permuted BETWEEN r.low AND r.high '
+                    'WHERE r.table_num = ?' % self.table_name(i), (i,))
+                count = 0
+                for query, permuted in rows:
+                    results[query][i].append(
+                        table.unpermute(signed_to_unsigned(permuted)))
+                    count += 1
+                self.metrics.incr('bytes', 8 * count, i)
+            self.connection.execute('DELETE FROM temp.ranges')
+        self.metrics.incr('round_trips')
+
+        for hsh, tables in zip(hashes, results):
+            for i in range(self.num_tables):
+                tables[i] = self.filter_candidates(hsh, tables[i], i)
+        return results
+
+    def find_one(self, hash_or_hashes):
+        '''Find one near-duplicate for the provided query (or queries)'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+
+        results = []
+        for tables in self.find_tables(list(hashes)):
+            found = [f for table in tables for f in table]
+            results.append(found[0] if found else None)
+
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return results[0]
+        return results
+
+    def find_all(self, hash_or_hashes):
+        '''Find all near-duplicates for the provided query (or queries)'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+
+        results = []
+        for tables in self.find_tables(list(hashes)):
+            results.append(list(set(f for table in tables for f in table)))
+
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return results[0]
+        return results
+
+    def find_one_columnar(self, hashes, missing=0):
+        '''Like `find_one`, but fill a uint64 array directly'''
+        results = array('Q')
+        for tables in self.find_tables(list(hashes)):
+            for table in tables:
+                if table:
+                    results.append(table[0])
+                    break
+            else:
+                results.append(missing)
+        return results
+
+    def find_all_columnar(self, hashes):
+        '''Like `find_all`, but fill a `Matches` directly'''
+        matches = Matches()
+        for tables in self.find_tables(list(hashes)):
+            matches.append(set(f for table in tables for f in table))
+        return matches
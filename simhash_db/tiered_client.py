@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+
+'''A client that keeps a bounded in-memory tier of recent hashes in front of
+a persistent backend. Writes go through to both tiers. `find_one` is
+answered from the hot tier when it can be, and only the misses go on to the
+cold tier. The hot tier only holds some of the hashes, so `find_all` always
+asks the cold tier.'''
+
+import itertools
+import threading
+from . import BaseClient
+from .judy_client import Client as JudyClient
+
+
+class Client(BaseClient):
+    '''Our tiered client. `cold` is either a client, or the name of a
+    backend to create one with (using `cold_args` and `cold_kwargs`). The
+    hot tier is an in-memory client bounded to `max_entries` hashes (or
+    `max_memory` bytes) and to those inserted in the last `max_age` seconds,
+    evicting by `policy`. With `warm`, it's filled from the cold tier when
+    the client is created'''
+    # How many hashes to warm the hot tier with when it has no budget (only
+    # a `max_age`, say), so a large cold tier isn't read into memory whole
+    warm_limit = 1000000
+
+    def __init__(self, name, num_blocks, num_bits, cold, cold_args=(),
+                 cold_kwargs=None, max_entries=1000000, max_age=None,
+                 max_memory=None, policy='oldest', warm=True):
+        BaseClient.__init__(self, name, num_blocks, num_bits)
+        if not isinstance(cold, BaseClient):
+            from . import _make_client
+            cold = _make_client(cold, name, num_blocks, num_bits,
+                                *cold_args, **(cold_kwargs or {}))
+        self.cold = cold
+        self.hot = JudyClient(name, num_blocks, num_bits,
+                              max_entries=max_entries, max_age=max_age,
+                              max_memory=max_memory, policy=policy)
+        # The in-memory corpus isn't safe to share between threads, but the
+        # cold tier may be, so only the hot tier takes turns
+        self.lock = threading.Lock()
+        self.export_partitions = cold.export_partitions
+        if warm:
+            self.warm()
+
+    def warm(self, limit=None):
+        '''Fill the hot tier with up to `limit` (by default, as many as fit
+        its budget, or `warm_limit` without one) hashes from the cold tier,
+        and return how many were loaded. Backends with a retention window
+        yield their newest bucket first, so those are the hashes kept'''
+        limit = limit or self.hot.capacity() or self.warm_limit
+        try:
+            hashes = list(itertools.islice(self.cold.iter_hashes(), limit))
+        except NotImplementedError:
+            return 0
+        # Insert the oldest first, so that they're the first evicted
+        hashes.reverse()
+        with self.lock:
+            self.hot.insert(hashes)
+        return len(hashes)
+
+    def delete(self):
+        '''Delete this database of simhashes'''
+        self.cold.delete()
+        with self.lock:
+            self.hot.delete()
+
+    def delete_old(self):
+        '''Delete the data that has fallen out of the cold tier's retention
+        window'''
+        return self.cold.delete_old()
+
+    def iter_hashes(self):
+        '''Iterate over all the hashes stored in the cold tier'''
+        return self.cold.iter_hashes()
+
+    def scan_table(self, hsh, table_num, ranges):
+        '''Return all the candidates in range in this particular table of the
+        cold tier'''
+        return self.cold.scan_table(hsh, table_num, ranges)
+
+    def scan_partition(self, low, high):
+        '''Return the hashes in this partition of the cold tier'''
+        return self.cold.scan_partition(low, high)
+
+    def describe_scan(self, table_num, ranges):
+        '''Return the commands `scan_table` issues for this table'''
+        return self.cold.describe_scan(table_num, ranges)
+
+    def insert(self, hash_or_hashes):
+        '''Insert one (or many) hashes into both tiers. The cold tier is
+        written first, so the hot tier never has what the cold tier doesn't'''
+        hashes = hash_or_hashes
+        if hasattr(hash_or_hashes, '__iter__'):
+            hashes = list(hash_or_hashes)
+        with self.metrics.timer('insert'):
+            self.cold.insert(hashes)
+            with self.lock:
+                self.hot.insert(hashes)
+
+    def find_one(self, hash_or_hashes):
+        '''Find one near-duplicate for the provided query (or queries),
+        asking the cold tier only about those the hot tier misses'''
+        hashes = hash_or_hashes
+        if not hasattr(hash_or_hashes, '__iter__'):
+            hashes = [hash_or_hashes]
+        hashes = list(hashes)
+
+        with self.metrics.timer('find_one'):
+            with self.lock:
+                results = self.hot.find_one(hashes)
+            misses = [i for i, found in enumerate(results) if found is None]
+            if misses:
+                found = self.cold.find_one([hashes[i] for i in misses])
+                for i, result in zip(misses, found):
+                    results[i] = result
+        self.metrics.incr('hot_hits', len(hashes) - len(misses))
+        self.metrics.incr('cold_queries', len(misses))
+
+        if not hasattr(hash_or_hashes, '__iter__'):
+            return results[0]
+        return results
+
+    def find_all(self, hash_or_hashes):
+        '''Find all near-duplicates for the provided query (or queries)'''
+        with self.metrics.timer('find_all'):
+            return self.cold.find_all(hash_or_hashes)
+
+    def find_all_columnar(self, hashes):
+        '''Like `find_all`, but return a `simhash_db.columnar.Matches`'''
+        with self.metrics.timer('find_all'):
+            return self.cold.find_all_columnar(hashes)
@@ -4,6 +4,8 @@
 
 import unittest
 from simhash_db import Client
+from simhash_db.coalesce import Coalescer
+from simhash_db.metrics import Registry, prometheus_text
 
 
 class BaseTest(object):
@@ -50,6 +52,20 @@ class BaseTest(object):
         for result in results:
             self.assertTrue(len(result) >= 1)
 
+    # Hashes within a couple of bits of each other, for the tests that only
+    # need a few near-duplicates in the database
+    neighbours = [1, 2, 4]
+
+    def insert_neighbours(self, *others):
+        '''Insert the neighbours (and any others) and return them all'''
+        hashes = self.neighbours + list(others)
+        self.client.insert(hashes)
+        return hashes
+
+    def assertMatches(self, found, expected):
+        '''Assert that exactly the expected hashes were found'''
+        self.assertEqual(set(found), set(expected))
+
     def test_delete(self):
         '''Test out that we can in fact delete the database and have it be
         completely gone'''
@@ -71,3 +87,106 @@ class BaseTest(object):
         self.client.insert(hashes)
         for hsh in hashes:
             self.assertEqual(set(self.client.find_all(hsh)), set([hsh]))
+
+    def test_metrics(self):
+        '''Make sure that an attached registry records what the client does'''
+        registry = Registry()
+        self.client.instrument(registry)
+        self.insert_neighbours()
+        self.assertMatches(self.client.find_all(1), self.neighbours)
+        self.assertTrue(registry.histograms)
+        self.assertTrue(prometheus_text(registry).startswith('# TYPE'))
+
+        # And detaching it should stop recording
+        self.client.instrument(None)
+        registry.reset()
+        self.client.find_all(1)
+        self.assertEqual(registry.histograms, {})
+
+    def test_explain(self):
+        '''Make sure explain reports on every table and finds the matches'''
+        self.insert_neighbours()
+        report = self.client.explain(1)
+        self.assertEqual(len(report['tables']), self.client.num_tables)
+        self.assertMatches(report['matches'], self.neighbours)
+        ranges = self.client.ranges(1)
+        for step in report['tables']:
+            self.assertEqual(step['range'], ranges[step['table']])
+
+    def test_stream(self):
+        '''Make sure we can insert and query from generators'''
+        expected = [1 << i for i in range(6)]
+        count = self.client.insert_stream(
+            iter(expected), batch_size=2, in_flight=2)
+        self.assertEqual(count, 6)
+
+        results = list(self.client.find_all_iter(
+            iter([1, 31]), batch_size=1, in_flight=2))
+        self.assertMatches(results[0], expected)
+        self.assertEqual(results[1], [])
+
+        results = list(self.client.find_one_iter(iter([1, 31]), batch_size=1))
+        self.assertIn(results[0], expected)
+        self.assertEqual(results[1], None)
+
+    def test_coalesce(self):
+        '''Make sure concurrent single-hash calls get their own results'''
+        import threading
+        self.insert_neighbours()
+        coalescer = Coalescer(self.client, max_delay=0.01)
+        results = {}
+
+        def query(hsh):
+            results[hsh] = coalescer.find_one(hsh)
+
+        threads = [threading.Thread(target=query, args=(h,)) for h in [1, 31]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Lists are batched too, and empty ones don't wait on the dispatcher
+        many = coalescer.find_one([1, 31])
+        self.assertEqual(coalescer.find_all([]), [])
+        coalescer.close()
+
+        self.assertIn(results[1], self.neighbours)
+        self.assertEqual(results[31], None)
+        self.assertIn(many[0], self.neighbours)
+        self.assertEqual(many[1], None)
+
+    def test_probe(self):
+        '''Make sure probes all run, and can be abandoned early'''
+        self.assertEqual(
+            sorted(self.client.probe(lambda n: n * 2, [1, 2, 3])), [2, 4, 6])
+        probes = self.client.probe(lambda n: n, range(100))
+        self.assertIn(next(probes), range(100))
+        probes.close()
+
+    def test_delete_old(self):
+        '''Without a retention window, there's never anything old'''
+        self.insert_neighbours()
+        self.assertEqual(self.client.delete_old(), [])
+        self.assertMatches(self.client.find_all(1), self.neighbours)
+
+    def test_exact_keys(self):
+        '''Near-duplicates share at least one key in the 'exact' index mode'''
+        keys = set(self.client.exact_keys(1))
+        self.assertEqual(len(keys), self.client.num_tables)
+        for other in [1 ^ 7, 1 ^ (7 << 61), 1 ^ (1 << 63) ^ (1 << 20) ^ 2]:
+            self.assertTrue(keys & set(self.client.exact_keys(other)))
+
+    def test_columnar(self):
+        '''Columnar results match the lists of lists'''
+        self.insert_neighbours(0xFF00)
+        queries = [1, 31, 0xFF00]
+        matches = self.client.find_all_columnar(queries)
+        self.assertEqual(len(matches), 3)
+        self.assertEqual(len(matches.offsets), 4)
+        # Each match is listed once, though it's found in several tables
+        self.assertEqual(
+            [sorted(found) for found in matches.tolist()],
+            [sorted(found) for found in self.client.find_all(queries)])
+        first = self.client.find_one_columnar(queries, missing=7)
+        self.assertEqual(first.typecode, 'Q')
+        self.assertIn(first[0], self.neighbours)
+        self.assertEqual(list(first[1:]), [7, 0xFF00])
@@ -0,0 +1,38 @@
+#! /usr/bin/env python
+
+'''Make sure the configuration advisor is sane'''
+
+import random
+import unittest
+from simhash_db import advisor
+
+
+class AdvisorTest(unittest.TestCase):
+    '''Test the configuration advisor'''
+    def setUp(self):
+        rand = random.Random(0)
+        self.sample = [rand.randint(0, 2 ** 64 - 1) for i in range(1000)]
+
+    def test_full_recall(self):
+        '''With at least as many bits as the distance, nothing is missed'''
+        result = advisor.model(self.sample, 6, 3, distance=3, trials=200)
+        self.assertEqual(result['recall'], 1.0)
+        self.assertEqual(result['num_tables'], advisor.num_tables(6, 3))
+
+    def test_advise(self):
+        '''The recommendation should meet the recall target'''
+        results = advisor.advise(self.sample, 3, max_blocks=8, trials=200)
+        self.assertTrue(results[0]['meets_recall'])
+        self.assertTrue(results[0]['num_bits'] >= 3)
+        costs = [r['cost'] for r in results if r['meets_recall']]
+        self.assertEqual(costs, sorted(costs))
+
+    def test_sample(self):
+        '''Sampling should cap the sample size but count everything'''
+        sample, seen = advisor.sample_hashes(iter(self.sample), 100, seed=1)
+        self.assertEqual(len(sample), 100)
+        self.assertEqual(seen, len(self.sample))
+
+
+if __name__ == '__main__':
+    unittest.main()
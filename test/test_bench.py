@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+
+'''Smoke test bench.py against each of its local stand-ins'''
+
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The backends that `bench.py --local` can run without a server, and the
+# module each one's stand-in needs
+STAND_INS = [('judy', None), ('redis', 'fakeredis'), ('mongo', 'mongomock')]
+
+
+def bench(backend, *extra):
+    '''Run a tiny benchmark, returning the exit status and output'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    process = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'bench.py'), '--local',
+        '--backend', backend, '--count', '10', '--batches', '5',
+        '--warmup', '1', '--processes', '2', '--seed', '1', '--json', '-'] +
+        list(extra),
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout.decode('utf-8'), stderr.decode('utf-8')
+
+
+class BenchTest(unittest.TestCase):
+    '''bench.py should run cleanly on every local stand-in'''
+    def test_local(self):
+        for backend, module in STAND_INS:
+            if module is not None:
+                try:
+                    __import__(module)
+                except ImportError:
+                    continue
+            status, stdout, stderr = bench(backend, '--prefill', '2')
+            self.assertEqual(status, 0, '%s: %s' % (backend, stderr))
+            output = json.loads(stdout[stdout.index('{'):])
+            for result in output['results']:
+                self.assertEqual(result['errors'], 0, backend)
+            self.assertEqual(
+                [sorted(result['operations']) for result in output['results']],
+                [['insert'], ['find_all']], backend)
+
+    def test_prefill(self):
+        '''Per-process stores can't be queried without a prefill'''
+        status, _, stderr = bench('judy')
+        self.assertNotEqual(status, 0)
+        self.assertIn('--prefill', stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+#! /usr/bin/env python
+
+'''Make sure the columnar results are sane'''
+
+import unittest
+from simhash_db.columnar import Matches, first_matches
+
+
+class ColumnarTest(unittest.TestCase):
+    '''Test the columnar result forms'''
+    def test_matches(self):
+        '''Matches are kept in CSR form'''
+        matches = Matches.from_lists([[1, 2], [], None, [3]])
+        self.assertEqual(list(matches.values), [1, 2, 3])
+        self.assertEqual(list(matches.offsets), [0, 2, 2, 2, 3])
+        self.assertEqual(len(matches), 4)
+        self.assertEqual(list(matches[3]), [3])
+        self.assertEqual(matches.tolist(), [[1, 2], [], [], [3]])
+
+    def test_first_matches(self):
+        '''Missing matches are replaced with the sentinel'''
+        self.assertEqual(list(first_matches([5, None, 2 ** 64 - 1])),
+                         [5, 0, 2 ** 64 - 1])
+        self.assertEqual(list(first_matches([None], missing=9)), [9])
+
+
+if __name__ == '__main__':
+    unittest.main()
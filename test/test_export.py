@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+'''Make sure exports round-trip'''
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from simhash_db import Client
+from simhash_db import export
+
+
+class ExportTest(unittest.TestCase):
+    '''Test the export format, and moving hashes between clients'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rand = random.Random(1)
+        self.hashes = [rand.getrandbits(64) for _ in range(1000)] + [
+            0, 2 ** 63 - 1, 2 ** 63, 2 ** 64 - 1]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, **kwargs):
+        '''Write and read back the hashes'''
+        buf = io.BytesIO()
+        writer = export.Writer(buf, frame_size=100, **kwargs)
+        writer.write(self.hashes)
+        writer.close()
+        buf.seek(0)
+        frames = list(export.read(buf))
+        self.assertEqual(len(frames), 11)
+        return [hsh for frame in frames for hsh in frame]
+
+    def test_formats(self):
+        '''Every combination of flags reads back the same hashes'''
+        for compress in (True, False):
+            for delta in (True, False):
+                self.assertEqual(
+                    sorted(self.round_trip(compress=compress, delta=delta)),
+                    sorted(self.hashes))
+
+    def test_compact(self):
+        '''Delta encoding sorted hashes saves space'''
+        sizes = []
+        for delta in (True, False):
+            buf = io.BytesIO()
+            writer = export.Writer(buf, compress=False, delta=delta)
+            writer.write(range(0, 100000, 7))
+            writer.close()
+            sizes.append(len(buf.getvalue()))
+        self.assertTrue(sizes[0] * 4 < sizes[1])
+
+    def test_invalid(self):
+        '''Files that aren't exports (or are cut short) are rejected'''
+        self.assertRaises(ValueError, list, export.read(io.BytesIO(b'nope')))
+        buf = io.BytesIO()
+        export.Writer(buf).write(self.hashes)
+        buf.seek(0)
+        self.assertRaises(ValueError, list, export.read(buf))
+
+    def test_key_ranges(self):
+        '''The ranges cover the whole space, without crossing the sign bit'''
+        for count in (1, 2, 5, 8):
+            ranges = export.key_ranges(count)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], 2 ** 64 - 1)
+            for (_, high), (low, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(high + 1, low)
+            for low, high in ranges:
+                self.assertEqual(low >> 63, high >> 63)
+
+    def test_migrate(self):
+        '''A corpus can be exported and imported with another layout'''
+        path = os.path.join(self.directory, 'simhash.db')
+        source = Client('sqlite', 'source', 6, 3, path=path)
+        target = Client('sqlite', 'target', 8, 2, path=path)
+        source.insert(self.hashes)
+
+        exported = os.path.join(self.directory, 'export')
+        self.assertEqual(source.export(exported), len(self.hashes))
+        self.assertEqual(target.import_(exported), len(self.hashes))
+        self.assertEqual(sorted(target.iter_hashes()), sorted(self.hashes))
+        self.assertEqual(target.find_all(self.hashes[0]), [self.hashes[0]])
+        source.delete()
+        target.delete()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+
+'''Make sure importing the package and its backends stays cheap and free of
+side effects. Each import is timed in a fresh interpreter; the budget (in
+seconds) can be set with SIMHASH_DB_IMPORT_BUDGET'''
+
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+BUDGET = float(os.environ.get('SIMHASH_DB_IMPORT_BUDGET', '1.0'))
+MODULES = [
+    'simhash_db',
+    'simhash_db.judy_client',
+    'simhash_db.redis_client',
+    'simhash_db.mongo_client',
+    'simhash_db.hbase_client',
+    'simhash_db.riak_client',
+    'simhash_db.elasticsearch_client',
+    'simhash_db.cassandra_client',
+    'simhash_db.sqlite_client',
+    'simhash_db.tiered_client',
+    'simhash_db.ingest',
+    'simhash_db.columnar'
+]
+
+SCRIPT = '''
+import sys, json, time, socket, threading
+start = time.time()
+try:
+    __import__(%r)
+except ImportError as exc:
+    print(json.dumps({'missing': str(exc)}))
+    sys.exit(0)
+print(json.dumps({
+    'seconds': time.time() - start,
+    'monkey': 'gevent.monkey' in sys.modules,
+    'socket': socket.socket.__module__,
+    'thread': threading.Thread.__module__
+}))
+'''
+
+
+def measure(module):
+    '''Import the module in a fresh interpreter and report on it'''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT % module], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+class ImportTest(unittest.TestCase):
+    '''Importing any of the modules should be fast and not patch anything'''
+    def test_imports(self):
+        for module in MODULES:
+            result = measure(module)
+            if 'missing' in result:
+                continue
+            self.assertFalse(result['monkey'], module)
+            self.assertEqual(result['socket'], 'socket', module)
+            self.assertEqual(result['thread'], 'threading', module)
+            self.assertTrue(result['seconds'] < BUDGET, '%s took %fs' % (
+                module, result['seconds']))
+
+
+if __name__ == '__main__':
+    for module in MODULES:
+        print('%-35s %s' % (module, measure(module)))
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+
+'''Make sure the ingestion pipeline is sane'''
+
+import simhash
+import unittest
+from simhash_db import Client
+from simhash_db.ingest import Pipeline
+from simhash_db.elasticsearch import SimHashHelper
+
+TEXTS = [
+    'the quick brown fox jumps over the lazy dog %i' % i for i in range(5)
+] + ['an entirely different document about something else']
+
+
+class IngestTest(unittest.TestCase):
+    '''Test the ingestion pipeline'''
+    def setUp(self):
+        self.client = Client('judy', 'testing', 6, 3, max_entries=1000)
+
+    def test_insert(self):
+        '''The hashes of all the documents are inserted, in order'''
+        pipeline = Pipeline(self.client, workers=2, batch_size=2)
+        self.assertEqual(pipeline.insert(iter(TEXTS)), len(TEXTS))
+        self.assertEqual(
+            list(self.client.iter_hashes()),
+            [simhash.hash(text) for text in TEXTS])
+
+    def test_dedup(self):
+        '''Documents already in the client are reported as duplicates'''
+        pipeline = Pipeline(self.client, field='text', workers=0)
+        docs = [{'text': text} for text in TEXTS]
+        first = list(pipeline.dedup(docs))
+        self.assertEqual([match for _, _, match in first], [None] * 6)
+        second = list(pipeline.dedup(docs))
+        self.assertNotIn(None, [match for _, _, match in second])
+        self.assertEqual(len(list(self.client.iter_hashes())), 6)
+
+    def test_dedup_batch(self):
+        '''Near-duplicates within a batch match the earlier ones'''
+        pipeline = Pipeline(self.client, workers=0)
+        pipeline.hashes = lambda documents: iter([
+            (documents, [1, 3, 2 ** 64 - 1, 1])])
+        results = list(pipeline.dedup(['a', 'b', 'c', 'd']))
+        self.assertEqual([match for _, _, match in results],
+                         [None, 1, None, 1])
+        self.assertEqual(sorted(self.client.iter_hashes()), [1, 2 ** 64 - 1])
+
+    def test_fields(self):
+        '''The index fields match those of the Elasticsearch helper'''
+        pipeline = Pipeline(self.client, field='text', workers=2)
+        docs = [doc for batch in pipeline.fields(
+            {'text': text} for text in TEXTS) for doc in batch]
+        helper = SimHashHelper(6, 3)
+        for doc in docs:
+            self.assertEqual(
+                doc, helper.get_simhash({'text': doc['text']}, 'text',
+                                        'simhash'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 #! /usr/bin/env python
 
-'''Make sure the Mongo client is sane'''
+'''Make sure the Judy client is sane'''
 
+import os
+import time
+import random
+import shutil
+import tempfile
 import unittest
 from test import BaseTest
 from simhash_db import Client
@@ -12,6 +17,105 @@ class JudyTest(BaseTest, unittest.TestCase):
     def make_client(self, name, num_blocks, num_bits):
         return Client('judy', name, num_blocks, num_bits)
 
+    def test_untracked(self):
+        '''Unbounded clients don't keep track of their hashes for eviction,
+        but log them so they can be exported'''
+        self.client.insert([4, 1, 2])
+        self.client.insert([2])
+        self.assertEqual(self.client.inserted, None)
+        self.assertEqual(self.client.members, None)
+        self.assertEqual(list(self.client.iter_hashes()), [1, 2, 4])
+        memory = self.client.estimated_memory()
+        self.assertEqual(memory['tracking'], 3 * self.client.log_bytes)
+
+    def test_count(self):
+        '''Hashes inserted more than once are counted once'''
+        self.client.insert([4, 1, 2])
+        self.client.insert([2, 4])
+        self.assertEqual(self.client.count(), 3)
+        self.assertEqual(self.client.estimated_memory()['hashes'], 3)
+
+    def test_export(self):
+        '''Unbounded clients can be exported'''
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'export')
+            self.client.insert([1, 2, 4, 2])
+            self.assertEqual(self.client.export(path), 3)
+        finally:
+            shutil.rmtree(directory)
+
+
+class BoundedJudyTest(BaseTest, unittest.TestCase):
+    '''Test the Judy client bounded in size and age'''
+    def make_client(self, name, num_blocks, num_bits):
+        return Client('judy', name, num_blocks, num_bits,
+                      max_entries=1000, max_age=3600)
+
+    def test_max_entries(self):
+        '''The oldest hashes are evicted beyond max_entries'''
+        self.client.max_entries = 2
+        self.client.insert([1, 2, 4])
+        self.assertEqual(set(self.client.find_all(1)), set([2, 4]))
+        # Inserting a hash again makes it the newest
+        self.client.insert(2)
+        self.client.insert(8)
+        self.assertEqual(list(self.client.iter_hashes()), [2, 8])
+
+    def test_max_age(self):
+        '''Hashes older than max_age are evicted'''
+        self.client.insert([1, 2])
+        self.client.inserted[1] = time.time() - 7200
+        # Reads only evict once expire_interval has passed
+        self.assertEqual(self.client.find_one(1), 1)
+        self.client.last_evicted -= self.client.expire_interval
+        self.assertEqual(self.client.find_one(1), 2)
+        self.assertEqual(list(self.client.iter_hashes()), [2])
+
+    def test_read_no_evict(self):
+        '''Without max_age, reads don't evict'''
+        self.client = Client('judy', 'testing', 6, 3, max_entries=2)
+        self.client.insert([1, 2])
+        self.client.max_entries = 1
+        self.assertEqual(set(self.client.find_all(1)), set([1, 2]))
+        self.client.insert(4)
+        self.assertEqual(list(self.client.iter_hashes()), [4])
+
+    def test_estimated_memory(self):
+        '''Memory is estimated per table, and the budget is kept'''
+        self.client.insert([1, 2, 4])
+        usage = self.client.estimated_memory()
+        self.assertEqual(usage['hashes'], 3)
+        self.assertEqual(len(usage['tables']), self.client.num_tables)
+        self.assertEqual(
+            usage['total'], 3 * self.client.bytes_per_hash())
+        self.client.max_memory = 2 * self.client.bytes_per_hash()
+        self.client.insert(8)
+        self.assertEqual(list(self.client.iter_hashes()), [4, 8])
+
+    def test_random(self):
+        '''The random policy evicts from every table consistently'''
+        self.client = Client('judy', 'testing', 6, 3, max_entries=10,
+                             policy='random')
+        rand = random.Random(1)
+        hashes = [rand.getrandbits(64) for _ in range(20)]
+        self.client.insert(hashes)
+        kept = set(self.client.iter_hashes())
+        self.assertEqual(len(kept), 10)
+        for hsh in hashes:
+            self.assertEqual(self.client.find_all(hsh),
+                             [hsh] if hsh in kept else [])
+        # Every evicted hash was moved out of the tracking consistently
+        self.assertEqual(
+            sorted(self.client.positions.values()), list(range(10)))
+        for hsh, position in self.client.positions.items():
+            self.assertEqual(self.client.members[position], hsh)
+
+    def test_random_max_age(self):
+        '''Age-based eviction needs the oldest-first policy'''
+        self.assertRaises(ValueError, Client, 'judy', 'testing', 6, 3,
+                          max_age=60, policy='random')
+
 
 if __name__ == '__main__':
     unittest.main()
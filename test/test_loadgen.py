@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+
+'''Make sure the open-loop load generator is sane'''
+
+import time
+import random
+import threading
+import unittest
+from simhash_db import Client
+from simhash_db.loadgen import (
+    batch_sizes, schedule, open_loop, saturated, sweep)
+
+
+class SlowClient(object):
+    '''A client that takes `delay` seconds per call, and can't be shared'''
+    stream_in_flight = 1
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def find_all(self, hashes):
+        '''Take a while to find nothing'''
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.calls += 1
+        return [[] for _ in hashes]
+
+
+class HungClient(object):
+    '''A client whose calls don't return until it's released'''
+    def __init__(self):
+        self.release = threading.Event()
+
+    def find_all(self, hashes):
+        '''Wait to be released'''
+        self.release.wait()
+        return [[] for _ in hashes]
+
+
+class LoadgenTest(unittest.TestCase):
+    '''Test the schedule and the sweep'''
+    def test_schedule(self):
+        '''Arrivals are increasing, within the duration and near the rate'''
+        times = schedule(1000, 2, random.Random(1))
+        self.assertEqual(times, sorted(times))
+        self.assertTrue(all(0 <= when < 2 for when in times))
+        self.assertTrue(1800 < len(times) < 2200)
+        self.assertEqual(times, schedule(1000, 2, random.Random(1)))
+
+    def test_batch_sizes(self):
+        '''Batch size specifications are parsed'''
+        rand = random.Random(1)
+        self.assertEqual(batch_sizes('5')(rand), 5)
+        self.assertEqual(batch_sizes('fixed:7')(rand), 7)
+        self.assertTrue(2 <= batch_sizes('uniform:2:4')(rand) <= 4)
+        self.assertTrue(batch_sizes('exponential:3')(rand) >= 1)
+        self.assertRaises(ValueError, batch_sizes, 'normal:3')
+
+    def test_sweep(self):
+        '''Every rate is run until one saturates'''
+        client = Client('judy', 'testing', 6, 3)
+        results, sustained = sweep(client, [40, 20], 0.2, seed=1)
+        self.assertEqual([r['rate'] for r in results], [20, 40])
+        self.assertEqual(sustained, 40)
+        for result in results:
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(result['completed'], result['sent'])
+
+    def test_saturated(self):
+        '''A slow client saturates, and no requests outlive the run'''
+        client = SlowClient(0.05)
+        results, sustained = sweep(client, [200, 400], 0.2, seed=1)
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0]['saturated'])
+        self.assertEqual(sustained, None)
+        self.assertEqual(client.most, 1)
+        calls = client.calls
+        time.sleep(0.1)
+        self.assertEqual(client.calls, calls)
+        self.assertEqual(client.running, 0)
+
+    def test_workers(self):
+        '''Workers are stopped before returning'''
+        before = threading.active_count()
+        open_loop(SlowClient(0.05), 100, 0.1, workers=4, seed=1)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_stuck(self):
+        '''A hung request doesn't block forever, and is reported'''
+        client = HungClient()
+        start = time.time()
+        result = open_loop(client, 50, 0.1, workers=2, seed=1)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(result['stuck'], 2)
+        self.assertTrue(saturated(result))
+        client.release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
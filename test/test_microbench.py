@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+'''Microbenchmarks for the pure-CPU hot paths, gated against a baseline.
+
+Each benchmark is timed with several repeats, and its min and median time per
+call are compared against those stored in the baseline file. A benchmark fails
+only when both are slower than the baseline by more than the threshold, which
+keeps one noisy repeat from failing the run. Baselines are machine-specific,
+so they aren't checked in, and the gate is skipped without one. Record one
+(on a known-good checkout) with:
+
+    python test_microbench.py --update
+
+Benchmarks of backends whose dependencies aren't installed are skipped. The
+baseline path (so CI can supply one) and threshold can be set with
+SIMHASH_DB_BENCH_BASELINE and SIMHASH_DB_BENCH_THRESHOLD (a fraction, 0.25 by
+default).'''
+
+import os
+import sys
+import json
+import random
+import struct
+import timeit
+import unittest
+from simhash_db import BaseClient
+
+
+BASELINE = os.environ.get('SIMHASH_DB_BENCH_BASELINE', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json'))
+THRESHOLD = float(os.environ.get('SIMHASH_DB_BENCH_THRESHOLD', '0.25'))
+REPEAT = 7
+
+
+def measure(function, number):
+    '''Time `function`, returning the min and median seconds per call'''
+    times = sorted(t / number for t in timeit.repeat(
+        function, repeat=REPEAT, number=number))
+    return {'min': times[0], 'median': times[len(times) // 2]}
+
+
+# The benchmarks of helpers in backends whose dependencies may be missing
+BACKENDS = ('mongo_client', 'elasticsearch_client')
+
+
+def benchmarks(group='core'):
+    '''Return a dictionary of name => (function, number of calls per repeat)
+    for the benchmarks in a group: 'core', or one of `BACKENDS`. Raises
+    ImportError if the group's dependencies aren't installed'''
+    rand = random.Random(0)
+    client = BaseClient('bench', 6, 3)
+    hashes = [rand.randint(0, 2 ** 64 - 1) for i in range(100)]
+    hsh = hashes[0]
+    packed = [struct.pack('!Q', h) for h in hashes]
+
+    if group == 'core':
+        return {
+            'permute': (lambda: client.permute(hsh), 1000),
+            'ranges': (lambda: client.ranges(hsh), 1000),
+            'unpack_filter': (lambda: client.filter_candidates(
+                hsh, [struct.unpack('!Q', p)[0] for p in packed]), 100)
+        }
+
+    module = __import__('simhash_db.' + group, fromlist=['x'])
+    results = {
+        group + '.unsigned_to_signed': (
+            lambda: [module.unsigned_to_signed(h) for h in hashes], 100),
+        group + '.signed_to_unsigned': (
+            lambda: [module.signed_to_unsigned(
+                module.unsigned_to_signed(h)) for h in hashes], 100)
+    }
+    if group == 'mongo_client':
+        # Only build documents; no connection is needed for that
+        mongo = object.__new__(module.Client)
+        BaseClient.__init__(mongo, 'bench', 6, 3)
+        results['mongo_client.documents'] = (
+            lambda: mongo.documents(hashes), 10)
+    return results
+
+
+def run(group='core'):
+    '''Run the benchmarks in a group'''
+    return dict((name, measure(function, number))
+                for name, (function, number) in benchmarks(group).items())
+
+
+def record():
+    '''Run all the benchmarks that can be, and save them as the baseline'''
+    results = run()
+    for group in BACKENDS:
+        try:
+            results.update(run(group))
+        except ImportError as exc:
+            print('Skipping %s: %s' % (group, exc))
+    with open(BASELINE, 'w') as fout:
+        json.dump(results, fout, indent=2, sort_keys=True)
+    return results
+
+
+class MicrobenchTest(unittest.TestCase):
+    '''Fail if any hot path got slower than the baseline allows'''
+    def check(self, group):
+        '''Compare a group of benchmarks against the baseline'''
+        if not os.path.exists(BASELINE):
+            self.skipTest('No baseline at %s; record one with `python '
+                          'test_microbench.py --update` or set '
+                          'SIMHASH_DB_BENCH_BASELINE' % BASELINE)
+        try:
+            current = run(group)
+        except ImportError as exc:
+            self.skipTest('Can\'t benchmark %s: %s' % (group, exc))
+        with open(BASELINE) as fin:
+            baseline = json.load(fin)
+
+        slower = []
+        for name, result in sorted(current.items()):
+            if name not in baseline:
+                continue
+            limit = 1.0 + THRESHOLD
+            if (result['min'] > baseline[name]['min'] * limit and
+                    result['median'] > baseline[name]['median'] * limit):
+                slower.append('%s: %.3fus vs %.3fus' % (
+                    name, result['median'] * 1e6,
+                    baseline[name]['median'] * 1e6))
+        self.assertEqual(slower, [], 'Slower than baseline by more than '
+                         '%i%%: %s' % (THRESHOLD * 100, ', '.join(slower)))
+
+    def test_regressions(self):
+        '''The pure-CPU paths of the base client'''
+        self.check('core')
+
+    def test_mongo_client(self):
+        '''The Mongo client's conversions and documents'''
+        self.check('mongo_client')
+
+    def test_elasticsearch_client(self):
+        '''The Elasticsearch client's conversions'''
+        self.check('elasticsearch_client')
+
+
+if __name__ == '__main__':
+    if '--update' in sys.argv:
+        results = record()
+        for name, result in sorted(results.items()):
+            print('%-40s %10.3fus' % (name, result['median'] * 1e6))
+    else:
+        unittest.main()
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+
+'''Make sure the shared connection registry is sane'''
+
+import os
+import time
+import threading
+import unittest
+from simhash_db.pool import Connections
+
+
+class Closeable(object):
+    '''A stand-in connection that remembers being closed'''
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionsTest(unittest.TestCase):
+    '''Test the connection registry'''
+    def setUp(self):
+        self.connections = Connections()
+
+    def test_shared(self):
+        '''The same configuration gets the same connection'''
+        key = Connections.key('redis', (), {'host': 'localhost'})
+        first = self.connections.get(key, object)
+        self.assertTrue(self.connections.get(key, object) is first)
+        other = Connections.key('redis', (), {'host': 'elsewhere'})
+        self.assertFalse(self.connections.get(other, object) is first)
+
+    def test_unhealthy(self):
+        '''A connection that fails its check is replaced'''
+        def check(connection):
+            raise IOError('Connection refused')
+
+        first = self.connections.get('key', object)
+        second = self.connections.get('key', object, check, interval=-1)
+        self.assertFalse(first is second)
+
+    def test_limit(self):
+        '''Past the limit, the least recently used connection is forgotten'''
+        connections = Connections(limit=2)
+        first = connections.get('first', object)
+        connections.get('second', object)
+        self.assertTrue(connections.get('first', object) is first)
+        connections.get('third', object)
+        self.assertEqual(list(connections.entries), ['first', 'third'])
+
+    def test_evict_close(self):
+        '''A connection is closed when it's evicted'''
+        connections = Connections(limit=1)
+        first = connections.get('first', Closeable)
+        second, lock = connections.get(
+            'second', lambda: (Closeable(), threading.Lock()))
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        connections.get('third', Closeable)
+        self.assertTrue(second.closed)
+
+    def test_once_concurrent(self):
+        '''Setup is run once, even when threads ask for it together'''
+        calls = []
+
+        def setup():
+            calls.append(1)
+            time.sleep(0.1)
+
+        threads = [threading.Thread(target=self.connections.once,
+                                    args=('schema', setup)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+
+    def test_concurrent(self):
+        '''A connection is made once, without holding up other keys'''
+        made = []
+
+        def slow():
+            made.append(1)
+            time.sleep(0.2)
+            return object()
+
+        threads = [threading.Thread(target=self.connections.get,
+                                    args=('slow', slow)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        self.connections.get('fast', object)
+        self.assertLess(time.time() - start, 0.1)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(made, [1])
+
+    def test_fork(self):
+        '''A forked child doesn't reuse its parent's connections'''
+        first = self.connections.get('key', object)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            shared = self.connections.get('key', object) is first
+            os.write(write, b'1' if shared else b'0')
+            os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 1), b'0')
+        os.close(read)
+
+
+if __name__ == '__main__':
+    unittest.main()
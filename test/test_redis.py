@@ -2,16 +2,105 @@
 
 '''Make sure the Redis client is sane'''
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
+import redis
 from test import BaseTest
 from simhash_db import Client
 
 
+class FailingUnlink(object):
+    '''A connection whose UNLINK fails with the provided error'''
+    def __init__(self, client, error):
+        self.client = client
+        self.error = error
+
+    def execute_command(self, command, *args):
+        if command == 'UNLINK':
+            raise redis.ResponseError(self.error)
+        return self.client.execute_command(command, *args)
+
+
 class RedisTest(BaseTest, unittest.TestCase):
     '''Test the Redis client'''
     def make_client(self, name, num_blocks, num_bits):
         return Client('redis', name, num_blocks, num_bits)
 
+    def test_export(self):
+        '''Hashes whose scores round onto a partition bound are exported
+        once'''
+        size = 2 ** 60
+        table = self.client.corpus.tables[0]
+        self.client.insert([table.unpermute(size * i + offset)
+                            for i in range(1, 16) for offset in (-2, -1, 1)])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'export')
+            self.assertEqual(self.client.export(path, partitions=16), 45)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unlink_unknown(self):
+        '''Servers without UNLINK get DEL instead'''
+        self.client.client.set('testing.purge', 1)
+        self.client.purge_batch(FailingUnlink(
+            self.client.client, "ERR unknown command 'UNLINK'"),
+            ['testing.purge'])
+        self.assertFalse(self.client.unlink)
+        self.assertEqual(self.client.client.exists('testing.purge'), 0)
+
+    def test_unlink_error(self):
+        '''Other errors from UNLINK are raised'''
+        self.client.client.set('testing.purge', 1)
+        try:
+            self.assertRaises(
+                redis.ResponseError, self.client.purge_batch,
+                FailingUnlink(self.client.client, 'NOPERM no permissions'),
+                ['testing.purge'])
+            self.assertTrue(self.client.unlink)
+        finally:
+            self.client.client.delete('testing.purge')
+
+
+class RedisExactTest(BaseTest, unittest.TestCase):
+    '''Test the Redis client in the 'exact' index mode'''
+    def make_client(self, name, num_blocks, num_bits):
+        return Client('redis', name, num_blocks, num_bits,
+                      index_mode='exact')
+
+    def test_glob_name(self):
+        '''Deleting a database whose name is a pattern leaves others be'''
+        self.client.insert(1)
+        other = self.make_client('test*', 6, 3)
+        other.insert(2 ** 64 - 1)
+        other.delete()
+        self.assertEqual(self.client.find_one(1), 1)
+        self.assertEqual(other.find_one(2 ** 64 - 1), None)
+
+
+class RedisShardedTest(BaseTest, unittest.TestCase):
+    '''Test the Redis client with its tables split into shards, spread over
+    several nodes (databases of the same server, for testing)'''
+    def make_client(self, name, num_blocks, num_bits):
+        return Client('redis', name, num_blocks, num_bits, shard_bits=5,
+                      connection=[redis.Redis(db=i) for i in range(3)])
+
+    def test_export(self):
+        '''Exporting with more partitions than probe workers finishes'''
+        rand = random.Random(1)
+        hashes = set(rand.getrandbits(64) for _ in range(1000))
+        self.client.insert(list(hashes))
+        self.client.probe_workers = 4
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'export')
+            self.assertEqual(self.client.export(path, partitions=16), 1000)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
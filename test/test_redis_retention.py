@@ -12,6 +12,17 @@ class RedisTestRetention(BaseTest, unittest.TestCase):
     def make_client(self, name, num_blocks, num_bits):
         return Client('redis', name, num_blocks, num_bits, weeks=3)
 
+    def test_expiry_recreated(self):
+        '''Keys deleted elsewhere and written again get their expiry back'''
+        self.client.insert(1)
+        redis = self.client.client
+        keys = redis.keys(self.client.name_prefix + '*')
+        self.assertTrue(keys)
+        redis.delete(*keys)
+        self.client.insert(1)
+        for key in redis.keys(self.client.name_prefix + '*'):
+            self.assertGreater(redis.ttl(key), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+
+'''Make sure the remote client and server are sane'''
+
+import asyncio
+import socket
+import threading
+import unittest
+from test import BaseTest
+from simhash_db import Client, GeneralException, protocol
+from simhash_db.server import Batcher, Server
+
+
+class RemoteTest(BaseTest, unittest.TestCase):
+    '''Test the remote client against a server hosting the Judy client'''
+    def make_client(self, name, num_blocks, num_bits):
+        self.stop_server()
+        self.loop = asyncio.new_event_loop()
+        self.server = Server(Client('judy', name, num_blocks, num_bits),
+                             port=0, loop=self.loop)
+        asyncio.set_event_loop(self.loop)
+        listening = self.loop.run_until_complete(self.server.start())
+        port = listening.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.remote = Client('remote', name, num_blocks, num_bits, port=port)
+        return self.remote
+
+    def stop_server(self):
+        '''Close the client, and stop the server and its event loop'''
+        if getattr(self, 'thread', None) is None:
+            return
+        self.remote.close()
+        asyncio.run_coroutine_threadsafe(
+            self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.thread = None
+
+    def tearDown(self):
+        BaseTest.tearDown(self)
+        self.stop_server()
+
+    def test_error(self):
+        '''An error leaves no responses behind on the connection'''
+        def fail(hashes):
+            raise GeneralException('Failed')
+        hosted = self.server.client
+        hosted.find_one = fail
+        self.client.max_request = 1
+        try:
+            self.assertRaises(GeneralException,
+                              self.client.find_one, [1, 2, 3])
+        finally:
+            del hosted.find_one
+        self.client.insert(5)
+        self.assertEqual(self.client.find_one([5, 2 ** 64 - 1]), [5, None])
+
+
+    def test_zero(self):
+        '''A match of 0 isn't mistaken for no match'''
+        ours, theirs = socket.socketpair()
+        self.client.sock.close()
+        self.client.sock = ours
+        theirs.sendall(protocol.response(
+            7, protocol.FIND_ONE, [0, None, 5]))
+        self.assertEqual(self.client.read_response(protocol.FIND_ONE),
+                         (7, [0, None, 5]))
+        theirs.close()
+        self.client.close()
+
+    def test_limit(self):
+        '''Requests over the limit are refused'''
+        self.server.max_request = 2
+        self.assertRaises(GeneralException, self.client.insert, [1, 2, 3])
+        self.client.insert([1, 2])
+        self.assertEqual(self.client.find_one(1), 1)
+
+    def test_reconnect(self):
+        '''A closed connection is opened again by the next call'''
+        self.client.insert(1)
+        self.client.close()
+        self.assertEqual(self.client.find_one(1), 1)
+
+    def test_iter_hashes(self):
+        '''Listing the hashes is rejected clearly'''
+        self.assertRaises(NotImplementedError, self.client.iter_hashes)
+
+
+class BatcherTest(unittest.TestCase):
+    '''Test how requests are batched'''
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = Client('judy', 'testing', 6, 3)
+        self.batcher = Batcher(self.client, self.loop, max_delay=1)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_insert_then_find(self):
+        '''Queries are answered after the inserts queued before them'''
+        inserted = self.batcher.submit(protocol.INSERT, [5])
+        found = self.batcher.submit(protocol.FIND_ONE, [5])
+        self.assertEqual(self.batcher.pending[protocol.INSERT], [])
+        self.loop.run_until_complete(asyncio.gather(inserted, found))
+        self.assertEqual(found.result(), [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+
+'''Make sure the retention buckets are sane'''
+
+import unittest
+from datetime import datetime, timedelta
+from simhash_db.retention import Retention
+
+
+class Clock(object):
+    '''A clock that only moves when told to'''
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RetentionTest(unittest.TestCase):
+    '''Test the retention buckets'''
+    def test_none(self):
+        '''Without retention, there's only the one bucket'''
+        retention = Retention('testing')
+        self.assertEqual(retention.names(), ['testing'])
+        self.assertEqual(retention.expired(['testing']), [])
+
+    def test_weeks(self):
+        '''Weekly buckets are named after their Monday'''
+        clock = Clock(datetime(2026, 10, 21, 13, 30))
+        retention = Retention('testing', weeks=3, clock=clock)
+        self.assertEqual(retention.names(), [
+            'testing-2026-10-19', 'testing-2026-10-12', 'testing-2026-10-05'])
+
+    def test_months(self):
+        '''Monthly buckets are named after their month'''
+        clock = Clock(datetime(2026, 1, 15))
+        retention = Retention('testing', months=2, clock=clock)
+        self.assertEqual(retention.names(), ['testing-2026-01', 'testing-2025-12'])
+
+    def test_rotation(self):
+        '''Crossing into a new bucket changes where hashes go'''
+        clock = Clock(datetime(2026, 10, 25, 23, 59))
+        retention = Retention('testing', weeks=2, clock=clock)
+        self.assertEqual(retention.current(), 'testing-2026-10-19')
+        clock.now = datetime(2026, 10, 26, 0, 1)
+        self.assertEqual(retention.current(), 'testing-2026-10-26')
+
+    def test_since(self):
+        '''Queries for recent hashes only look at recent buckets'''
+        clock = Clock(datetime(2026, 10, 21))
+        retention = Retention('testing', weeks=12, clock=clock)
+        self.assertEqual(retention.since(timedelta(days=1)),
+                         ['testing-2026-10-19'])
+        self.assertEqual(retention.since(timedelta(days=3)),
+                         ['testing-2026-10-19', 'testing-2026-10-12'])
+        self.assertEqual(len(retention.since(None)), 12)
+
+    def test_expired(self):
+        '''Buckets that fell out of the window are expired'''
+        clock = Clock(datetime(2026, 10, 21))
+        retention = Retention('testing', weeks=2, clock=clock)
+        self.assertEqual(retention.expired([
+            'testing-2026-10-19', 'testing-2026-10-12', 'testing-2026-10-05',
+            'other-2020-01-01', 'testing']), ['testing-2026-10-05'])
+        self.assertEqual(retention.expires(retention.current()),
+                         datetime(2026, 11, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
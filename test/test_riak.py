@@ -12,6 +12,51 @@ class RiakTest(BaseTest, unittest.TestCase):
     def make_client(self, name, num_blocks, num_bits):
         return Client('riak', name, num_blocks, num_bits)
 
+    def test_store(self):
+        '''Each hash is stored under its own key, indexed once per table'''
+        self.client.insert([1, 2])
+        self.assertEqual(sorted(self.client.iter_hashes()), [1, 2])
+
+    def test_bucket_type(self):
+        '''The exact index mode needs a bucket type'''
+        self.assertRaises(ValueError, Client, 'riak', 'testing', 6, 3,
+                          index_mode='exact')
+        ranges = self.client.ranges(1)
+        for i in range(self.client.num_tables):
+            self.assertIn(1, self.client.scan_table(1, i, ranges))
+
+    def test_delete_returns_clients(self):
+        '''Listing and deleting keys gives every client back to the pool'''
+        self.client.insert([1, 2, 4])
+        self.client.delete()
+        self.assertEqual(self.client.pool.clients.qsize(),
+                         self.client.probe_workers)
+        self.assertEqual(list(self.client.keys()), [])
+
+
+class RiakExactTest(BaseTest, unittest.TestCase):
+    '''Test the Riak client in the 'exact' index mode. This needs a bucket
+    type created with `datatype = set`:
+
+        riak-admin bucket-type create sets '{"props":{"datatype":"set"}}'
+        riak-admin bucket-type activate sets'''
+    def make_client(self, name, num_blocks, num_bits):
+        return Client('riak', name, num_blocks, num_bits,
+                      index_mode='exact', bucket_type='sets')
+
+    def test_missing_set(self):
+        '''A set that was never written is empty'''
+        key = self.client.exact_key(self.client.name, 0, 12345)
+        self.assertEqual(self.client.members(key), [])
+        self.assertEqual(self.client.find_all(12345), [])
+
+    def test_add(self):
+        '''Hashes are added to the set of each of their keys'''
+        self.client.insert([1, 2])
+        for key in self.client.exact_keys(1):
+            self.assertIn(1, self.client.members(key))
+        self.assertEqual(sorted(self.client.iter_hashes()), [1, 2])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+
+'''Make sure the SQLite client is sane'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from test import BaseTest
+from simhash_db import Client
+
+
+class SqliteTest(BaseTest, unittest.TestCase):
+    '''Test the SQLite client'''
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def make_client(self, name, num_blocks, num_bits):
+        return Client('sqlite', name, num_blocks, num_bits,
+                      path=os.path.join(self.directory, 'simhash.db'))
+
+    def test_persistence(self):
+        '''Hashes are still there for a client of the same file'''
+        self.client.insert([1, 2, 4])
+        client = self.make_client('testing', 6, 3)
+        self.assertEqual(set(client.find_all(1)), set([1, 2, 4]))
+        self.assertEqual(set(client.iter_hashes()), set([1, 2, 4]))
+
+    def test_shared(self):
+        '''Clients of the same file share its connection and its lock'''
+        client = self.make_client('testing', 6, 3)
+        self.assertTrue(client.connection is self.client.connection)
+        self.assertTrue(client.lock is self.client.lock)
+
+    def test_pages(self):
+        '''Hashes are listed a page at a time'''
+        hashes = [i * 0x0101010101010101 for i in range(25)]
+        self.client.insert(hashes)
+        self.assertEqual(sorted(self.client.iter_hashes(page_size=10)),
+                         sorted(hashes))
+
+    def test_batch(self):
+        '''A batch of queries gets each of its own results'''
+        ones = 0xFFFFFFFFFFFFFFFF
+        self.client.insert([1, 3, ones, ones ^ 1])
+        self.assertEqual(
+            [set(found) for found in self.client.find_all(
+                [0, ones, 0x5555555555555555])],
+            [set([1, 3]), set([ones, ones ^ 1]), set()])
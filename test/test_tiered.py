@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+
+'''Make sure the tiered client is sane'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from test import BaseTest
+from simhash_db import Client
+from simhash_db.metrics import Registry
+
+
+class TieredTest(BaseTest, unittest.TestCase):
+    '''Test the tiered client, in front of SQLite'''
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def make_client(self, name, num_blocks, num_bits, **kwargs):
+        return Client('tiered', name, num_blocks, num_bits, cold='sqlite',
+                      cold_kwargs={
+                          'path': os.path.join(self.directory, 'simhash.db')},
+                      **kwargs)
+
+    def test_fallback(self):
+        '''Misses in the hot tier are answered by the cold tier'''
+        self.client.hot.max_entries = 2
+        self.client.insert([1, 0xFF00, 0xFF0000])
+        registry = Registry()
+        self.client.instrument(registry)
+        self.assertEqual(
+            self.client.find_one([0xFF00, 1, 31]), [0xFF00, 1, None])
+        self.assertEqual(registry.counter('hot_hits'), 1)
+        self.assertEqual(registry.counter('cold_queries'), 2)
+
+    def test_warm(self):
+        '''The hot tier is warmed from the cold tier'''
+        self.client.insert([1, 2, 4])
+        client = self.make_client('testing', 6, 3, max_entries=2)
+        self.assertEqual(len(list(client.hot.iter_hashes())), 2)
+        self.assertEqual(set(client.find_all(1)), set([1, 2, 4]))
+
+    def test_warm_unbounded(self):
+        '''Without a budget, warming still reads a bounded number'''
+        self.client.insert([1, 2, 4])
+        client = self.make_client('testing', 6, 3, max_entries=None,
+                                  max_age=60, warm=False)
+        client.warm_limit = 2
+        self.assertEqual(client.warm(), 2)
+        self.assertEqual(client.warm(3), 3)